@@ -0,0 +1,129 @@
+"""
+Exposes the counters ``paste.httpserver`` keeps about itself and its
+thread pool (see ``paste.httpserver.ServerMetrics``), as JSON or in
+the Prometheus text format.  This lets you watch for saturation (a
+growing queue, long queue waits, no idle workers) before requests
+start timing out.
+
+Mount it next to your application with ``paste.urlmap``, e.g.::
+
+    [composite:main]
+    use = egg:Paste#urlmap
+    / = myapp
+    /_metrics = metrics
+
+    [app:metrics]
+    use = egg:Paste#server_metrics
+
+Then ``/_metrics`` gives JSON, and ``/_metrics?format=prometheus``
+gives the Prometheus text format.
+"""
+import json
+from paste.request import parse_querystring
+
+__all__ = ['ServerMetricsApp', 'make_server_metrics', 'format_prometheus']
+
+class ServerMetricsApp(object):
+
+    """
+    Application that reports the metrics of the ``paste.httpserver``
+    server it runs in, as JSON (the default) or in the Prometheus text
+    format (with ``?format=prometheus``).  Use ``default_format`` to
+    change what you get without a ``format`` parameter.
+    """
+
+    formats = {
+        'json': 'application/json',
+        'prometheus': 'text/plain; version=0.0.4; charset=utf-8',
+        }
+
+    def __init__(self, default_format='json'):
+        assert default_format in self.formats, (
+            "Unknown format: %r" % default_format)
+        self.default_format = default_format
+
+    def __call__(self, environ, start_response):
+        metrics = environ.get('paste.httpserver.metrics')
+        if metrics is None:
+            start_response('403 Forbidden', [('Content-type', 'text/plain')])
+            return [b'You must use the Paste HTTP server to use this application']
+        format = dict(parse_querystring(environ)).get(
+            'format', self.default_format)
+        if format not in self.formats:
+            start_response('400 Bad Request', [('Content-type', 'text/plain')])
+            return [('Unknown format: %r' % format).encode('utf-8')]
+        data = metrics.snapshot(environ.get('paste.httpserver.thread_pool'))
+        if format == 'json':
+            body = json.dumps(data, sort_keys=True)
+        else:
+            body = format_prometheus(data)
+        body = body.encode('utf-8')
+        start_response('200 OK', [
+            ('Content-type', self.formats[format]),
+            ('Content-length', str(len(body))),
+            ('Cache-control', 'no-cache'),
+            ])
+        return [body]
+
+_prometheus_counters = [
+    ('connections', 'connections_total', 'Connections accepted'),
+    ('requests', 'requests_total', 'Requests handled'),
+    ('reused_requests', 'reused_requests_total',
+     'Requests on a kept-alive connection'),
+    ('bytes_in', 'received_bytes_total', 'Request body bytes read'),
+    ('bytes_out', 'sent_bytes_total', 'Response bytes sent'),
+    ]
+
+_prometheus_gauges = [
+    ('uptime', 'uptime_seconds', 'Seconds since the server started'),
+    ('queue_depth', 'queue_depth', 'Tasks waiting for a worker thread'),
+    ('workers', 'workers', 'Worker threads'),
+    ('busy_workers', 'busy_workers', 'Worker threads handling a request'),
+    ('idle_workers', 'idle_workers', 'Worker threads waiting for a task'),
+    ]
+
+def format_prometheus(data, prefix='paste_httpserver_'):
+    """
+    Format the result of ``ServerMetrics.snapshot()`` in the Prometheus
+    text exposition format.
+    """
+    lines = []
+    def metric(name, type, help):
+        lines.append('# HELP %s%s %s' % (prefix, name, help))
+        lines.append('# TYPE %s%s %s' % (prefix, name, type))
+    for key, name, help in _prometheus_counters:
+        metric(name, 'counter', help)
+        lines.append('%s%s %s' % (prefix, name, data[key]))
+    for key, name, help in _prometheus_gauges:
+        if key in data:
+            metric(name, 'gauge', help)
+            lines.append('%s%s %s' % (prefix, name, data[key]))
+    if 'worker_requests' in data:
+        metric('worker_requests', 'gauge',
+               'Requests handled by each live worker thread')
+        for thread_id, count in sorted(data['worker_requests'].items()):
+            lines.append('%sworker_requests{thread="%s"} %s'
+                         % (prefix, thread_id, count))
+    metric('queue_wait_seconds', 'histogram',
+           'Time tasks waited for a worker thread')
+    for bound, count in data['queue_wait_buckets']:
+        lines.append('%squeue_wait_seconds_bucket{le="%s"} %s'
+                     % (prefix, bound, count))
+    lines.append('%squeue_wait_seconds_sum %s'
+                 % (prefix, data['queue_wait_total']))
+    lines.append('%squeue_wait_seconds_count %s'
+                 % (prefix, data['queue_wait_count']))
+    metric('response_time_seconds', 'summary',
+           'Time to handle a request, over recent requests')
+    for quantile, value in sorted(data['response_time_percentiles'].items()):
+        lines.append('%sresponse_time_seconds{quantile="%s"} %s'
+                     % (prefix, quantile, value))
+    lines.append('%sresponse_time_seconds_sum %s'
+                 % (prefix, data['response_time_total']))
+    lines.append('%sresponse_time_seconds_count %s'
+                 % (prefix, data['requests']))
+    return '\n'.join(lines) + '\n'
+
+def make_server_metrics(global_conf, default_format='json'):
+    return ServerMetricsApp(default_format=default_format)
+make_server_metrics.__doc__ = ServerMetricsApp.__doc__
@@ -10,19 +10,35 @@ if-modified-since request header.
 """
 
 import os, time, mimetypes, zipfile, tarfile
+import binascii
+import mmap
+import re
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+try:
+    # Python 3
+    from email.utils import parsedate_tz, mktime_tz
+except ImportError:
+    # Python 2
+    from rfc822 import parsedate_tz, mktime_tz
 from paste.httpexceptions import *
 from paste.httpheaders import *
 
 CACHE_SIZE = 4096
 BLOCK_SIZE = 4096 * 16
 
-__all__ = ['DataApp', 'FileApp', 'DirectoryApp', 'ArchiveStore']
+__all__ = ['DataApp', 'FileApp', 'DirectoryApp', 'ArchiveStore',
+           'CompressedCache']
 
 class DataApp(object):
     """
     Returns an application that will send content in a single chunk,
     this application has support for setting cache-control and for
-    responding to conditional (or HEAD) requests.
+    responding to conditional (or HEAD) requests.  ``Range`` requests
+    are answered as in RFC 7233, with a ``multipart/byteranges`` body
+    for several ranges, and honoring ``If-Range``.
 
     Constructor Arguments:
 
@@ -55,6 +71,8 @@ class DataApp(object):
     """
 
     allowed_methods = ('GET', 'HEAD')
+    # Requests for more ranges than this get the whole content
+    max_ranges = 64
 
     def __init__(self, content, headers=None, allowed_methods=None,
                  **kwargs):
@@ -144,16 +162,35 @@ class DataApp(object):
                 return exce.wsgi_application(environ, start_response)
 
         (lower, upper) = (0, self.content_length - 1)
-        range = RANGE.parse(environ)
-        if range and 'bytes' == range[0] and 1 == len(range[1]):
-            (lower, upper) = range[1][0]
-            upper = upper or (self.content_length - 1)
-            if upper >= self.content_length or lower > upper:
-                return HTTPRequestRangeNotSatisfiable((
-                  "Range request was made beyond the end of the content,\r\n"
-                  "which is %s long.\r\n  Range: %s\r\n") % (
-                     self.content_length, RANGE(environ))
-                ).wsgi_application(environ, start_response)
+        range = None
+        if self.if_range_matches(environ, current_etag):
+            range = _byte_ranges(RANGE(environ), self.content_length)
+            if range is not None and len(range) > self.max_ranges:
+                range = None
+        if range is not None and not range:
+            return HTTPRequestRangeNotSatisfiable((
+              "Range request was made beyond the end of the content,\r\n"
+              "which is %s long.\r\n  Range: %s\r\n") % (
+                 self.content_length, RANGE(environ)),
+              headers=[('Content-Range', 'bytes */%d' % self.content_length)]
+            ).wsgi_application(environ, start_response)
+        if range and len(range) > 1:
+            body = _ByteRanges(range, CONTENT_TYPE(headers),
+                               self.content_length)
+            CONTENT_TYPE.update(headers, 'multipart/byteranges; boundary=%s'
+                                % body.boundary)
+            CONTENT_RANGE.delete(headers)
+            CONTENT_LENGTH.update(headers, body.content_length)
+            start_response('206 Partial Content', headers)
+            if isinstance(self.content, memoryview):
+                return _ViewIter(list(body.iter_body(
+                    lambda lower, length: [self.content[lower:lower + length]])))
+            if self.content is not None:
+                return body.iter_body(
+                    lambda lower, length: [self.content[lower:lower + length]])
+            return body
+        if range:
+            (lower, upper) = range[0]
 
         content_length = upper - lower + 1
         CONTENT_RANGE.update(headers, first_byte=lower, last_byte=upper,
@@ -164,43 +201,170 @@ class DataApp(object):
         else:
             start_response('200 OK', headers)
         if self.content is not None:
-            return [self.content[lower:upper+1]]
+            content = self.content[lower:lower + content_length]
+            if isinstance(content, memoryview):
+                return _ViewIter([content])
+            return [content]
         return (lower, content_length)
 
+    def if_range_matches(self, environ, current_etag):
+        """
+        False if there is an ``If-Range`` header for another version
+        of the content, so the whole content should be sent.
+        """
+        value = environ.get('HTTP_IF_RANGE', '').strip()
+        if not value:
+            return True
+        if value.startswith('"') or value.startswith('W/'):
+            # Weak tags never match
+            return value == current_etag
+        try:
+            date = mktime_tz(parsedate_tz(value))
+        except (TypeError, OverflowError):
+            return False
+        return date == int(self.last_modified)
+
 class FileApp(DataApp):
     """
     Returns an application that will send the file at the given
     filename.  Adds a mime type based on ``mimetypes.guess_type()``.
-    See DataApp for the arguments beyond ``filename``.
+    See DataApp for the arguments beyond ``filename`` and these:
+
+        ``precompressed``   if true, send a ``.br`` or ``.gz`` file
+                            next to this one (like ``app.js.gz``) to
+                            clients that accept that encoding, as long
+                            as it is not older than this file
+
+        ``compressed_cache``    a ``CompressedCache``, used to send
+                                gzipped text files that have no
+                                ``.gz`` file next to them
+
+    With either of these the response has ``Vary: Accept-Encoding``,
+    and each encoding gets its own ``ETag``.
+
+        ``use_mmap``    if true, files too big to read into memory are
+                        memory-mapped, and responses (including
+                        ranges) are sent from the one mapping instead
+                        of being read from a new file object each time.
+                        The body gives ``bytes`` in ``BLOCK_SIZE``
+                        pieces, but when it goes straight to
+                        ``paste.httpserver`` (with no middleware
+                        between) the server sends the mapping's
+                        ``memoryview`` slices without copying.  The file
+                        should be replaced rather than changed in place.
     """
 
-    def __init__(self, filename, headers=None, **kwargs):
+    # (content-coding, file extension), in order of preference
+    precompressed_encodings = [('br', '.br'), ('gzip', '.gz')]
+    # If set, update() checks the file at most this often (in seconds)
+    check_interval = 0
+    last_checked = 0
+
+    def __init__(self, filename, headers=None, precompressed=False,
+                 compressed_cache=None, use_mmap=False, **kwargs):
         self.filename = filename
+        self.use_mmap = use_mmap
+        self.precompressed = precompressed
+        self.compressed_cache = compressed_cache
+        self.variants = {}
+        self.update_lock = threading.Lock()
         content_type, content_encoding = self.guess_type()
         if content_type and 'content_type' not in kwargs:
             kwargs['content_type'] = content_type
         if content_encoding and 'content_encoding' not in kwargs:
             kwargs['content_encoding'] = content_encoding
         DataApp.__init__(self, None, headers, **kwargs)
+        if CONTENT_ENCODING(self.headers):
+            # Already encoded; don't encode it again
+            self.precompressed = False
+            self.compressed_cache = None
+        if self.precompressed or self.compressed_cache is not None:
+            VARY.update(self.headers, 'Accept-Encoding')
 
     def guess_type(self):
         return mimetypes.guess_type(self.filename)
 
     def update(self, force=False):
+        now = time.time()
+        if (not force and self.check_interval
+            and now - self.last_checked < self.check_interval):
+            return
         stat = os.stat(self.filename)
         if not force and stat.st_mtime == self.last_modified:
+            self.last_checked = now
             return
-        self.last_modified = stat.st_mtime
+        # The new content and headers are made before any of them are
+        # changed, since other threads may be sending this file; until
+        # then they see the old version, and don't skip the reload
         if stat.st_size < CACHE_SIZE:
             fh = open(self.filename,"rb")
-            self.set_content(fh.read(), stat.st_mtime)
+            content = fh.read()
             fh.close()
+            content_length = len(content)
+        elif self.use_mmap:
+            # A mapping still used by a response is closed once the
+            # last slice of it is released
+            content = _map_file(self.filename)
+            content_length = len(content)
         else:
-            self.content = None
-            self.content_length = stat.st_size
-            # This is updated automatically if self.set_content() is
-            # called
-            LAST_MODIFIED.update(self.headers, time=self.last_modified)
+            content = None
+            content_length = stat.st_size
+        headers = self.headers[:]
+        LAST_MODIFIED.update(headers, time=stat.st_mtime)
+        with self.update_lock:
+            self.content = content
+            self.content_length = content_length
+            self.last_modified = stat.st_mtime
+            self.headers = headers
+            self.last_checked = now
+
+    def variant_headers(self):
+        """
+        The headers for an encoded variant of this file, which sets
+        its own content headers.
+        """
+        content_headers = ('content-type', 'content-encoding',
+                           'content-length', 'last-modified')
+        return [(name, value) for (name, value) in self.headers
+                if name.lower() not in content_headers]
+
+    def encoded_variant(self, environ):
+        """
+        Returns an application for a compressed variant of this file
+        that the client accepts, or None.  ``update()`` must have been
+        called.
+        """
+        accepted = _accepted_encodings(environ)
+        if not accepted:
+            return None
+        if self.precompressed:
+            for encoding, ext in self.precompressed_encodings:
+                if encoding not in accepted:
+                    continue
+                sibling = self.filename + ext
+                try:
+                    mtime = os.stat(sibling).st_mtime
+                except OSError:
+                    self.variants.pop(encoding, None)
+                    continue
+                if mtime < self.last_modified:
+                    # Left over from an older version of the file
+                    continue
+                app = self.variants.get(encoding)
+                if app is None:
+                    app = _EncodedFileApp(
+                        sibling, encoding, self.variant_headers(),
+                        content_type=CONTENT_TYPE(self.headers))
+                    self.variants[encoding] = app
+                app.expires = self.expires
+                return app
+        if (self.compressed_cache is not None and 'gzip' in accepted
+            and _compressible_type(CONTENT_TYPE(self.headers))):
+            app = self.compressed_cache.get(self)
+            if app is not None:
+                app.expires = self.expires
+            return app
+        return None
 
     def get(self, environ, start_response):
         is_head = environ['REQUEST_METHOD'].upper() == 'HEAD'
@@ -208,6 +372,13 @@ class FileApp(DataApp):
             self.update(force=True) # RFC 2616 13.2.6
         else:
             self.update()
+        if self.precompressed or self.compressed_cache is not None:
+            app = self.encoded_variant(environ)
+            if app is not None:
+                retval = app.get(environ, start_response)
+                if is_head:
+                    return [b'']
+                return retval
         if not self.content:
             if not os.path.exists(self.filename):
                 exc = HTTPNotFound(
@@ -222,20 +393,171 @@ class FileApp(DataApp):
                 return exc.wsgi_application(
                     environ, start_response)
         retval = DataApp.get(self, environ, start_response)
-        if isinstance(retval, list):
+        if not isinstance(retval, (tuple, _ByteRanges)):
             # cached content, exception, or not-modified
             if is_head:
                 return [b'']
             return retval
+        if isinstance(retval, _ByteRanges):
+            if is_head:
+                file.close()
+                return [b'']
+            def read(lower, length):
+                file.seek(lower)
+                return _FileIter(file, size=length)
+            return _FileRangesIter(file, retval.iter_body(read))
         (lower, content_length) = retval
         if is_head:
             return [b'']
         file.seek(lower)
         file_wrapper = environ.get('wsgi.file_wrapper', None)
-        if file_wrapper:
+        if file_wrapper and getattr(file_wrapper, 'takes_length', False):
+            return file_wrapper(file, BLOCK_SIZE, length=content_length)
+        if (file_wrapper and lower == 0
+            and content_length == self.content_length):
+            # Other file wrappers read to the end of the file
             return file_wrapper(file, BLOCK_SIZE)
+        return _FileIter(file, size=content_length)
+
+def _byte_ranges(value, length):
+    """
+    Parses a ``Range`` header (RFC 7233) for content of ``length``
+    bytes.  Returns a sorted list of ``(first, last)`` byte positions,
+    with overlapping and adjacent ranges joined; ``[]`` if none of the
+    ranges can be satisfied; or None if the header is not a valid byte
+    range request, and should be ignored.
+    """
+    units, sep, spec = (value or '').partition('=')
+    if not sep or units.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    valid = False
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        match = _byte_range_re.match(item)
+        if match is None:
+            return None
+        first, last = match.groups()
+        if first is None:
+            if last is None:
+                return None
+            # The last ``last`` bytes
+            first, last = max(length - int(last), 0), length - 1
+            if last < first:
+                valid = True
+                continue
         else:
-            return _FileIter(file, size=content_length)
+            first = int(first)
+            if last is None:
+                last = length - 1
+            else:
+                last = int(last)
+                if last < first:
+                    return None
+                last = min(last, length - 1)
+            if first >= length:
+                valid = True
+                continue
+        valid = True
+        ranges.append((first, last))
+    if not valid:
+        return None
+    ranges.sort()
+    joined = []
+    for first, last in ranges:
+        if joined and first <= joined[-1][1] + 1:
+            joined[-1] = (joined[-1][0], max(last, joined[-1][1]))
+        else:
+            joined.append((first, last))
+    return joined
+
+_byte_range_re = re.compile(r'^(\d+)?\s*-\s*(\d+)?$')
+
+class _ByteRanges(object):
+    """
+    The body of a ``multipart/byteranges`` response, with a part for
+    each ``(first, last)`` range of the content.
+    """
+
+    def __init__(self, ranges, content_type, total_length):
+        self.boundary = binascii.hexlify(os.urandom(12)).decode('ascii')
+        self.parts = []
+        for first, last in ranges:
+            head = ('\r\n--%s\r\nContent-Type: %s\r\n'
+                    'Content-Range: bytes %d-%d/%d\r\n\r\n'
+                    % (self.boundary, content_type, first, last,
+                       total_length))
+            self.parts.append((head.encode('latin-1'), first,
+                               last - first + 1))
+        self.tail = ('\r\n--%s--\r\n' % self.boundary).encode('ascii')
+        self.content_length = len(self.tail) + sum(
+            [len(head) + length for (head, first, length) in self.parts])
+
+    def iter_body(self, read):
+        """
+        Yields the body; ``read(first, length)`` returns an iterable of
+        the content of a range.
+        """
+        for head, first, length in self.parts:
+            yield head
+            for chunk in read(first, length):
+                yield chunk
+        yield self.tail
+
+class _FileRangesIter(object):
+
+    def __init__(self, file, body):
+        self.file = file
+        self.body = body
+
+    def __iter__(self):
+        return self.body
+
+    def close(self):
+        self.file.close()
+
+def _map_file(filename, offset=0, length=None):
+    """
+    Returns a read-only ``memoryview`` of a file (or of ``length``
+    bytes of it, from ``offset``), backed by a memory mapping.
+    """
+    fh = open(filename, 'rb')
+    try:
+        mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fh.close()
+    content = memoryview(mapping)
+    if offset or length is not None:
+        if length is None:
+            length = len(content) - offset
+        content = content[offset:offset + length]
+    return content
+
+class _ViewIter(object):
+
+    """
+    A body made of ``bytes`` and ``memoryview`` pieces (of mapped
+    files).  Iterating over it gives ``bytes``, in ``BLOCK_SIZE``
+    pieces, as WSGI requires; ``paste.httpserver`` calls
+    ``httpserver_buffers()`` instead, when it gets this straight from
+    the application, and sends the views without copying them.
+    """
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def httpserver_buffers(self):
+        return self.pieces
+
+    def __iter__(self):
+        for piece in self.pieces:
+            if not isinstance(piece, memoryview):
+                yield piece
+                continue
+            for start in range(0, len(piece), BLOCK_SIZE):
+                yield piece[start:start + BLOCK_SIZE].tobytes()
 
 class _FileIter(object):
 
@@ -263,6 +585,132 @@ class _FileIter(object):
         self.file.close()
 
 
+class _EncodedMixin(object):
+    """
+    Gives a content-encoded variant of a file its own ``ETag``.
+    """
+
+    encoding = None
+
+    def calculate_etag(self):
+        return '"%s-%s-%s"' % (self.last_modified, self.content_length,
+                               self.encoding)
+
+class _EncodedFileApp(_EncodedMixin, FileApp):
+
+    def __init__(self, filename, encoding, headers, **kwargs):
+        self.encoding = encoding
+        FileApp.__init__(self, filename, headers, content_encoding=encoding,
+                         **kwargs)
+
+class _EncodedDataApp(_EncodedMixin, DataApp):
+
+    def __init__(self, content, encoding, headers, last_modified, **kwargs):
+        self.encoding = encoding
+        DataApp.__init__(self, None, headers, content_encoding=encoding,
+                         **kwargs)
+        self.set_content(content, last_modified)
+
+_compressible_types = set([
+    'application/javascript', 'application/x-javascript',
+    'application/json', 'application/xml', 'image/svg+xml',
+    ])
+
+def _compressible_type(content_type):
+    content_type = (content_type or '').split(';', 1)[0].strip().lower()
+    return (content_type.startswith('text/')
+            or content_type in _compressible_types
+            or content_type.endswith('+xml')
+            or content_type.endswith('+json'))
+
+def _accepted_encodings(environ):
+    """
+    The content-codings in ``Accept-Encoding`` that are not refused
+    with ``q=0``.
+    """
+    accepted = set()
+    for item in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        pieces = item.split(';')
+        coding = pieces[0].strip().lower()
+        q = 1
+        for param in pieces[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        if coding and q > 0:
+            accepted.add(coding)
+    return accepted
+
+class CompressedCache(object):
+    """
+    A bounded in-memory cache of gzipped files, which ``FileApp``
+    (given ``compressed_cache``) uses for text files that have no
+    ``.gz`` file next to them.  One cache can be shared by many
+    ``FileApp`` instances (and threads).
+
+    Entries are keyed by the file's path, modification time and size,
+    so a changed file is compressed again.  The least recently used
+    entries are dropped to keep the total under ``max_size`` bytes.
+    Files bigger than ``max_file_size`` are never compressed.
+    """
+
+    def __init__(self, max_size=16 * 1024 * 1024,
+                 max_file_size=1024 * 1024, compress_level=6):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.compress_level = compress_level
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, fileapp):
+        """
+        Returns an application sending the gzipped content of
+        ``fileapp``'s file, or None if it isn't worth compressing.
+        """
+        if fileapp.content_length > self.max_file_size:
+            return None
+        key = (fileapp.filename, fileapp.last_modified,
+               fileapp.content_length)
+        with self.lock:
+            if key in self.entries:
+                app = self.entries.pop(key)
+                self.entries[key] = app
+                return app
+        app = self.compress(fileapp)
+        size = app is not None and app.content_length or 0
+        if size > self.max_size:
+            return app
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = app
+                self.size += size
+                while self.size > self.max_size:
+                    old_key, old_app = self.entries.popitem(last=False)
+                    self.size -= (old_app is not None
+                                  and old_app.content_length or 0)
+        return app
+
+    def compress(self, fileapp):
+        fh = open(fileapp.filename, 'rb')
+        try:
+            content = fh.read()
+        finally:
+            fh.close()
+        # 16 + MAX_WBITS gives the gzip header and trailer
+        compressor = zlib.compressobj(
+            self.compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(content) + compressor.flush()
+        if len(compressed) >= len(content):
+            return None
+        return _EncodedDataApp(
+            compressed, 'gzip', fileapp.variant_headers(),
+            fileapp.last_modified,
+            content_type=CONTENT_TYPE(fileapp.headers))
+
 class DirectoryApp(object):
     """
     Returns an application that dispatches requests to corresponding FileApps based on PATH_INFO.
@@ -303,6 +751,14 @@ class ArchiveStore(object):
 
         ``filepath``    the path to the archive being served
 
+        ``cache_size``  the most bytes of decompressed items to keep
+                        in memory; the least recently used are dropped
+
+        ``use_mmap``    if true (the default), items stored in a zip
+                        file without compression are sent straight from
+                        a memory mapping of the archive, and don't count
+                        against ``cache_size``
+
     ``cache_control()``
 
         This method provides validated construction of the ``Cache-Control``
@@ -310,16 +766,23 @@ class ArchiveStore(object):
         ``EXPIRES`` header for HTTP/1.0 clients.
     """
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, cache_size=16 * 1024 * 1024,
+                 use_mmap=True):
+        self.mapping = None
         if zipfile.is_zipfile(filepath):
             self.archive = zipfile.ZipFile(filepath,"r")
+            if use_mmap:
+                self.mapping = _map_file(filepath)
         elif tarfile.is_tarfile(filepath):
             self.archive = tarfile.TarFileCompat(filepath,"r")
         else:
             raise AssertionError("filepath '%s' is not a zip or tar " % filepath)
         self.expires = None
         self.last_modified = time.time()
-        self.cache = {}
+        self.cache_size = cache_size
+        self.cached_bytes = 0
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
 
     def cache_control(self, **kwargs):
         self.expires = CACHE_CONTROL.apply(self.headers, **kwargs) or None
@@ -329,7 +792,10 @@ class ArchiveStore(object):
         path = environ.get("PATH_INFO","")
         if path.startswith("/"):
             path = path[1:]
-        application = self.cache.get(path)
+        with self.lock:
+            application = self.cache.pop(path, None)
+            if application is not None:
+                self.cache[path] = application
         if application:
             return application(environ, start_response)
         try:
@@ -348,9 +814,48 @@ class ArchiveStore(object):
                                 content_encoding = content_encoding)
         else:
             app = DataApp(None, content_type = content_type)
-        app.set_content(self.archive.read(path),
+        app.set_content(self.read(info),
                 time.mktime(info.date_time + (0,0,0)))
-        self.cache[path] = app
         app.expires = self.expires
+        self.cache_app(path, app)
         return app(environ, start_response)
 
+    def read(self, info):
+        """
+        Returns the content of an item: a slice of the archive's
+        mapping if it is stored without compression, or else read
+        (and decompressed) from the archive.
+        """
+        if (self.mapping is not None
+            and info.compress_type == zipfile.ZIP_STORED
+            and not info.flag_bits & 0x1):
+            # The data follows the item's local header, whose
+            # name and extra field lengths can differ from the
+            # central directory's
+            offset = info.header_offset
+            header = self.mapping[offset:offset + zipfile.sizeFileHeader]
+            fields = struct.unpack(zipfile.structFileHeader, header)
+            if fields[0] == zipfile.stringFileHeader:
+                start = (offset + zipfile.sizeFileHeader
+                         + fields[zipfile._FH_FILENAME_LENGTH]
+                         + fields[zipfile._FH_EXTRA_FIELD_LENGTH])
+                return self.mapping[start:start + info.file_size]
+        return self.archive.read(info.filename)
+
+    def cache_app(self, path, app):
+        if isinstance(app.content, memoryview):
+            size = 0
+        else:
+            size = app.content_length
+        if size > self.cache_size:
+            return
+        with self.lock:
+            if path in self.cache:
+                return
+            self.cache[path] = app
+            self.cached_bytes += size
+            while self.cached_bytes > self.cache_size:
+                old_path, old_app = self.cache.popitem(last=False)
+                if not isinstance(old_app.content, memoryview):
+                    self.cached_bytes -= old_app.content_length
+
@@ -10,39 +10,81 @@ WSGI middleware
 Gzip-encodes the response.
 """
 
-import gzip
+import itertools
+import zlib
 from paste.response import header_value, remove_header
 from paste.httpheaders import CONTENT_LENGTH
+from paste.util import converters
+from paste.wsgilib import add_close
 import six
 
+# Content types under text/ or application/ that are already
+# compressed, so gzipping them again only costs time
+incompressible_types = set([
+    'application/zip', 'application/gzip', 'application/x-gzip',
+    'application/x-bzip2', 'application/x-xz', 'application/x-7z-compressed',
+    'application/x-rar-compressed', 'application/x-compress',
+    'application/zstd', 'application/pdf', 'application/octet-stream',
+    ])
+
 class GzipOutput(object):
     pass
 
 class middleware(object):
 
-    def __init__(self, application, compress_level=6):
+    """
+    Gzip-encodes responses for clients that accept it.
+
+    By default the whole compressed response is collected so it can be
+    sent with a ``Content-Length``.  With ``streaming`` each piece the
+    application yields is compressed and passed on as it comes, so
+    large or slow responses don't sit in memory and the client gets
+    the first bytes sooner.  The compressor is flushed (so the client
+    can decode what it has so far) every ``flush_size`` bytes of input.
+
+    Responses smaller than ``min_size`` bytes are sent as they are;
+    with ``streaming``, up to that many bytes are read from the
+    application before deciding.
+    """
+
+    def __init__(self, application, compress_level=6, streaming=False,
+                 min_size=0, flush_size=65536):
         self.application = application
         self.compress_level = int(compress_level)
+        self.streaming = streaming
+        self.min_size = int(min_size)
+        self.flush_size = int(flush_size)
 
     def __call__(self, environ, start_response):
         if 'gzip' not in environ.get('HTTP_ACCEPT_ENCODING', ''):
             # nothing for us to do, so this middleware will
             # be a no-op:
             return self.application(environ, start_response)
-        response = GzipResponse(start_response, self.compress_level)
+        response = GzipResponse(start_response, self.compress_level,
+                                self.min_size, self.flush_size)
         app_iter = self.application(environ,
                                     response.gzip_start_response)
-        if app_iter is not None:
-            response.finish_response(app_iter)
-
+        if app_iter is None:
+            app_iter = []
+        if self.streaming:
+            def close():
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            return add_close(response.stream_response(app_iter), close)
+        response.finish_response(app_iter)
         return response.write()
 
 class GzipResponse(object):
 
-    def __init__(self, start_response, compress_level):
+    def __init__(self, start_response, compress_level, min_size=0,
+                 flush_size=65536):
         self.start_response = start_response
         self.compress_level = compress_level
+        self.min_size = min_size
+        self.flush_size = flush_size
         self.buffer = six.BytesIO()
+        # Output from the write() callable
+        self.written = []
         self.compressible = False
         self.content_length = None
 
@@ -52,16 +94,13 @@ class GzipResponse(object):
         ce = header_value(headers,'content-encoding')
         self.compressible = False
         if ct and (ct.startswith('text/') or ct.startswith('application/')) \
-            and 'zip' not in ct:
+            and 'zip' not in ct \
+            and ct.split(';', 1)[0].strip().lower() not in incompressible_types:
             self.compressible = True
         if ce:
             self.compressible = False
-        if self.compressible:
-            headers.append(('content-encoding', 'gzip'))
-        remove_header(headers, 'content-length')
-        self.headers = headers
         self.status = status
-        return self.buffer.write
+        return self.written.append
 
     def write(self):
         out = self.buffer
@@ -70,17 +109,74 @@ class GzipResponse(object):
         out.close()
         return [s]
 
+    def response_body(self, app_iter):
+        """
+        Returns an iterator over the body to send (compressed or not),
+        and sets up ``self.headers`` to go with it.  This reads the
+        beginning of ``app_iter`` (``min_size`` bytes, if there are
+        that many), but does not close it.
+        """
+        chunks = self._app_chunks(app_iter)
+        # Generators only call start_response once they are started
+        head = []
+        size = 0
+        for s in chunks:
+            head.append(s)
+            size += len(s)
+            if size >= self.min_size or not self.compressible:
+                break
+        if size < self.min_size:
+            self.compressible = False
+        body = itertools.chain(head, chunks)
+        if not self.compressible:
+            return body
+        self.headers.append(('content-encoding', 'gzip'))
+        vary = header_value(self.headers, 'vary')
+        if not vary:
+            self.headers.append(('vary', 'Accept-Encoding'))
+        elif 'accept-encoding' not in vary.lower():
+            remove_header(self.headers, 'vary')
+            self.headers.append(('vary', vary + ', Accept-Encoding'))
+        remove_header(self.headers, 'content-length')
+        return self._compress(body)
+
+    def _app_chunks(self, app_iter):
+        for s in app_iter:
+            if self.written:
+                for written in self.written:
+                    yield written
+                del self.written[:]
+            yield s
+        for written in self.written:
+            yield written
+        del self.written[:]
+
+    def _compress(self, chunks):
+        # 16 + MAX_WBITS gives the gzip header and trailer
+        compressor = zlib.compressobj(
+            self.compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        unflushed = 0
+        for s in chunks:
+            data = compressor.compress(s)
+            unflushed += len(s)
+            if unflushed >= self.flush_size:
+                data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                unflushed = 0
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def stream_response(self, app_iter):
+        body = self.response_body(app_iter)
+        self.start_response(self.status, self.headers)
+        for s in body:
+            if s:
+                yield s
+
     def finish_response(self, app_iter):
-        if self.compressible:
-            output = gzip.GzipFile(mode='wb', compresslevel=self.compress_level,
-                fileobj=self.buffer)
-        else:
-            output = self.buffer
         try:
-            for s in app_iter:
-                output.write(s)
-            if self.compressible:
-                output.close()
+            for s in self.response_body(app_iter):
+                self.buffer.write(s)
         finally:
             if hasattr(app_iter, 'close'):
                 app_iter.close()
@@ -97,11 +193,18 @@ def filter_factory(application, **conf):
         return middleware(application)
     return filter
 
-def make_gzip_middleware(app, global_conf, compress_level=6):
+def make_gzip_middleware(app, global_conf, compress_level=6,
+                         streaming=False, min_size=0, flush_size=65536):
     """
     Wrap the middleware, so that it applies gzipping to a response
     when it is supported by the browser and the content is of
     type ``text/*`` or ``application/*``
+
+    Set ``streaming = true`` to compress responses as they are
+    produced, instead of collecting them to send a ``Content-Length``.
+    Responses under ``min_size`` bytes are not compressed.
     """
     compress_level = int(compress_level)
-    return middleware(app, compress_level=compress_level)
+    return middleware(app, compress_level=compress_level,
+                      streaming=converters.asbool(streaming), min_size=int(min_size),
+                      flush_size=int(flush_size))
@@ -14,47 +14,184 @@ if pyOpenSSL is installed, it also provides SSL capabilities.
 # @@: add in protection against HTTP/1.0 clients who claim to
 #     be 1.1 but do not send a Content-Length
 
-# @@: add support for chunked encoding, this is not a 1.1 server
-#     till this is completed.
-
 from __future__ import print_function
 import atexit
+import bisect
+import collections
+import errno
 import traceback
 import io
+import signal
 import socket, sys, threading
 import posixpath
+import stat
 import six
 import time
 import os
 from itertools import count
 from six.moves import _thread
+from six.moves import http_client
 from six.moves import queue
 from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from six.moves.socketserver import ThreadingMixIn
 from six.moves.urllib.parse import unquote, urlsplit
 from paste.util import converters
 import logging
+from email.utils import formatdate
 try:
     from paste.util import killthread
 except ImportError:
     # Not available, probably no ctypes
     killthread = None
+try:
+    import selectors
+except ImportError:
+    # Python 2 without the selectors34 backport; no event loop server
+    selectors = None
 
-__all__ = ['WSGIHandlerMixin', 'WSGIServer', 'WSGIHandler', 'serve']
+__all__ = ['WSGIHandlerMixin', 'WSGIServer', 'WSGIHandler',
+           'FastWSGIHandler', 'WSGIEventLoopServer', 'FileWrapper',
+           'ServerMetrics', 'PreforkSupervisor', 'serve']
 __version__ = "0.5"
 
 
-def _get_headers(headers, k):
+# Headers that CGI puts in the environ without the HTTP_ prefix
+_cgi_header_keys = {
+    'HTTP_CONTENT_TYPE': 'CONTENT_TYPE',
+    'HTTP_CONTENT_LENGTH': 'CONTENT_LENGTH',
+    }
+
+if six.PY3:
+    def _native(data):
+        return data.decode('iso-8859-1')
+    def _bytes(text):
+        return text.encode('iso-8859-1')
+else:
+    def _native(data):
+        return data
+    def _bytes(text):
+        return text
+
+_http_date_cache = (None, None)
+
+def _http_date():
     """
-    Private function for abstracting differences in getting HTTP request
-    headers on Python 2 vs. Python 3
+    Return the current time formatted for a ``Date`` header; this is
+    only formatted once a second.
     """
+    global _http_date_cache
+    now = int(time.time())
+    cached_time, date = _http_date_cache
+    if cached_time != now:
+        date = formatdate(now, usegmt=True)
+        _http_date_cache = (now, date)
+    return date
+
+# Most systems won't take more buffers than this in one sendmsg() call
+_max_send_buffers = 1024
 
-    if hasattr(headers, 'get_all'):
-        return headers.get_all(k)     # Python 3 - email.message.Message
-    else:
-        return headers.getheaders(k)  # Python 2 - mimetools.Message
 
+class ServerMetrics(object):
+    """
+    Counters kept by the server and its thread pool: connections
+    accepted, requests, requests on kept-alive connections, request
+    body bytes read, bytes sent, time spent waiting in the thread pool
+    queue (as a histogram), and response times (percentiles are taken
+    over the last ``sample_size`` requests).
+
+    Servers put theirs in the environ as
+    ``paste.httpserver.metrics``; ``paste.debug.metrics`` serves it.
+    """
+
+    # Upper bounds (seconds) of the queue wait histogram buckets
+    queue_wait_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+    sample_size = 1024
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.connections = 0
+        self.requests = 0
+        self.reused_requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.response_time_total = 0.0
+        self.response_times = collections.deque(maxlen=self.sample_size)
+        self.queue_wait_counts = [0] * (len(self.queue_wait_buckets) + 1)
+        self.queue_wait_total = 0.0
+
+    def connection_accepted(self):
+        with self.lock:
+            self.connections += 1
+
+    def task_started(self, wait):
+        """
+        Record that a task waited ``wait`` seconds in the queue.
+        """
+        index = bisect.bisect_left(self.queue_wait_buckets, wait)
+        with self.lock:
+            self.queue_wait_counts[index] += 1
+            self.queue_wait_total += wait
+
+    def request_finished(self, duration, bytes_in, bytes_out, reused):
+        with self.lock:
+            self.requests += 1
+            if reused:
+                self.reused_requests += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.response_time_total += duration
+            self.response_times.append(duration)
+
+    def snapshot(self, thread_pool=None):
+        """
+        Return all the counters as a dictionary (of simple values,
+        ready to be serialized).  If ``thread_pool`` is given, its
+        queue depth and worker counts are included.
+        """
+        now = time.time()
+        with self.lock:
+            times = sorted(self.response_times)
+            wait_counts = list(self.queue_wait_counts)
+            result = dict(
+                uptime=now - self.started,
+                connections=self.connections,
+                requests=self.requests,
+                reused_requests=self.reused_requests,
+                bytes_in=self.bytes_in,
+                bytes_out=self.bytes_out,
+                queue_wait_total=self.queue_wait_total,
+                response_time_total=self.response_time_total)
+        result['accept_rate'] = result['connections'] / max(result['uptime'], 1)
+        if result['requests']:
+            result['keepalive_reuse_ratio'] = (
+                float(result['reused_requests']) / result['requests'])
+        else:
+            result['keepalive_reuse_ratio'] = 0.0
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.queue_wait_buckets + ('+Inf',),
+                                wait_counts):
+            cumulative += count
+            buckets.append((str(bound), cumulative))
+        result['queue_wait_buckets'] = buckets
+        result['queue_wait_count'] = cumulative
+        percentiles = {}
+        if times:
+            for p in (0.5, 0.9, 0.99):
+                percentiles[str(p)] = times[min(len(times) - 1,
+                                                int(p * len(times)))]
+            percentiles['1.0'] = times[-1]
+        result['response_time_percentiles'] = percentiles
+        if thread_pool is not None:
+            result['queue_depth'] = thread_pool.queue.qsize()
+            result['workers'] = len(thread_pool.workers)
+            result['busy_workers'] = len(thread_pool.worker_tracker)
+            result['idle_workers'] = len(thread_pool.idle_workers)
+            result['worker_requests'] = dict(
+                (str(thread_id), count) for thread_id, count
+                in list(thread_pool.requests_processed.items()))
+        return result
 
 class ContinueHook(object):
     """
@@ -100,6 +237,60 @@ class ContinueHook(object):
         self._ContinueFile_send()
         return self._ContinueFile_rfile.readlines(sizehint)
 
+class FileWrapper(object):
+    """
+    This server's ``wsgi.file_wrapper``.  When an application returns
+    one of these, the handler sends the file straight to the socket with
+    ``socket.sendfile()`` (which uses ``os.sendfile`` where available),
+    starting at the file's current position and stopping at the
+    response's ``Content-Length``.  If that isn't possible (SSL, a file
+    that isn't a regular file, a chunked response) the file is read in
+    ``block_size`` chunks instead.
+
+    Given ``length``, iterating over the wrapper (as middleware does)
+    stops after that many bytes, instead of at the end of the file;
+    ``takes_length`` tells applications they can pass it.
+    """
+
+    takes_length = True
+
+    def __init__(self, filelike, block_size=8192, length=None):
+        self.filelike = filelike
+        self.block_size = block_size
+        self.length = length
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        size = self.block_size
+        if self.length is not None:
+            size = min(size, self.length)
+            if size <= 0:
+                raise StopIteration
+        data = self.filelike.read(size)
+        if not data:
+            raise StopIteration
+        if self.length is not None:
+            self.length -= len(data)
+        return data
+    __next__ = next
+
+    def regular_fileno(self):
+        """
+        Return the file descriptor of the wrapped file, or None if it
+        isn't a regular file (and so can't be used with sendfile).
+        """
+        try:
+            fileno = self.filelike.fileno()
+            if stat.S_ISREG(os.fstat(fileno).st_mode):
+                return fileno
+        except (AttributeError, EnvironmentError, ValueError):
+            pass
+        return None
+
 class WSGIHandlerMixin:
     """
     WSGI mix-in for HTTPRequestHandler
@@ -133,39 +324,177 @@ class WSGIHandlerMixin:
         else:
             return self.server_version + ' ' + self.sys_version
 
+    # Requests handled so far on this connection
+    wsgi_connection_requests = 0
+
+    # Output is buffered until this many bytes are pending, so that
+    # status, headers and many small body chunks go out in a single
+    # sendmsg() call.  0 sends every chunk as soon as it is written.
+    wsgi_write_buffer_size = 16384
+
+    def wsgi_serialize_headers(self):
+        """
+        Return the status line and headers of the current response
+        as bytes, ready to be sent.  This also decides how the end of
+        the body will be signalled: by ``Content-Length``, by chunked
+        transfer-encoding (HTTP/1.1 only), or by closing the connection.
+        """
+        (status, headers) = self.wsgi_curr_headers
+        code, message = status.split(" ", 1)
+        code = int(code)
+        if (code < 200 or code in (204, 304)
+            or self.command == 'HEAD'):
+            # These responses never have a body
+            self.wsgi_body_allowed = False
+        if self.request_version == 'HTTP/0.9':
+            # No status line or headers at all for HTTP/0.9
+            return b''
+        lines = ['%s %d %s\r\n' % (self.protocol_version, code, message),
+                 'Server: %s\r\n' % self.version_string(),
+                 'Date: %s\r\n' % _http_date()]
+        #
+        # HTTP/1.1 compliance; either send Content-Length, use chunked
+        # encoding, or signal that the connection is being closed.
+        #
+        send_close = self.wsgi_body_allowed
+        for (k, v) in  headers:
+            lk = k.lower()
+            if 'content-length' == lk:
+                send_close = False
+                try:
+                    self.wsgi_content_length = int(v)
+                except ValueError:
+                    pass
+            if 'connection' == lk:
+                lv = v.lower()
+                if 'close' == lv:
+                    self.close_connection = 1
+                    send_close = False
+                elif 'keep-alive' == lv:
+                    self.close_connection = 0
+            if 'transfer-encoding' == lk:
+                # The application did its own encoding; all we can do
+                # is close the connection when it's done
+                self.close_connection = 1
+                send_close = False
+            lines.append('%s: %s\r\n' % (k, v))
+        if send_close:
+            if (not self.close_connection
+                and self.request_version >= 'HTTP/1.1'
+                and self.protocol_version >= 'HTTP/1.1'):
+                self.wsgi_chunked = True
+                lines.append('Transfer-Encoding: chunked\r\n')
+            else:
+                self.close_connection = 1
+                lines.append('Connection: close\r\n')
+        lines.append('\r\n')
+        return _bytes(''.join(lines))
+
     def wsgi_write_chunk(self, chunk):
         """
         Write a chunk of the output stream; send headers if they
-        have not already been sent.
+        have not already been sent.  Output is buffered up to
+        ``wsgi_write_buffer_size`` bytes, see ``wsgi_flush``.
         """
         if not self.wsgi_headers_sent and not self.wsgi_curr_headers:
             raise RuntimeError(
                 "Content returned before start_response called")
         if not self.wsgi_headers_sent:
             self.wsgi_headers_sent = True
-            (status, headers) = self.wsgi_curr_headers
-            code, message = status.split(" ", 1)
-            self.send_response(int(code), message)
-            #
-            # HTTP/1.1 compliance; either send Content-Length or
-            # signal that the connection is being closed.
-            #
-            send_close = True
-            for (k, v) in  headers:
-                lk = k.lower()
-                if 'content-length' == lk:
-                    send_close = False
-                if 'connection' == lk:
-                    if 'close' == v.lower():
-                        self.close_connection = 1
-                        send_close = False
-                self.send_header(k, v)
-            if send_close:
-                self.close_connection = 1
-                self.send_header('Connection', 'close')
+            self.wsgi_pending_head = self.wsgi_serialize_headers()
+        if chunk and self.wsgi_body_allowed:
+            self.wsgi_pending.append(chunk)
+            self.wsgi_pending_size += len(chunk)
+            if self.wsgi_pending_size >= self.wsgi_write_buffer_size:
+                self.wsgi_flush()
+
+    def wsgi_write_file(self, wrapper):
+        """
+        Send the body of a response given as a ``FileWrapper``.
+        """
+        self.wsgi_write_chunk(b'')
+        if not self.wsgi_body_allowed:
+            # A HEAD request (or a 304): don't read a file to drop it
+            return
+        length = self.wsgi_content_length
+        sendfile = getattr(self.connection, 'sendfile', None)
+        if (sendfile is not None and self.wsgi_sendmsg is not None
+            and not self.wsgi_chunked
+            and wrapper.regular_fileno() is not None):
+            # A plain socket (wsgi_sendmsg is only set for those), so
+            # the file can go from the page cache straight to it
+            self.wsgi_flush()
+            file = wrapper.filelike
+            self.wsgi_bytes_sent += sendfile(file, file.tell(), length)
+            return
+        for chunk in wrapper:
+            if length is not None:
+                chunk = chunk[:length]
+                length -= len(chunk)
+            self.wsgi_write_chunk(chunk)
+            if length == 0:
+                break
+
+    def wsgi_write(self, chunk):
+        """
+        The ``write`` callable returned by ``start_response``; unlike
+        the application iterator, this output is sent right away.
+        """
+        self.wsgi_write_chunk(chunk)
+        self.wsgi_flush()
+
+    def wsgi_flush(self):
+        """
+        Send all buffered output to the client.  This is available to
+        applications as ``environ['paste.httpserver.flush']``, for
+        streaming responses where each chunk should go out at once.
+        """
+        self.wsgi_send_pending()
 
-            self.end_headers()
-        self.wfile.write(chunk)
+    def wsgi_finish_response(self):
+        """
+        Send the rest of the response; for a chunked response this
+        includes the terminating chunk.
+        """
+        self.wsgi_send_pending(last=True)
+
+    def wsgi_send_pending(self, last=False):
+        buffers = []
+        if self.wsgi_pending_head:
+            buffers.append(self.wsgi_pending_head)
+            self.wsgi_pending_head = None
+        body = self.wsgi_pending
+        if body:
+            if self.wsgi_chunked:
+                buffers.append(_bytes('%x\r\n' % self.wsgi_pending_size))
+                buffers.extend(body)
+                buffers.append(b'\r\n')
+            else:
+                buffers.extend(body)
+            self.wsgi_pending = []
+            self.wsgi_pending_size = 0
+        if last and self.wsgi_chunked:
+            buffers.append(b'0\r\n\r\n')
+            self.wsgi_chunked = False
+        if not buffers:
+            return
+        sendmsg = self.wsgi_sendmsg
+        if sendmsg is None or len(buffers) == 1:
+            data = b''.join(buffers)
+            self.wfile.write(data)
+            self.wsgi_bytes_sent += len(data)
+            return
+        if len(buffers) > _max_send_buffers:
+            buffers = [b''.join(buffers)]
+        index = 0
+        while index < len(buffers):
+            sent = sendmsg(buffers[index:])
+            self.wsgi_bytes_sent += sent
+            while index < len(buffers) and sent >= len(buffers[index]):
+                sent -= len(buffers[index])
+                index += 1
+            if sent:
+                buffers[index] = memoryview(buffers[index])[sent:]
 
     def wsgi_start_response(self, status, response_headers, exc_info=None):
         if exc_info:
@@ -183,17 +512,13 @@ class WSGIHandlerMixin:
         elif self.wsgi_curr_headers:
             assert 0, "Attempt to set headers a second time w/o an exc_info"
         self.wsgi_curr_headers = (status, response_headers)
-        return self.wsgi_write_chunk
+        return self.wsgi_write
 
-    def wsgi_setup(self, environ=None):
+    def wsgi_split_path(self):
         """
-        Setup the member variables used by this WSGI mixin, including
-        the ``environ`` and status member variables.
-
-        After the basic environment is created; the optional ``environ``
-        argument can be used to override any settings.
+        Split the request path into ``(scheme, netloc, path, query)``,
+        where ``path`` has been unquoted and normalized.
         """
-
         dummy_url = 'http://dummy%s' % (self.path,)
         (scheme, netloc, path, query, fragment) = urlsplit(dummy_url)
         path = unquote(path)
@@ -202,16 +527,48 @@ class WSGIHandlerMixin:
         if endslash and path != '/':
             # Put the slash back...
             path += '/'
+        return (scheme, netloc, path, query)
+
+    def wsgi_header_environ(self):
+        """
+        Return the request headers as CGI environ keys (``HTTP_*``,
+        plus ``CONTENT_TYPE`` and ``CONTENT_LENGTH``); repeated headers
+        are folded into one comma-separated value.
+        """
+        result = {}
+        for k, v in self.headers.items():
+            key = 'HTTP_' + k.replace("-","_").upper()
+            if key in _cgi_header_keys:
+                key = _cgi_header_keys[key]
+                if key not in result:
+                    result[key] = v
+            elif key in result:
+                result[key] += ',' + v
+            else:
+                result[key] = v
+        return result
+
+    def wsgi_setup(self, environ=None):
+        """
+        Setup the member variables used by this WSGI mixin, including
+        the ``environ`` and status member variables.
+
+        After the basic environment is created; the optional ``environ``
+        argument can be used to override any settings.
+        """
+
+        (scheme, netloc, path, query) = self.wsgi_split_path()
         (server_name, server_port) = self.server.server_address[:2]
+        headers = self.wsgi_header_environ()
 
         rfile = self.rfile
         # We can put in the protection to keep from over-reading the
         # file
         try:
-            content_length = int(self.headers.get('Content-Length', '0'))
+            content_length = int(headers.get('CONTENT_LENGTH', '0'))
         except ValueError:
             content_length = 0
-        if '100-continue' == self.headers.get('Expect','').lower():
+        if '100-continue' == headers.get('HTTP_EXPECT', '').lower():
             rfile = LimitedLengthFile(ContinueHook(rfile, self.wfile.write), content_length)
         else:
             if not hasattr(self.connection, 'get_context'):
@@ -227,15 +584,16 @@ class WSGIHandlerMixin:
                ,'wsgi.input': rfile
                ,'wsgi.errors': sys.stderr
                ,'wsgi.multithread': True
-               ,'wsgi.multiprocess': False
+               ,'wsgi.multiprocess': getattr(self.server, 'wsgi_multiprocess',
+                                             False)
                ,'wsgi.run_once': False
                # CGI variables required by PEP-333
                ,'REQUEST_METHOD': self.command
                ,'SCRIPT_NAME': '' # application is root of server
                ,'PATH_INFO': path
                ,'QUERY_STRING': query
-               ,'CONTENT_TYPE': self.headers.get('Content-Type', '')
-               ,'CONTENT_LENGTH': self.headers.get('Content-Length', '0')
+               ,'CONTENT_TYPE': ''
+               ,'CONTENT_LENGTH': '0'
                ,'SERVER_NAME': server_name
                ,'SERVER_PORT': str(server_port)
                ,'SERVER_PROTOCOL': self.request_version
@@ -266,11 +624,20 @@ class WSGIHandlerMixin:
             self.server.thread_pool.worker_tracker[_thread.get_ident()][1] = self.wsgi_environ
             self.wsgi_environ['paste.httpserver.thread_pool'] = self.server.thread_pool
 
-        for k, v in self.headers.items():
-            key = 'HTTP_' + k.replace("-","_").upper()
-            if key in ('HTTP_CONTENT_TYPE','HTTP_CONTENT_LENGTH'):
-                continue
-            self.wsgi_environ[key] = ','.join(_get_headers(self.headers, k))
+        self.wsgi_environ.update(headers)
+        self.wsgi_environ['paste.httpserver.flush'] = self.wsgi_flush
+        self.wsgi_environ['wsgi.file_wrapper'] = FileWrapper
+        # Body chunks may be memoryviews (or other buffers) as well as
+        # bytes; they are sent without being copied.  This doesn't mean
+        # there's no middleware in between that wants bytes, so
+        # applications should only return buffers through an
+        # ``httpserver_buffers()`` method on their result
+        self.wsgi_environ['paste.httpserver.buffers'] = True
+        if getattr(self.server, 'metrics', None) is not None:
+            self.wsgi_environ['paste.httpserver.metrics'] = self.server.metrics
+        self.wsgi_input = rfile
+        self.wsgi_start_time = time.time()
+        self.wsgi_connection_requests += 1
 
         if hasattr(self.connection,'get_context'):
             self.wsgi_environ['wsgi.url_scheme'] = 'https'
@@ -285,6 +652,32 @@ class WSGIHandlerMixin:
 
         self.wsgi_curr_headers = None
         self.wsgi_headers_sent = False
+        self.wsgi_pending_head = None
+        self.wsgi_pending = []
+        self.wsgi_pending_size = 0
+        self.wsgi_bytes_sent = 0
+        self.wsgi_body_allowed = True
+        self.wsgi_chunked = False
+        self.wsgi_content_length = None
+        if (getattr(self, 'wbufsize', 0)
+            or hasattr(self.connection, 'get_context')):
+            # Buffered writes, or SSL; always go through wfile
+            self.wsgi_sendmsg = None
+        else:
+            self.wsgi_sendmsg = getattr(self.connection, 'sendmsg', None)
+
+    def wsgi_record_request(self):
+        """
+        Add the request that was just handled to the server's metrics.
+        """
+        metrics = getattr(self.server, 'metrics', None)
+        if metrics is None:
+            return
+        metrics.request_finished(
+            time.time() - self.wsgi_start_time,
+            getattr(self.wsgi_input, '_consumed', 0),
+            self.wsgi_bytes_sent,
+            self.wsgi_connection_requests > 1)
 
     def wsgi_connection_drop(self, exce, environ=None):
         """
@@ -299,30 +692,61 @@ class WSGIHandlerMixin:
         """
 
         self.wsgi_setup(environ)
+        try:
+            self.wsgi_run_application(environ)
+        finally:
+            self.wsgi_record_request()
 
+    def wsgi_run_application(self, environ=None):
+        """
+        Call the application and send its response.
+        """
         try:
             result = self.server.wsgi_application(self.wsgi_environ,
                                                   self.wsgi_start_response)
             try:
-                for chunk in result:
-                    self.wsgi_write_chunk(chunk)
+                buffers = getattr(result, 'httpserver_buffers', None)
+                if isinstance(result, FileWrapper):
+                    self.wsgi_write_file(result)
+                elif buffers is not None:
+                    # Straight from the application (like a mapped
+                    # file from FileApp), so these may be memoryviews,
+                    # sent without copying; WSGI middleware only gets
+                    # bytes by iterating over the result
+                    for chunk in buffers():
+                        self.wsgi_write_chunk(chunk)
+                else:
+                    for chunk in result:
+                        self.wsgi_write_chunk(chunk)
                 if not self.wsgi_headers_sent:
                     self.wsgi_write_chunk(b'')
+                self.wsgi_finish_response()
             finally:
                 if hasattr(result,'close'):
                     result.close()
                 result = None
         except socket.error as exce:
+            self.close_connection = 1
             self.wsgi_connection_drop(exce, environ)
             return
         except:
-            if not self.wsgi_headers_sent:
+            if not self.wsgi_bytes_sent:
+                # Nothing has gone out yet, so we can still replace
+                # whatever was buffered with an error response
                 error_msg = "Internal Server Error\n"
+                self.wsgi_pending_head = None
+                self.wsgi_pending = []
+                self.wsgi_pending_size = 0
+                self.wsgi_headers_sent = False
+                self.wsgi_body_allowed = True
+                self.wsgi_chunked = False
+                self.wsgi_content_length = None
                 self.wsgi_curr_headers = (
                     '500 Internal Server Error',
                     [('Content-type', 'text/plain'),
                      ('Content-length', str(len(error_msg)))])
                 self.wsgi_write_chunk(b"Internal Server Error\n")
+                self.wsgi_finish_response()
             raise
 
 #
@@ -457,7 +881,16 @@ class WSGIHandler(WSGIHandlerMixin, BaseHTTPRequestHandler):
     def handle(self):
         # don't bother logging disconnects while handling a request
         try:
-            BaseHTTPRequestHandler.handle(self)
+            if isinstance(self.connection, _LoopConnection):
+                # The event loop owns the connection between requests,
+                # so only handle the request it has dispatched to us
+                self.close_connection = 1
+                self.wsgi_connection_requests = self.connection.requests
+                self.handle_one_request()
+                self.connection.requests = self.wsgi_connection_requests
+                self.connection.keep_alive = not self.close_connection
+            else:
+                BaseHTTPRequestHandler.handle(self)
         except SocketErrors as exce:
             self.wsgi_connection_drop(exce)
 
@@ -468,6 +901,170 @@ class WSGIHandler(WSGIHandlerMixin, BaseHTTPRequestHandler):
         """
         return ''
 
+# Header names seen so far, mapped to their environ keys; bounded so
+# that clients can't grow it without limit
+_header_key_cache = {}
+_header_key_cache_size = 1000
+
+class FastWSGIHandler(WSGIHandler):
+    """
+    A ``WSGIHandler`` that parses the request head itself, in a single
+    pass over the raw header lines, building the ``HTTP_*`` environ
+    keys directly instead of going through ``email``-based parsing.
+    Common request paths also skip ``urlsplit`` and ``normpath``.
+
+    Use it with ``serve(handler=FastWSGIHandler)``.  ``self.headers``
+    is still available, but is only built when something asks for it.
+    """
+
+    max_header_line = 65536
+    max_headers = 100
+
+    _headers = None
+
+    def _get_headers(self):
+        if self._headers is None:
+            fp = io.BytesIO(b''.join(self.wsgi_raw_headers) + b'\r\n')
+            if six.PY3:
+                self._headers = http_client.parse_headers(
+                    fp, _class=self.MessageClass)
+            else:
+                self._headers = self.MessageClass(fp, 0)
+        return self._headers
+
+    def _set_headers(self, headers):
+        self._headers = headers
+
+    headers = property(_get_headers, _set_headers)
+
+    def handle_one_request(self):
+        self.raw_requestline = self.rfile.readline(self.max_header_line + 1)
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > self.max_header_line:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request(): # An error code has been sent, just exit
+            return
+        self.wsgi_execute()
+
+    def parse_request(self):
+        """
+        Parse the request line and headers; on failure an error
+        response is sent and False returned.
+        """
+        self.command = None
+        self.request_version = self.default_request_version
+        self.close_connection = 1
+        self._headers = None
+        self.requestline = requestline = _native(
+            self.raw_requestline).rstrip('\r\n')
+        words = requestline.split()
+        if len(words) == 3:
+            command, path, version = words
+            try:
+                if not version.startswith('HTTP/'):
+                    raise ValueError
+                major, minor = version[5:].split('.')
+                version_number = int(major), int(minor)
+            except ValueError:
+                self.send_error(400, "Bad request version (%r)" % version)
+                return False
+            if version_number >= (2, 0):
+                self.send_error(
+                    505, "Invalid HTTP Version (%s)" % version[5:])
+                return False
+            if (version_number >= (1, 1)
+                and self.protocol_version >= "HTTP/1.1"):
+                self.close_connection = 0
+            self.request_version = version
+        elif len(words) == 2:
+            command, path = words
+            if command != 'GET':
+                self.send_error(
+                    400, "Bad HTTP/0.9 request type (%r)" % command)
+                return False
+        elif not words:
+            return False
+        else:
+            self.send_error(400, "Bad request syntax (%r)" % requestline)
+            return False
+        if path.startswith('//'):
+            # Don't let the path look like a network-path reference
+            path = '/' + path.lstrip('/')
+        self.command, self.path = command, path
+
+        environ = self.wsgi_request_headers = {}
+        raw_headers = self.wsgi_raw_headers = []
+        readline = self.rfile.readline
+        max_line = self.max_header_line
+        key = None
+        while True:
+            line = readline(max_line + 1)
+            if len(line) > max_line:
+                self.send_error(431, "Line too long")
+                return False
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(raw_headers) >= self.max_headers:
+                self.send_error(431, "Too many headers")
+                return False
+            raw_headers.append(line)
+            line = _native(line)
+            if line[0] in ' \t':
+                # Folded (obsolete line folding) continuation
+                if key is not None:
+                    environ[key] += ' ' + line.strip()
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                key = None
+                continue
+            value = value.strip()
+            try:
+                key = _header_key_cache[name]
+            except KeyError:
+                key = 'HTTP_' + name.strip().upper().replace('-', '_')
+                key = _cgi_header_keys.get(key, key)
+                if len(_header_key_cache) < _header_key_cache_size:
+                    _header_key_cache[name] = key
+            if key not in environ:
+                environ[key] = value
+            elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                # Like the CGI variables, only the first one counts
+                key = None
+            else:
+                environ[key] += ',' + value
+
+        conntype = environ.get('HTTP_CONNECTION', '').lower()
+        if conntype == 'close':
+            self.close_connection = 1
+        elif (conntype == 'keep-alive'
+              and self.protocol_version >= "HTTP/1.1"):
+            self.close_connection = 0
+        return True
+
+    def wsgi_split_path(self):
+        path = self.path
+        if '#' in path:
+            path = path.split('#', 1)[0]
+        path, sep, query = path.partition('?')
+        if '%' in path:
+            path = unquote(path)
+        if (not path.startswith('/') or '//' in path or '/.' in path):
+            # Needs normalizing; leave it to the general version
+            return WSGIHandler.wsgi_split_path(self)
+        # For the ``paste.httpserver.proxy.*`` keys, this is what
+        # ``WSGIHandler`` reports for a request path
+        return ('http', 'dummy', path, query)
+
+    def wsgi_header_environ(self):
+        return self.wsgi_request_headers
+
 class LimitedLengthFile(object):
     def __init__(self, file, length):
         self.file = file
@@ -574,11 +1171,23 @@ class ThreadPool(object):
 
     Each worker thread only processes ``max_requests`` tasks before it
     dies and replaces itself with a new worker thread.
+
+    Normally hung threads are looked for every ``hung_check_period``
+    tasks, on the thread adding the task.  If ``supervisor_period`` is
+    given, a supervisor thread looks every ``supervisor_period``
+    seconds instead, and also keeps a count of hung threads, so adding
+    a task takes the same (small) time no matter how big the pool is.
+    The supervisor only flags threads to kill; the thread adding tasks
+    kills and replaces them, so it is still the only thread that
+    changes the pool.
     """
 
 
     SHUTDOWN = object()
 
+    # A ServerMetrics instance to record queue wait times in
+    metrics = None
+
     def __init__(
         self, nworkers, name="ThreadPool", daemon=False,
         max_requests=100, # threads are killed after this many requests
@@ -590,6 +1199,7 @@ class ThreadPool(object):
         hung_check_period=100, # every 100 requests check for hung workers
         logger=None, # Place to log messages to
         error_email=None, # Person(s) to notify if serious problem occurs
+        supervisor_period=None, # seconds between hung checks by a supervisor thread
         ):
         """
         Create thread pool with `nworkers` worker threads.
@@ -628,6 +1238,8 @@ class ThreadPool(object):
         self.requests_since_last_hung_check = 0
         # Used to keep track of what worker is doing what:
         self.worker_tracker = {}
+        # Tasks processed by each (live) worker:
+        self.requests_processed = {}
         # Used to keep track of the workers not doing anything:
         self.idle_workers = []
         # Used to keep track of threads that have been killed, but maybe aren't dead yet:
@@ -636,35 +1248,44 @@ class ThreadPool(object):
         # we shouldn't cull extra workers until some time has passed
         # (hung_thread_limit) since workers were added:
         self._last_added_new_idle_workers = 0
+        # Number of hung workers, as of the supervisor's last check:
+        self._hung_count = 0
+        # Set by the supervisor when add_task should kill hung workers:
+        self._kill_hung_due = False
+        self.supervisor_period = supervisor_period
+        self._supervisor_stop = threading.Event()
         if not daemon:
             atexit.register(self.shutdown)
         for i in range(self.nworkers):
             self.add_worker_thread(message='Initial worker pool')
+        if supervisor_period:
+            supervisor = threading.Thread(
+                target=self.supervisor_thread_callback,
+                name="%s supervisor" % name)
+            supervisor.daemon = True
+            supervisor.start()
 
     def add_task(self, task):
         """
         Add a task to the queue
         """
-        self.logger.debug('Added task (%i tasks queued)', self.queue.qsize())
-        if self.hung_check_period:
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Added task (%i tasks queued)', self.queue.qsize())
+        if self.supervisor_period:
+            if self._kill_hung_due:
+                self._kill_hung_due = False
+                self.kill_hung_threads()
+        elif self.hung_check_period:
             self.requests_since_last_hung_check += 1
             if self.requests_since_last_hung_check > self.hung_check_period:
                 self.requests_since_last_hung_check = 0
                 self.kill_hung_threads()
         if not self.idle_workers and self.spawn_if_under:
             # spawn_if_under can come into effect...
-            busy = 0
-            now = time.time()
-            self.logger.debug('No idle workers for task; checking if we need to make more workers')
-            for worker in self.workers:
-                if not hasattr(worker, 'thread_id'):
-                    # Not initialized
-                    continue
-                time_started, info = self.worker_tracker.get(worker.thread_id,
-                                                             (None, None))
-                if time_started is not None:
-                    if now - time_started < self.hung_thread_limit:
-                        busy += 1
+            if self.supervisor_period:
+                busy = len(self.worker_tracker) - self._hung_count
+            else:
+                busy = self._count_busy_workers()
             if busy < self.spawn_if_under:
                 self.logger.info(
                     'No idle tasks, and only %s busy tasks; adding %s more '
@@ -688,7 +1309,55 @@ class ThreadPool(object):
                 'Idle workers: %s', self.idle_workers)
             for i in range(len(self.workers) - self.nworkers):
                 self.queue.put(self.SHUTDOWN)
-        self.queue.put(task)
+        self.queue.put((time.time(), task))
+
+    def _count_busy_workers(self):
+        busy = 0
+        now = time.time()
+        self.logger.debug('No idle workers for task; checking if we need to make more workers')
+        for worker in self.workers:
+            if not hasattr(worker, 'thread_id'):
+                # Not initialized
+                continue
+            time_started, info = self.worker_tracker.get(worker.thread_id,
+                                                         (None, None))
+            if time_started is not None:
+                if now - time_started < self.hung_thread_limit:
+                    busy += 1
+        return busy
+
+    def supervisor_thread_callback(self):
+        """
+        The supervisor thread (see ``supervisor_period``) runs this:
+        every ``supervisor_period`` seconds it counts the hung workers,
+        and flags those hung too long for the next ``add_task()`` to
+        kill.
+        """
+        while not self._supervisor_stop.wait(self.supervisor_period):
+            try:
+                self.check_hung_workers()
+            except:
+                self.logger.exception('Error in thread pool supervisor')
+
+    def check_hung_workers(self):
+        """
+        Update the count of hung workers, and flag when any have been
+        hung too long (or dying ones may be zombies) so ``add_task()``
+        calls ``kill_hung_threads()``.
+        """
+        now = time.time()
+        hung = 0
+        kill = False
+        for time_started, info in list(self.worker_tracker.values()):
+            if now - time_started > self.hung_thread_limit:
+                hung += 1
+            if (self.kill_thread_limit
+                and now - time_started > self.kill_thread_limit):
+                kill = True
+        self._hung_count = hung
+        if kill or (self.max_zombie_threads_before_die
+                    and self.dying_threads):
+            self._kill_hung_due = True
 
     def track_threads(self):
         """
@@ -888,16 +1557,21 @@ class ThreadPool(object):
                                       % (thread_id, requests_processed, self.max_requests))
                     add_replacement_worker = True
                     break
-                runnable = self.queue.get()
-                if runnable is ThreadPool.SHUTDOWN:
+                item = self.queue.get()
+                if item is ThreadPool.SHUTDOWN:
                     self.logger.debug('Worker %s asked to SHUTDOWN', thread_id)
                     break
+                time_queued, runnable = item
                 try:
                     self.idle_workers.remove(thread_id)
                 except ValueError:
                     pass
-                self.worker_tracker[thread_id] = [time.time(), None]
+                now = time.time()
+                self.worker_tracker[thread_id] = [now, None]
+                if self.metrics is not None:
+                    self.metrics.task_started(now - time_queued)
                 requests_processed += 1
+                self.requests_processed[thread_id] = requests_processed
                 try:
                     try:
                         runnable()
@@ -937,6 +1611,7 @@ class ThreadPool(object):
                 del self.dying_threads[thread_id]
             except KeyError:
                 pass
+            self.requests_processed.pop(thread_id, None)
             if add_replacement_worker:
                 self.add_worker_thread(message='Voluntary replacement for thread %s' % thread_id)
 
@@ -945,6 +1620,7 @@ class ThreadPool(object):
         Shutdown the queue (after finishing any pending requests).
         """
         self.logger.info('Shutting down threadpool')
+        self._supervisor_stop.set()
         # Add a shutdown request for every worker
         for i in range(len(self.workers)):
             self.queue.put(ThreadPool.SHUTDOWN)
@@ -952,7 +1628,7 @@ class ThreadPool(object):
         hung_workers = []
         for worker in self.workers:
             worker.join(0.5)
-            if worker.isAlive():
+            if worker.is_alive():
                 hung_workers.append(worker)
         zombies = []
         for thread_id in self.dying_threads:
@@ -969,10 +1645,10 @@ class ThreadPool(object):
                 timed_out = False
                 need_force_quit = bool(zombies)
                 for worker in self.workers:
-                    if not timed_out and worker.isAlive():
+                    if not timed_out and worker.is_alive():
                         timed_out = True
                         worker.join(force_quit_timeout)
-                    if worker.isAlive():
+                    if worker.is_alive():
                         print("Worker %s won't die" % worker)
                         need_force_quit = True
                 if need_force_quit:
@@ -1062,6 +1738,7 @@ class ThreadPoolMixIn(object):
             % (self.server_name, self.server_port),
             daemon,
             **threadpool_options)
+        self.thread_pool.metrics = getattr(self, 'metrics', None)
 
     def process_request(self, request, client_address):
         """
@@ -1129,19 +1806,329 @@ class ThreadPoolMixIn(object):
         if hasattr(self, 'thread_pool'):
             self.thread_pool.shutdown(60)
 
+class _PrebufferedReader(object):
+    """
+    Read-only file over a socket which first returns the bytes the
+    event loop has already received for the connection.  Anything
+    still buffered once the request is done (e.g., a pipelined
+    request) can be taken back with ``take_buffer``.
+    """
+
+    recv_size = 65536
+
+    def __init__(self, sock, data=b''):
+        self._sock = sock
+        self._buffer = bytearray(data)
+        self.closed = False
+
+    def _fill(self):
+        data = self._sock.recv(self.recv_size)
+        self._buffer += data
+        return bool(data)
+
+    def read(self, size=-1):
+        buf = self._buffer
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            size = len(buf)
+        else:
+            while len(buf) < size and self._fill():
+                pass
+        data = bytes(buf[:size])
+        del buf[:size]
+        return data
+
+    def readline(self, size=-1):
+        buf = self._buffer
+        start = 0
+        while True:
+            pos = buf.find(b'\n', start)
+            if pos >= 0:
+                end = pos + 1
+                break
+            start = len(buf)
+            if 0 <= size <= start or not self._fill():
+                end = start
+                break
+        if 0 <= size < end:
+            end = size
+        data = bytes(buf[:end])
+        del buf[:end]
+        return data
+
+    def readlines(self, hint=None):
+        lines = []
+        total = 0
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+            if hint and total >= hint:
+                break
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+    __next__ = next
+
+    def take_buffer(self):
+        data = bytes(self._buffer)
+        del self._buffer[:]
+        return data
+
+    def close(self):
+        # The socket belongs to the connection, not to this file
+        self.closed = True
+
+class _LoopConnection(object):
+    """
+    An accepted socket owned by an ``EventLoopMixIn`` server.  This
+    is what request handlers get as their ``request``; ``makefile``
+    hands out a reader seeded with the bytes received so far, all
+    other attributes are those of the socket.
+    """
+
+    def __init__(self, sock, client_address):
+        self.socket = sock
+        self.client_address = client_address
+        self.buffer = b''
+        self.rfile = None
+        self.keep_alive = False
+        self.requests = 0
+        self.last_active = time.time()
+
+    def head_received(self):
+        buf = self.buffer
+        return b'\r\n\r\n' in buf or b'\n\n' in buf
+
+    def makefile(self, mode='r', bufsize=-1):
+        if 'r' in mode:
+            self.rfile = _PrebufferedReader(self.socket, self.buffer)
+            self.buffer = b''
+            return self.rfile
+        return self.socket.makefile(mode, bufsize)
+
+    def __getattr__(self, attr):
+        return getattr(self.socket, attr)
+
+class EventLoopMixIn(ThreadPoolMixIn):
+    """
+    Mix-in class where a single selector loop owns all connections,
+    and the thread pool only gets a connection once a complete request
+    head has arrived.  After the response the connection goes back to
+    the loop, so idle keep-alive connections don't tie up workers.
+
+    Connections idle in the loop for longer than ``keepalive_timeout``
+    seconds (or the server's ``wsgi_socket_timeout``, if set) are
+    closed.  Request heads larger than ``max_head_size`` are
+    dispatched as they are, for the handler to reject.
+    """
+
+    keepalive_timeout = 60
+    max_head_size = 65536
+    recv_size = 65536
+
+    def __init__(self, nworkers, daemon=False, **threadpool_options):
+        assert selectors is not None, (
+            "The event loop server needs the selectors module")
+        ThreadPoolMixIn.__init__(self, nworkers, daemon, **threadpool_options)
+        self._selector = selectors.DefaultSelector()
+        self._resumed = queue.Queue()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+
+    def serve_forever(self):
+        """
+        Run the event loop until the server is closed, then shut the
+        thread pool down cleanly.
+        """
+        selector = self._selector
+        self.socket.setblocking(False)
+        selector.register(self.socket, selectors.EVENT_READ)
+        selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        next_sweep = time.time() + 1
+        try:
+            while self.running:
+                for key, events in selector.select(1):
+                    if key.fileobj is self.socket:
+                        self._accept_connections()
+                    elif key.fileobj is self._wakeup_recv:
+                        self._drain_wakeup()
+                    else:
+                        self._read_connection(key.data)
+                self._register_resumed()
+                now = time.time()
+                if now >= next_sweep:
+                    self._close_idle_connections(now)
+                    next_sweep = now + 1
+        finally:
+            for key in list(selector.get_map().values()):
+                if key.data is not None:
+                    self.shutdown_request(key.fileobj)
+            selector.close()
+            self._wakeup_send.close()
+            self._wakeup_recv.close()
+            self.thread_pool.shutdown()
+
+    def _accept_connections(self):
+        while True:
+            try:
+                request, client_address = self.get_request()
+            except socket.error:
+                # Nothing left to accept (or the accept failed, in
+                # which case the client will have to retry)
+                return
+            if not self.verify_request(request, client_address):
+                self.shutdown_request(request)
+                continue
+            request.setblocking(False)
+            conn = _LoopConnection(request, client_address)
+            self._selector.register(request, selectors.EVENT_READ, conn)
+
+    def _read_connection(self, conn):
+        try:
+            data = conn.socket.recv(self.recv_size)
+        except socket.error as exce:
+            if exce.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b''
+        if not data:
+            self._selector.unregister(conn.socket)
+            self.shutdown_request(conn.socket)
+            return
+        conn.buffer += data
+        conn.last_active = time.time()
+        if conn.head_received() or len(conn.buffer) > self.max_head_size:
+            self._selector.unregister(conn.socket)
+            self._dispatch(conn)
+
+    def _dispatch(self, conn):
+        conn.socket.settimeout(self.wsgi_socket_timeout)
+        self.thread_pool.add_task(
+            lambda: self.process_connection_in_thread(conn))
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _register_resumed(self):
+        while True:
+            try:
+                conn = self._resumed.get_nowait()
+            except queue.Empty:
+                return
+            if self.running:
+                self._selector.register(
+                    conn.socket, selectors.EVENT_READ, conn)
+            else:
+                self.shutdown_request(conn.socket)
+
+    def _close_idle_connections(self, now):
+        timeout = self.wsgi_socket_timeout or self.keepalive_timeout
+        if not timeout:
+            return
+        for key in list(self._selector.get_map().values()):
+            conn = key.data
+            if conn is not None and now - conn.last_active > timeout:
+                self._selector.unregister(conn.socket)
+                self.shutdown_request(conn.socket)
+
+    def process_connection_in_thread(self, conn):
+        """
+        The worker thread calls back here to handle the request the
+        loop has received on ``conn``; the connection is then either
+        handed back to the loop or closed.
+        """
+        try:
+            self.finish_request(conn, conn.client_address)
+        except BaseException as e:
+            conn.keep_alive = False
+            self.handle_error(conn, conn.client_address)
+            if isinstance(e, (MemoryError, KeyboardInterrupt)):
+                self.shutdown_request(conn.socket)
+                raise
+        if conn.keep_alive and self.running:
+            self.resume_connection(conn)
+        else:
+            self.shutdown_request(conn.socket)
+
+    def resume_connection(self, conn):
+        """
+        Hand a connection back to the event loop, after its last
+        response has been sent.
+        """
+        if conn.rfile is not None:
+            conn.buffer = conn.rfile.take_buffer()
+            conn.rfile = None
+        conn.keep_alive = False
+        conn.last_active = time.time()
+        if conn.head_received():
+            # A pipelined request is already waiting
+            self._dispatch(conn)
+            return
+        conn.socket.setblocking(False)
+        self._resumed.put(conn)
+        self._wake_loop()
+
+    def _wake_loop(self):
+        try:
+            self._wakeup_send.send(b'x')
+        except socket.error:
+            # The loop already has a wakeup pending
+            pass
+
+    def server_close(self):
+        """
+        Stop the event loop, then finish pending requests and shutdown
+        the server.
+        """
+        self.running = False
+        self._wake_loop()
+        ThreadPoolMixIn.server_close(self)
+
 class WSGIServerBase(SecureHTTPServer):
+    # Set in the worker processes of a PreforkSupervisor
+    wsgi_multiprocess = False
+
     def __init__(self, wsgi_application, server_address,
                  RequestHandlerClass=None, ssl_context=None,
-                 request_queue_size=None):
+                 request_queue_size=None, reuse_port=False):
+        # Used by server_bind, which the base constructor calls
+        self.reuse_port = reuse_port
         SecureHTTPServer.__init__(self, server_address,
                                   RequestHandlerClass, ssl_context,
                                   request_queue_size=request_queue_size)
         self.wsgi_application = wsgi_application
         self.wsgi_socket_timeout = None
+        self.metrics = ServerMetrics()
+
+    def server_bind(self):
+        if self.reuse_port:
+            # Lets several processes listen on the same port, with the
+            # kernel spreading new connections between them.
+            assert hasattr(socket, 'SO_REUSEPORT'), (
+                "SO_REUSEPORT is not available on this platform")
+            self.socket.setsockopt(socket.SOL_SOCKET,
+                                   socket.SO_REUSEPORT, 1)
+        SecureHTTPServer.server_bind(self)
 
     def get_request(self):
         # If there is a socket_timeout, set it on the accepted
         (conn,info) = SecureHTTPServer.get_request(self)
+        self.metrics.connection_accepted()
         if self.wsgi_socket_timeout:
             conn.settimeout(self.wsgi_socket_timeout)
         return (conn, info)
@@ -1153,26 +2140,247 @@ class WSGIThreadPoolServer(ThreadPoolMixIn, WSGIServerBase):
     def __init__(self, wsgi_application, server_address,
                  RequestHandlerClass=None, ssl_context=None,
                  nworkers=10, daemon_threads=False,
-                 threadpool_options=None, request_queue_size=None):
+                 threadpool_options=None, request_queue_size=None,
+                 reuse_port=False):
         WSGIServerBase.__init__(self, wsgi_application, server_address,
                                 RequestHandlerClass, ssl_context,
-                                request_queue_size=request_queue_size)
+                                request_queue_size=request_queue_size,
+                                reuse_port=reuse_port)
         if threadpool_options is None:
             threadpool_options = {}
         ThreadPoolMixIn.__init__(self, nworkers, daemon_threads,
                                  **threadpool_options)
 
+class WSGIEventLoopServer(EventLoopMixIn, WSGIServerBase):
+    def __init__(self, wsgi_application, server_address,
+                 RequestHandlerClass=None, ssl_context=None,
+                 nworkers=10, daemon_threads=False,
+                 threadpool_options=None, request_queue_size=None,
+                 reuse_port=False):
+        assert not ssl_context, (
+            "The event loop server does not support SSL")
+        WSGIServerBase.__init__(self, wsgi_application, server_address,
+                                RequestHandlerClass, ssl_context,
+                                request_queue_size=request_queue_size,
+                                reuse_port=reuse_port)
+        if threadpool_options is None:
+            threadpool_options = {}
+        EventLoopMixIn.__init__(self, nworkers, daemon_threads,
+                                **threadpool_options)
+
 class ServerExit(SystemExit):
     """
     Raised to tell the server to really exit (SystemExit is normally
     caught)
     """
 
+class PreforkSupervisor(object):
+    """
+    Runs ``processes`` forked worker processes, each with its own
+    server listening on the same port (with ``SO_REUSEPORT``), so that
+    requests are spread over several interpreters.
+
+    ``make_server`` is called in each worker process to create its
+    server.  Workers that die are replaced.  ``SIGHUP`` replaces the
+    workers one at a time (a rolling restart), and ``SIGTERM`` or
+    ``SIGINT`` stops them all; a worker that gets ``SIGTERM`` stops
+    accepting connections and finishes the requests it has.
+    """
+
+    # Seconds between checks for dead workers and signals
+    poll_interval = 0.5
+    # Seconds a new worker gets to start listening before the worker
+    # it replaces is stopped, in a rolling restart
+    restart_interval = 1
+    # Seconds workers get to finish before they are killed
+    stop_timeout = 30
+
+    def __init__(self, make_server, processes, logger=None):
+        assert hasattr(os, 'fork'), (
+            "Pre-forking is not available on this platform")
+        self.make_server = make_server
+        self.processes = processes
+        if logger is None:
+            logger = logging.getLogger('paste.httpserver.PreforkSupervisor')
+        self.logger = logger
+        self.workers = {}
+        self.running = False
+        self.restart_requested = False
+
+    def serve_forever(self):
+        self.running = True
+        previous = {}
+        for signum, handler in [(signal.SIGTERM, self.handle_stop),
+                                (signal.SIGINT, self.handle_stop),
+                                (signal.SIGHUP, self.handle_restart)]:
+            previous[signum] = signal.signal(signum, handler)
+        try:
+            while len(self.workers) < self.processes:
+                self.spawn_worker()
+            while self.running:
+                self.reap_workers(replace=True)
+                if self.restart_requested:
+                    self.restart_requested = False
+                    self.restart_workers()
+                time.sleep(self.poll_interval)
+        finally:
+            self.stop_workers()
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+    def handle_stop(self, signum, frame):
+        self.running = False
+
+    def handle_restart(self, signum, frame):
+        self.restart_requested = True
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                self.run_worker()
+                status = 0
+            except:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        self.logger.info('Started worker process %s', pid)
+        self.workers[pid] = time.time()
+        return pid
+
+    def run_worker(self):
+        """
+        Runs in the forked worker process.
+        """
+        stopped = []
+        servers = []
+        def stop(signum, frame):
+            # The serve_forever loop notices this within a second
+            stopped.append(signum)
+            for server in servers:
+                server.running = False
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        server = self.make_server()
+        server.wsgi_multiprocess = True
+        servers.append(server)
+        if stopped:
+            # Stopped while the server was being made (which sets
+            # running)
+            server.running = False
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def reap_workers(self, replace=False):
+        """
+        Forgets workers that have exited, starting new ones in their
+        place if ``replace`` is true.  Returns the pids reaped.
+        """
+        reaped = []
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                break
+            if not pid:
+                break
+            if pid not in self.workers:
+                continue
+            del self.workers[pid]
+            reaped.append(pid)
+            if replace and self.running:
+                self.logger.warning(
+                    'Worker process %s exited with status %s; replacing it',
+                    pid, status)
+                self.spawn_worker()
+        return reaped
+
+    def signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def restart_workers(self):
+        """
+        Replaces each worker in turn: the new worker is started before
+        the old one is stopped, so there is always a worker listening.
+        """
+        for pid in list(self.workers):
+            if not self.running:
+                break
+            if pid not in self.workers:
+                continue
+            self.spawn_worker()
+            self._reap_for(self.restart_interval)
+            if pid not in self.workers:
+                # It exited meanwhile, and has been replaced
+                continue
+            self.signal_worker(pid, signal.SIGTERM)
+            # Stopping it on purpose, so don't replace it a second time
+            del self.workers[pid]
+            self._wait_for_pid(pid, self.stop_timeout, reap=True)
+
+    def _reap_for(self, seconds):
+        """
+        Waits ``seconds``, replacing workers that exit meanwhile.
+        """
+        end = time.time() + seconds
+        while True:
+            self.reap_workers(replace=True)
+            remaining = end - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, self.poll_interval))
+
+    def stop_workers(self):
+        pids = list(self.workers)
+        for pid in pids:
+            self.signal_worker(pid, signal.SIGTERM)
+        for pid in pids:
+            self._wait_for_pid(pid, self.stop_timeout)
+        self.workers.clear()
+
+    def _wait_for_pid(self, pid, timeout, reap=False):
+        """
+        Waits for the worker ``pid`` to exit, killing it after
+        ``timeout`` seconds.  With ``reap``, other workers that exit
+        meanwhile are replaced.
+        """
+        end = time.time() + timeout
+        while True:
+            if reap:
+                self.reap_workers(replace=True)
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                return
+            if done:
+                return
+            if time.time() >= end:
+                self.logger.warning(
+                    'Worker process %s did not stop after %s seconds; '
+                    'killing it', pid, timeout)
+                self.signal_worker(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                return
+            time.sleep(0.1)
+
 def serve(application, host=None, port=None, handler=None, ssl_pem=None,
           ssl_context=None, server_version=None, protocol_version=None,
           start_loop=True, daemon_threads=None, socket_timeout=None,
           use_threadpool=None, threadpool_workers=10,
-          threadpool_options=None, request_queue_size=5):
+          threadpool_options=None, request_queue_size=5,
+          use_event_loop=None, processes=None, reuse_port=None):
     """
     Serves your ``application`` over HTTP(S) via WSGI interface
 
@@ -1190,7 +2398,9 @@ def serve(application, host=None, port=None, handler=None, ssl_pem=None,
     ``handler``
 
         This is the HTTP request handler to use, it defaults to
-        ``WSGIHandler`` in this module.
+        ``WSGIHandler`` in this module.  ``FastWSGIHandler`` parses
+        requests with less overhead, at the cost of being stricter
+        about malformed request heads.
 
     ``ssl_pem``
 
@@ -1224,12 +2434,11 @@ def serve(application, host=None, port=None, handler=None, ssl_pem=None,
         This sets the protocol used by the server, by default
         ``HTTP/1.0``. There is some support for ``HTTP/1.1``, which
         defaults to nicer keep-alive connections.  This server supports
-        ``100 Continue``, but does not yet support HTTP/1.1 Chunked
-        Encoding. Hence, if you use HTTP/1.1, you're somewhat in error
-        since chunked coding is a mandatory requirement of a HTTP/1.1
-        server.  If you specify HTTP/1.1, every response *must* have a
-        ``Content-Length`` and you must be careful not to read past the
-        end of the socket.
+        ``100 Continue``, and responses to HTTP/1.1 clients that don't
+        have a ``Content-Length`` are sent with chunked encoding, so the
+        connection can be kept alive.  Chunked request bodies are not
+        supported, and you must be careful not to read past the end of
+        the socket.
 
     ``start_loop``
 
@@ -1274,6 +2483,35 @@ def serve(application, host=None, port=None, handler=None, ssl_pem=None,
         The 'backlog' argument to socket.listen(); specifies the
         maximum number of queued connections.
 
+    ``use_event_loop``
+
+        Keep all connections in a single event loop (using the
+        ``selectors`` module), and only hand a request to the thread
+        pool once its request line and headers have been received.
+        Idle keep-alive connections then cost no worker thread, so a
+        small pool can serve many more clients.  Idle connections are
+        closed after ``socket_timeout`` seconds (60 if not given).
+        This implies ``use_threadpool``, and does not support SSL.
+
+    ``processes``
+
+        Fork this many worker processes, each with its own server (and
+        thread pool) listening on the same port, so that requests are
+        not all served by one interpreter.  The calling process
+        supervises the workers: it replaces workers that die, replaces
+        them one at a time on ``SIGHUP``, and stops them on ``SIGTERM``
+        or ``SIGINT``.  This needs ``fork`` and ``SO_REUSEPORT`` (Linux,
+        the BSDs), and ``PreforkSupervisor`` is returned instead of a
+        server.  The application is shared by all the workers, so
+        anything it opens before the fork (like database connections)
+        should be opened lazily instead.
+
+    ``reuse_port``
+
+        Set ``SO_REUSEPORT`` on the listening socket, so other
+        processes can listen on the same port.  This is always set
+        when ``processes`` is given.
+
     """
     is_ssl = False
     if ssl_pem or ssl_context:
@@ -1307,25 +2545,51 @@ def serve(application, host=None, port=None, handler=None, ssl_pem=None,
 
     if use_threadpool is None:
         use_threadpool = True
-
-    if converters.asbool(use_threadpool):
-        server = WSGIThreadPoolServer(application, server_address, handler,
-                                      ssl_context, int(threadpool_workers),
-                                      daemon_threads,
-                                      threadpool_options=threadpool_options,
-                                      request_queue_size=request_queue_size)
+    processes = int(processes or 1)
+    reuse_port = converters.asbool(reuse_port) or processes > 1
+
+    def make_server():
+        if converters.asbool(use_event_loop):
+            server = WSGIEventLoopServer(
+                application, server_address, handler, ssl_context,
+                int(threadpool_workers), daemon_threads,
+                threadpool_options=threadpool_options,
+                request_queue_size=request_queue_size,
+                reuse_port=reuse_port)
+        elif converters.asbool(use_threadpool):
+            server = WSGIThreadPoolServer(
+                application, server_address, handler, ssl_context,
+                int(threadpool_workers), daemon_threads,
+                threadpool_options=threadpool_options,
+                request_queue_size=request_queue_size,
+                reuse_port=reuse_port)
+        else:
+            server = WSGIServer(application, server_address, handler,
+                                ssl_context,
+                                request_queue_size=request_queue_size,
+                                reuse_port=reuse_port)
+            if daemon_threads:
+                server.daemon_threads = daemon_threads
+        if socket_timeout:
+            server.wsgi_socket_timeout = int(socket_timeout)
+        return server
+
+    if processes > 1:
+        assert server_address[1], (
+            "A port must be given to serve from several processes")
+        assert converters.asbool(use_threadpool) or converters.asbool(
+            use_event_loop), "Pre-forking needs the thread pool"
+        server = PreforkSupervisor(make_server, processes)
     else:
-        server = WSGIServer(application, server_address, handler, ssl_context,
-                            request_queue_size=request_queue_size)
-        if daemon_threads:
-            server.daemon_threads = daemon_threads
-
-    if socket_timeout:
-        server.wsgi_socket_timeout = int(socket_timeout)
+        server = make_server()
 
     if converters.asbool(start_loop):
         protocol = is_ssl and 'https' or 'http'
-        host, port = server.server_address[:2]
+        if processes > 1:
+            host, port = server_address
+            print('starting %s worker processes' % processes)
+        else:
+            host, port = server.server_address[:2]
         if host == '0.0.0.0':
             print('serving on 0.0.0.0:%s view at %s://127.0.0.1:%s'
                   % (port, protocol, port))
@@ -1349,12 +2613,18 @@ def server_runner(wsgi_app, global_conf, **kwargs):
                  'threadpool_dying_limit', 'threadpool_spawn_if_under',
                  'threadpool_max_zombie_threads_before_die',
                  'threadpool_hung_check_period',
-                 'threadpool_max_requests', 'request_queue_size']:
+                 'threadpool_supervisor_period',
+                 'threadpool_max_requests', 'request_queue_size',
+                 'processes']:
         if name in kwargs:
             kwargs[name] = int(kwargs[name])
-    for name in ['use_threadpool', 'daemon_threads']:
+    for name in ['use_threadpool', 'daemon_threads', 'use_event_loop',
+                 'reuse_port']:
         if name in kwargs:
             kwargs[name] = asbool(kwargs[name])
+    if isinstance(kwargs.get('handler'), six.string_types):
+        from paste.util.import_string import eval_import
+        kwargs['handler'] = eval_import(kwargs['handler'])
     threadpool_options = {}
     for name, value in list(kwargs.items()):
         if name.startswith('threadpool_') and name != 'threadpool_workers':
@@ -1368,6 +2638,9 @@ def server_runner(wsgi_app, global_conf, **kwargs):
 
 server_runner.__doc__ = (serve.__doc__ or '') + """
 
+    In a configuration file ``handler`` is given as an import string,
+    like ``paste.httpserver:FastWSGIHandler``.
+
     You can also set these threadpool options:
 
     ``threadpool_max_requests``:
@@ -1417,6 +2690,13 @@ server_runner.__doc__ = (serve.__doc__ or '') + """
         or for zombie threads that should cause a restart.  Default 100
         requests.
 
+    ``threadpool_supervisor_period``:
+
+        Check for hung and zombie threads every X seconds in a separate
+        supervisor thread, instead of every ``threadpool_hung_check_period``
+        requests.  This keeps the cost of accepting a request constant
+        for big pools.  Default None (no supervisor thread).
+
     ``threadpool_logger``:
 
         Logging messages will go the logger named here.
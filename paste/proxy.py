@@ -29,6 +29,14 @@ TODO:
 
 """
 
+import errno
+import random
+import select
+import socket
+import sys
+import threading
+import time
+
 from six.moves import http_client as httplib
 from six.moves.urllib import parse as urlparse
 from six.moves.urllib.parse import quote
@@ -37,6 +45,9 @@ import six
 from paste import httpexceptions
 from paste.util.converters import aslist
 
+# Size of the pieces a streamed response is read in
+BLOCK_SIZE = 64 * 1024
+
 # Remove these headers from response (specify lower case header
 # names):
 filtered_headers = (
@@ -50,42 +61,463 @@ filtered_headers = (
     'upgrade',
 )
 
+# Requests with these methods can safely be sent again
+idempotent_methods = ('GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT', 'DELETE')
+
+class ConnectionPool(object):
+
+    """
+    A thread-safe pool of kept-alive connections to one host.
+
+    A connection is taken from the pool for each request, and put
+    back once the response has been read; up to ``max_idle`` idle
+    connections are kept, for at most ``idle_timeout`` seconds.
+    ``connect_timeout`` and ``read_timeout`` are in seconds (None
+    waits forever); the read timeout applies to each read.
+
+    ``stats()`` returns counts of connections created, reused and
+    discarded, and the connections now idle and in use.
+    """
+
+    idle_timeout = 30
+
+    def __init__(self, scheme, host, max_idle=10, connect_timeout=None,
+                 read_timeout=None):
+        if scheme == 'http':
+            self.connection_class = httplib.HTTPConnection
+        elif scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            raise ValueError("Unknown scheme %r" % scheme)
+        self.host = host
+        self.max_idle = max_idle
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.lock = threading.Lock()
+        self.idle = []
+        self.created = self.reused = self.discarded = self.in_use = 0
+
+    def get(self):
+        """
+        Returns ``(connection, reused)``.
+        """
+        now = time.time()
+        dropped = []
+        with self.lock:
+            self.in_use += 1
+            while self.idle:
+                conn, last_used = self.idle.pop()
+                if (now - last_used < self.idle_timeout
+                    and not _connection_dropped(conn)):
+                    self.reused += 1
+                    break
+                self.discarded += 1
+                dropped.append(conn)
+            else:
+                conn = None
+                self.created += 1
+        for old_conn in dropped:
+            old_conn.close()
+        if conn is not None:
+            return conn, True
+        conn = self.connection_class(self.host, timeout=self.connect_timeout)
+        try:
+            conn.connect()
+        except:
+            with self.lock:
+                self.in_use -= 1
+            raise
+        if self.read_timeout != self.connect_timeout:
+            conn.sock.settimeout(self.read_timeout)
+        return conn, False
+
+    def release(self, conn, reusable=True):
+        """
+        Puts a connection back in the pool, or closes it if it can't
+        be used again.
+        """
+        with self.lock:
+            self.in_use -= 1
+            if reusable and len(self.idle) < self.max_idle:
+                self.idle.append((conn, time.time()))
+                return
+            self.discarded += 1
+        conn.close()
+
+    def request(self, method, path, body, headers, connected=None):
+        """
+        Sends a request, returning ``(connection, response)``; give
+        the connection to ``release()`` once the response is read.  An
+        idempotent request is retried on a new connection if a reused
+        one fails (the server may have closed it).  ``connected`` is
+        called once there is a connection to send the request on.
+        """
+        while True:
+            conn, reused = self.get()
+            if connected is not None:
+                connected()
+            try:
+                conn.request(method, path, body, headers)
+                return conn, conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                self.release(conn, False)
+                if not reused or not _can_resend(method, body):
+                    raise
+
+    def stats(self):
+        with self.lock:
+            return {'created': self.created, 'reused': self.reused,
+                    'discarded': self.discarded, 'idle': len(self.idle),
+                    'in_use': self.in_use}
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, last_used in idle:
+            conn.close()
+
+def _connection_dropped(conn):
+    # An idle connection has nothing to read, unless the server has
+    # closed it (or sent something it shouldn't have)
+    if conn.sock is None:
+        return True
+    try:
+        if hasattr(select, 'poll'):
+            # select() can't take file descriptors over FD_SETSIZE
+            poller = select.poll()
+            poller.register(conn.sock, select.POLLIN)
+            return bool(poller.poll(0))
+        readable = select.select([conn.sock], [], [], 0)[0]
+    except (ValueError, select.error, socket.error):
+        return True
+    return bool(readable)
+
+class _InputReader(object):
+
+    """
+    Reads at most ``length`` bytes of ``wsgi.input``, so
+    ``httplib`` can send the request body as it is read.
+    """
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.length = self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+def _can_resend(method, body):
+    """
+    Returns true if a request that may have been (partly) sent can be
+    sent again: its method is idempotent, and its body hasn't been
+    partly read from ``wsgi.input``.
+    """
+    if method.upper() not in idempotent_methods:
+        return False
+    if isinstance(body, _InputReader):
+        return body.remaining == body.length
+    return True
+
+def _connection_reset(exc):
+    """
+    Returns true if ``exc`` means the host dropped the connection
+    (rather than, say, being slow to respond).
+    """
+    if isinstance(exc, httplib.BadStatusLine):
+        # Including RemoteDisconnected: closed without a response
+        return True
+    return getattr(exc, 'errno', None) in (
+        errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+class _PooledResponse(object):
+
+    """
+    Iterates over the body of a response as it arrives, then puts its
+    connection back in the pool (or closes it if the body wasn't all
+    read), and calls ``finished`` if given.
+    """
+
+    def __init__(self, pool, conn, res, block_size=None, finished=None):
+        self.pool = pool
+        self.conn = conn
+        self.res = res
+        self.block_size = block_size or BLOCK_SIZE
+        self.finished = finished
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.res.read(self.block_size)
+        if not data:
+            self.done = True
+            raise StopIteration
+        return data
+    __next__ = next
+
+    def close(self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        reusable = self.done and not self.res.will_close
+        self.res.close()
+        self.pool.release(conn, reusable)
+        if self.finished is not None:
+            self.finished()
+
+class Upstream(object):
+
+    """
+    One of the hosts a ``Balancer`` sends requests to.
+    """
+
+    def __init__(self, address, pool=None):
+        self.address = address
+        parsed = urlparse.urlsplit(address)
+        self.scheme = parsed[0].lower()
+        self.host = parsed[1]
+        self.path = parsed[2]
+        self.pool = pool
+        # Requests sent and not yet finished
+        self.outstanding = 0
+        # Connection errors since the last success
+        self.failures = 0
+        self.ejected_until = 0
+        # Set by the HealthChecker
+        self.healthy = True
+
+    def __repr__(self):
+        return '<%s %s outstanding=%s healthy=%s>' % (
+            self.__class__.__name__, self.address, self.outstanding,
+            self.healthy)
+
+class Balancer(object):
+
+    """
+    Spreads requests over several equivalent upstream hosts.
+
+    ``method`` is ``'least_outstanding'`` (the host with the fewest
+    unfinished requests) or ``'two_choices'`` (the less busy of two
+    hosts picked at random).  Slow hosts collect unfinished requests,
+    so they are given fewer new ones.
+
+    A host is left out for ``eject_time`` seconds after
+    ``max_failures`` connection errors in a row (failing to connect,
+    or having the connection reset; not timeouts), and while a
+    ``HealthChecker`` finds it unhealthy.  If every host is left out
+    they are all used anyway.
+    """
+
+    max_failures = 2
+    eject_time = 10
+
+    def __init__(self, addresses, method='least_outstanding', pool_size=None,
+                 connect_timeout=None, read_timeout=None):
+        if method not in ('least_outstanding', 'two_choices'):
+            raise ValueError("Unknown balancing method %r" % method)
+        self.method = method
+        self.upstreams = []
+        for address in addresses:
+            upstream = Upstream(address)
+            if pool_size:
+                upstream.pool = ConnectionPool(
+                    upstream.scheme, upstream.host, max_idle=pool_size,
+                    connect_timeout=connect_timeout,
+                    read_timeout=read_timeout)
+            self.upstreams.append(upstream)
+        if not self.upstreams:
+            raise ValueError("No upstream addresses given")
+        self.lock = threading.Lock()
+        self.health_checker = None
+
+    def choose(self, exclude=()):
+        """
+        Returns an upstream for a request, which must be given to
+        ``release()`` when the request is finished; returns None if
+        every upstream is in ``exclude``.
+        """
+        now = time.time()
+        with self.lock:
+            candidates = [u for u in self.upstreams if u not in exclude]
+            if not candidates:
+                return None
+            available = [u for u in candidates
+                         if u.healthy and u.ejected_until <= now]
+            if available:
+                candidates = available
+            if self.method == 'two_choices' and len(candidates) > 2:
+                candidates = random.sample(candidates, 2)
+            upstream = min(candidates,
+                           key=lambda u: (u.outstanding, random.random()))
+            upstream.outstanding += 1
+        return upstream
+
+    def release(self, upstream):
+        with self.lock:
+            upstream.outstanding -= 1
+
+    def failed(self, upstream):
+        """
+        Records a connection error.
+        """
+        with self.lock:
+            upstream.failures += 1
+            if upstream.failures >= self.max_failures:
+                upstream.ejected_until = time.time() + self.eject_time
+
+    def succeeded(self, upstream):
+        if upstream.failures:
+            with self.lock:
+                upstream.failures = 0
+                upstream.ejected_until = 0
+
+    def start_health_checks(self, path='/', interval=10, timeout=5):
+        self.health_checker = HealthChecker(
+            self, path=path, interval=interval, timeout=timeout)
+        self.health_checker.start()
+        return self.health_checker
+
+    def stop_health_checks(self):
+        if self.health_checker is not None:
+            self.health_checker.stop()
+            self.health_checker = None
+
+class HealthChecker(threading.Thread):
+
+    """
+    Requests ``path`` from each of a ``Balancer``'s upstreams every
+    ``interval`` seconds, marking those that don't respond (or respond
+    with a 5xx error) unhealthy until they pass again.
+    """
+
+    def __init__(self, balancer, path='/', interval=10, timeout=5):
+        threading.Thread.__init__(self, name='paste.proxy.HealthChecker')
+        self.daemon = True
+        self.balancer = balancer
+        self.path = path
+        self.interval = interval
+        self.timeout = timeout
+        self.stopped = threading.Event()
+
+    def check(self, upstream):
+        """
+        Returns true if ``upstream`` is healthy.
+        """
+        if upstream.scheme == 'https':
+            ConnClass = httplib.HTTPSConnection
+        else:
+            ConnClass = httplib.HTTPConnection
+        conn = ConnClass(upstream.host, timeout=self.timeout)
+        try:
+            conn.request('GET', self.path, headers={'host': upstream.host})
+            res = conn.getresponse()
+            res.read()
+            return res.status < 500
+        except (socket.error, httplib.HTTPException):
+            return False
+        finally:
+            conn.close()
+
+    def check_all(self):
+        for upstream in self.balancer.upstreams:
+            healthy = self.check(upstream)
+            upstream.healthy = healthy
+            if healthy:
+                self.balancer.succeeded(upstream)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.check_all()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
 class Proxy(object):
 
+    """
+    Proxies requests to ``address``.
+
+    By default each request gets a new connection, and the request and
+    response bodies are read into memory.  With ``pool_size`` up to
+    that many kept-alive connections are kept for reuse (see
+    ``ConnectionPool``, in ``self.pool``), the request body is sent as
+    it is read and the response is passed on as it arrives.
+    ``connect_timeout`` and ``read_timeout`` are in seconds.
+
+    ``address`` may also be a list of equivalent addresses, shared by
+    a ``Balancer`` (in ``self.balancer``) using the ``balance``
+    method.  A request that can't connect to one is retried on
+    another; one that fails after connecting is only retried if its
+    method is idempotent and its body can be sent again.  With ``health_check_path`` a
+    ``HealthChecker`` requests that path from each address every
+    ``health_check_interval`` seconds.
+    """
+
     def __init__(self, address, allowed_request_methods=(),
-                 suppress_http_headers=()):
+                 suppress_http_headers=(), pool_size=None,
+                 connect_timeout=None, read_timeout=None,
+                 balance='least_outstanding', health_check_path=None,
+                 health_check_interval=10):
         self.address = address
-        self.parsed = urlparse.urlsplit(address)
-        self.scheme = self.parsed[0].lower()
-        self.host = self.parsed[1]
-        self.path = self.parsed[2]
+        if isinstance(address, (list, tuple)):
+            self.balancer = Balancer(
+                address, method=balance, pool_size=pool_size,
+                connect_timeout=connect_timeout, read_timeout=read_timeout)
+            if health_check_path:
+                self.balancer.start_health_checks(
+                    health_check_path, interval=health_check_interval,
+                    timeout=connect_timeout or 5)
+            self.parsed = self.scheme = self.host = self.path = None
+            pool_size = None
+        else:
+            self.balancer = None
+            self.parsed = urlparse.urlsplit(address)
+            self.scheme = self.parsed[0].lower()
+            self.host = self.parsed[1]
+            self.path = self.parsed[2]
         self.allowed_request_methods = [
             x.lower() for x in allowed_request_methods if x]
 
         self.suppress_http_headers = [
             x.lower() for x in suppress_http_headers if x]
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        if pool_size:
+            self.pool = ConnectionPool(
+                self.scheme, self.host, max_idle=pool_size,
+                connect_timeout=connect_timeout, read_timeout=read_timeout)
+        else:
+            self.pool = None
 
     def __call__(self, environ, start_response):
         if (self.allowed_request_methods and
             environ['REQUEST_METHOD'].lower() not in self.allowed_request_methods):
             return httpexceptions.HTTPBadRequest("Disallowed")(environ, start_response)
 
-        if self.scheme == 'http':
-            ConnClass = httplib.HTTPConnection
-        elif self.scheme == 'https':
-            ConnClass = httplib.HTTPSConnection
-        else:
-            raise ValueError(
-                "Unknown scheme for %r: %r" % (self.address, self.scheme))
-        conn = ConnClass(self.host)
+        streaming = self.pool is not None or (
+            self.balancer is not None
+            and self.balancer.upstreams[0].pool is not None)
         headers = {}
         for key, value in environ.items():
             if key.startswith('HTTP_'):
                 key = key[5:].lower().replace('_', '-')
                 if key == 'host' or key in self.suppress_http_headers:
                     continue
+                if streaming and key in filtered_headers:
+                    # Hop-by-hop headers (like Connection: close) are
+                    # about the client's connection, not ours
+                    continue
                 headers[key] = value
-        headers['host'] = self.host
         if 'REMOTE_ADDR' in environ:
             headers['x-forwarded-for'] = environ['REMOTE_ADDR']
         if environ.get('CONTENT_TYPE'):
@@ -98,41 +530,109 @@ class Proxy(object):
             else:
                 headers['content-length'] = environ['CONTENT_LENGTH']
                 length = int(environ['CONTENT_LENGTH'])
-                body = environ['wsgi.input'].read(length)
+                if streaming:
+                    body = _InputReader(environ['wsgi.input'], length)
+                else:
+                    body = environ['wsgi.input'].read(length)
         else:
             body = ''
 
+        if self.balancer is None:
+            return self.send_request(self, environ, start_response,
+                                     headers, body)
+        balancer = self.balancer
+        tried = []
+        while True:
+            upstream = balancer.choose(exclude=tried)
+            tried.append(upstream)
+            connected = []
+            try:
+                app_iter = self.send_request(
+                    upstream, environ, start_response, headers, body,
+                    finished=lambda upstream=upstream: balancer.release(upstream),
+                    connected=lambda: connected.append(True))
+            except (socket.error, httplib.HTTPException):
+                exc_info = sys.exc_info()
+                balancer.release(upstream)
+                if not connected or _connection_reset(exc_info[1]):
+                    balancer.failed(upstream)
+                if (len(tried) == len(balancer.upstreams)
+                    or (connected and not _can_resend(
+                        environ['REQUEST_METHOD'], body))):
+                    six.reraise(*exc_info)
+                continue
+            balancer.succeeded(upstream)
+            if upstream.pool is None:
+                balancer.release(upstream)
+            return app_iter
+
+    def send_request(self, target, environ, start_response, headers, body,
+                     finished=None, connected=None):
+        """
+        Sends the request to ``target`` (this proxy, or one of its
+        balancer's upstreams), with the ``scheme``, ``host``, ``path``
+        and ``pool`` it gives.  ``connected`` is called once connected,
+        before anything is sent.
+        """
+        if target.scheme == 'http':
+            ConnClass = httplib.HTTPConnection
+        elif target.scheme == 'https':
+            ConnClass = httplib.HTTPSConnection
+        else:
+            raise ValueError(
+                "Unknown scheme for %r: %r" % (target.address, target.scheme))
+        headers['host'] = target.host
         path_info = quote(environ['PATH_INFO'])
-        if self.path:
+        if target.path:
             request_path = path_info
             if request_path and request_path[0] == '/':
                 request_path = request_path[1:]
 
-            path = urlparse.urljoin(self.path, request_path)
+            path = urlparse.urljoin(target.path, request_path)
         else:
             path = path_info
         if environ.get('QUERY_STRING'):
             path += '?' + environ['QUERY_STRING']
 
-        conn.request(environ['REQUEST_METHOD'],
-                     path,
-                     body, headers)
-        res = conn.getresponse()
+        if target.pool is not None:
+            conn, res = target.pool.request(environ['REQUEST_METHOD'],
+                                            path, body, headers,
+                                            connected=connected)
+            status = '%s %s' % (res.status, res.reason)
+            start_response(status, parse_headers(res.msg))
+            return _PooledResponse(target.pool, conn, res,
+                                   finished=finished)
+
+        conn = ConnClass(target.host, timeout=self.connect_timeout)
+        try:
+            conn.connect()
+            if connected is not None:
+                connected()
+            if self.read_timeout != self.connect_timeout:
+                conn.sock.settimeout(self.read_timeout)
+            conn.request(environ['REQUEST_METHOD'],
+                         path,
+                         body, headers)
+            res = conn.getresponse()
+            # @@: Default?
+            length = res.getheader('content-length')
+            if length is not None:
+                body = res.read(int(length))
+            else:
+                body = res.read()
+        finally:
+            conn.close()
         headers_out = parse_headers(res.msg)
 
         status = '%s %s' % (res.status, res.reason)
         start_response(status, headers_out)
-        # @@: Default?
-        length = res.getheader('content-length')
-        if length is not None:
-            body = res.read(int(length))
-        else:
-            body = res.read()
-        conn.close()
         return [body]
 
 def make_proxy(global_conf, address, allowed_request_methods="",
-               suppress_http_headers=""):
+               suppress_http_headers="", pool_size=None,
+               connect_timeout=None, read_timeout=None,
+               balance='least_outstanding', health_check_path=None,
+               health_check_interval=10):
     """
     Make a WSGI application that proxies to another address:
 
@@ -146,13 +646,45 @@ def make_proxy(global_conf, address, allowed_request_methods="",
         a space seperated list of http headers (lower case, without
         the leading ``http_``) that should not be passed on to target
         host
+
+    ``pool_size``
+        keep up to this many connections to the target host open, and
+        stream request and response bodies instead of reading them
+        into memory
+
+    ``connect_timeout``, ``read_timeout``
+        seconds to wait for a connection to the target host, and for
+        each read from it
+
+    ``address`` may be several (whitespace-separated) equivalent
+    addresses, to spread requests over:
+
+    ``balance``
+        ``least_outstanding`` (the default) or ``two_choices``
+
+    ``health_check_path``, ``health_check_interval``
+        request this path from each address every so many seconds,
+        and leave out the addresses that fail
     """
+    addresses = aslist(address)
+    if len(addresses) > 1:
+        address = addresses
     allowed_request_methods = aslist(allowed_request_methods)
     suppress_http_headers = aslist(suppress_http_headers)
+    if pool_size:
+        pool_size = int(pool_size)
+    if connect_timeout:
+        connect_timeout = float(connect_timeout)
+    if read_timeout:
+        read_timeout = float(read_timeout)
     return Proxy(
         address,
         allowed_request_methods=allowed_request_methods,
-        suppress_http_headers=suppress_http_headers)
+        suppress_http_headers=suppress_http_headers,
+        pool_size=pool_size, connect_timeout=connect_timeout,
+        read_timeout=read_timeout, balance=balance,
+        health_check_path=health_check_path,
+        health_check_interval=float(health_check_interval))
 
 
 class TransparentProxy(object):
@@ -168,13 +700,20 @@ class TransparentProxy(object):
     If you specify ``force_host`` (and optionally ``force_scheme``)
     then HTTP_HOST won't be used to determine where to connect to;
     instead a specific host will be connected to, but the ``Host``
-    header in the request will remain intact.
+    header in the request will remain intact.  ``force_host`` may be a
+    list of hosts, shared by a ``Balancer`` (in ``self.balancer``).
     """
 
     def __init__(self, force_host=None,
-                 force_scheme='http'):
+                 force_scheme='http', balance='least_outstanding'):
         self.force_host = force_host
         self.force_scheme = force_scheme
+        if isinstance(force_host, (list, tuple)):
+            self.balancer = Balancer(
+                ['%s://%s' % (force_scheme, host) for host in force_host],
+                method=balance)
+        else:
+            self.balancer = None
 
     def __repr__(self):
         return '<%s %s force_host=%r force_scheme=%r>' % (
@@ -199,11 +738,43 @@ class TransparentProxy(object):
             raise ValueError(
                 "WSGI environ must contain an HTTP_HOST key")
         host = environ['HTTP_HOST']
-        if self.force_host is None:
-            conn_host = host
+        if self.balancer is not None:
+            conn, upstream = self.connect_upstream(ConnClass)
         else:
-            conn_host = self.force_host
-        conn = ConnClass(conn_host)
+            upstream = None
+            if self.force_host is None:
+                conn_host = host
+            else:
+                conn_host = self.force_host
+            conn = ConnClass(conn_host)
+        try:
+            return self.send_request(conn, host, environ, start_response)
+        finally:
+            if upstream is not None:
+                self.balancer.release(upstream)
+
+    def connect_upstream(self, ConnClass):
+        """
+        Connects to one of the balancer's upstreams, trying the others
+        if it fails; returns ``(connection, upstream)``.
+        """
+        tried = []
+        while True:
+            upstream = self.balancer.choose(exclude=tried)
+            tried.append(upstream)
+            conn = ConnClass(upstream.host)
+            try:
+                conn.connect()
+            except socket.error:
+                self.balancer.release(upstream)
+                self.balancer.failed(upstream)
+                if len(tried) == len(self.balancer.upstreams):
+                    raise
+                continue
+            self.balancer.succeeded(upstream)
+            return conn, upstream
+
+    def send_request(self, conn, host, environ, start_response):
         headers = {}
         for key, value in environ.items():
             if key.startswith('HTTP_'):
@@ -280,10 +851,17 @@ def parse_headers(message):
     return headers_out
 
 def make_transparent_proxy(
-    global_conf, force_host=None, force_scheme='http'):
+    global_conf, force_host=None, force_scheme='http',
+    balance='least_outstanding'):
     """
     Create a proxy that connects to a specific host, but does
     absolutely no other filtering, including the Host header.
+    ``force_host`` may be several (whitespace-separated) hosts to
+    spread requests over.
     """
+    if force_host:
+        hosts = aslist(force_host)
+        if len(hosts) > 1:
+            force_host = hosts
     return TransparentProxy(force_host=force_host,
-                            force_scheme=force_scheme)
+                            force_scheme=force_scheme, balance=balance)
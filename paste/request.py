@@ -17,7 +17,11 @@ environment to solve common requirements.
    * resolve_relative_url(url, environ)
 
 """
-import cgi
+try:
+    import cgi
+except ImportError:
+    # Removed in Python 3.13
+    cgi = None
 from six.moves.urllib import parse as urlparse
 from six.moves.urllib.parse import quote, parse_qsl
 try:
@@ -33,7 +37,8 @@ except ImportError:
     from collections.abc import MutableMapping as DictMixin
 import six
 
-from paste.util.multidict import MultiDict
+from paste.util.formparser import UploadedFile, parse_form
+from paste.util.multidict import IndexedMultiDict
 
 __all__ = ['get_cookies', 'get_cookie_dict', 'parse_querystring',
            'parse_formvars', 'construct_url', 'path_info_split',
@@ -129,28 +134,35 @@ def parse_dict_querystring(environ):
     """
     source = environ.get('QUERY_STRING', '')
     if not source:
-        return MultiDict()
+        return IndexedMultiDict()
     if 'paste.parsed_dict_querystring' in environ:
         parsed, check_source = environ['paste.parsed_dict_querystring']
         if check_source == source:
             return parsed
     parsed = parse_qsl(source, keep_blank_values=True,
                        strict_parsing=False)
-    multi = MultiDict(parsed)
+    multi = IndexedMultiDict(parsed)
     environ['paste.parsed_dict_querystring'] = (multi, source)
     return multi
 
-def parse_formvars(environ, include_get_vars=True, encoding=None, errors=None):
+def parse_formvars(environ, include_get_vars=True, encoding=None, errors=None,
+                   max_parts=None, max_field_size=None, max_size=None,
+                   spool_size=None):
     """Parses the request, returning a MultiDict of form variables.
 
     If ``include_get_vars`` is true then GET (query string) variables
     will also be folded into the MultiDict.
 
     All values should be strings, except for file uploads which are
-    left as ``FieldStorage`` instances.
+    left as ``UploadedFile`` (a ``cgi.FieldStorage`` subclass, where
+    that module exists) instances.
 
     If the request was not a normal form request (e.g., a POST with an
     XML body) then ``environ['wsgi.input']`` won't be read.
+
+    ``max_parts``, ``max_field_size``, ``max_size`` and ``spool_size``
+    override the limits in ``paste.util.formparser``; a ``FormError``
+    (a ``ValueError``) is raised if the body goes over them.
     """
     source = environ['wsgi.input']
     if 'paste.parsed_formvars' in environ:
@@ -159,42 +171,29 @@ def parse_formvars(environ, include_get_vars=True, encoding=None, errors=None):
             if include_get_vars:
                 parsed.update(parse_querystring(environ))
             return parsed
-    # @@: Shouldn't bother FieldStorage parsing during GET/HEAD and
-    # fake_out_cgi requests
-    formvars = MultiDict()
-    ct = environ.get('CONTENT_TYPE', '').partition(';')[0].lower()
-    use_cgi = ct in ('', 'application/x-www-form-urlencoded',
-                                'multipart/form-data')
-    # FieldStorage assumes a default CONTENT_LENGTH of -1, but a
-    # default of 0 is better:
+    formvars = IndexedMultiDict()
+    content_type = environ.get('CONTENT_TYPE', '')
+    method = environ.get('REQUEST_METHOD', 'GET')
+    if 'CONTENT_TYPE' not in environ and method == 'POST':
+        content_type = 'application/x-www-form-urlencoded'
+    # A default CONTENT_LENGTH of 0 is better than reading to the end:
     if not environ.get('CONTENT_LENGTH'):
         environ['CONTENT_LENGTH'] = '0'
-    if use_cgi:
-        # Prevent FieldStorage from parsing QUERY_STRING during GET/HEAD
-        # requests
-        old_query_string = environ.get('QUERY_STRING','')
-        environ['QUERY_STRING'] = ''
-        inp = environ['wsgi.input']
-        kwparms = {}
-        if six.PY3:
-            if encoding:
-                kwparms['encoding'] = encoding
-            if errors:
-                kwparms['errors'] = errors
-        fs = cgi.FieldStorage(fp=inp,
-                              environ=environ,
-                              keep_blank_values=True,
-                              **kwparms)
-        environ['QUERY_STRING'] = old_query_string
-        if isinstance(fs.value, list):
-            for name in fs.keys():
-                values = fs[name]
-                if not isinstance(values, list):
-                    values = [values]
-                for value in values:
-                    if not value.filename:
-                        value = value.value
-                    formvars.add(name, value)
+    try:
+        content_length = int(environ['CONTENT_LENGTH'])
+    except ValueError:
+        # Ignored, as cgi.FieldStorage did
+        content_length = 0
+    if method not in ('GET', 'HEAD'):
+        fields = parse_form(
+            source, content_type, content_length,
+            encoding=encoding, errors=errors, max_parts=max_parts,
+            max_field_size=max_field_size, max_size=max_size,
+            spool_size=spool_size)
+        for name, value in fields:
+            if isinstance(value, UploadedFile) and not value.filename:
+                value = value.value
+            formvars.add(name, value)
     environ['paste.parsed_formvars'] = (formvars, source)
     if include_get_vars:
         formvars.update(parse_querystring(environ))
@@ -410,7 +409,8 @@ def _cgi_FieldStorage__repr__patch(self):
     return "FieldStorage(%r, %r, %r)" % (
              self.name, self.filename, self.value)
 
-cgi.FieldStorage.__repr__ = _cgi_FieldStorage__repr__patch
+if cgi is not None:
+    cgi.FieldStorage.__repr__ = _cgi_FieldStorage__repr__patch
 
 if __name__ == '__main__':
     import doctest
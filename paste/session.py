@@ -11,16 +11,23 @@ Use like:
     environ['paste.session.factory']()
 
 This will return a dictionary.  The contents of this dictionary will
-be saved to disk when the request is completed.  The session will be
-created when you first fetch the session dictionary, and a cookie will
-be sent in that case.  There's current no way to use sessions without
-cookies, and there's no way to delete a session except to clear its
-data.
+be saved to disk when the request is completed, if they were changed.
+Changes to mutable values in the dictionary aren't noticed; call its
+``changed()`` method after making them.  With ``touch=True`` an
+unchanged session's expiration is still pushed back on each request.
+The session will be created when you first fetch the session
+dictionary, and a cookie will be sent in that case.  There's current
+no way to use sessions without cookies, and there's no way to delete a
+session except to clear its data.
+
+Sessions can also be kept in a ``SessionStore``, by passing
+``store=...`` to ``SessionMiddleware``: ``ShardedFileStore`` (files
+spread over many directories), ``SQLiteStore`` or ``MemoryStore``
+(a bounded, in-process store).  These only save a session that has
+changed, and remove sessions that have expired.
 
 @@: This doesn't do any locking, and may cause problems when a single
-session is accessed concurrently.  Also, it loads and saves the
-session for each request, with no caching.  Also, sessions aren't
-expired.
+session is accessed concurrently.
 """
 
 try:
@@ -32,10 +39,12 @@ except ImportError:
 import time
 import random
 import os
+import re
 import datetime
 import six
 import threading
 import tempfile
+from collections import OrderedDict
 
 try:
     import cPickle
@@ -45,8 +54,13 @@ try:
     from hashlib import md5
 except ImportError:
     from md5 import md5
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 from paste import wsgilib
 from paste import request
+from paste.util.converters import asbool
 
 class SessionMiddleware(object):
 
@@ -84,10 +98,16 @@ class SessionMiddleware(object):
 
 class SessionFactory(object):
 
+    """
+    Loads or creates the session for a request.  Sessions are kept by
+    ``session_class`` (``FileSession`` by default), or in ``store``
+    (a ``SessionStore``) if given.
+    """
 
     def __init__(self, environ, cookie_name='_SID_',
                  session_class=None,
                  session_expiration=60*12, # in minutes
+                 store=None,
                  **session_class_kw):
 
         self.created = False
@@ -95,6 +115,9 @@ class SessionFactory(object):
         self.environ = environ
         self.cookie_name = cookie_name
         self.session = None
+        if store is not None:
+            session_class = session_class or StoreSession
+            session_class_kw['store'] = store
         self.session_class = session_class or FileSession
         self.session_class_kw = session_class_kw
 
@@ -178,15 +201,74 @@ class SessionFactory(object):
             self.session.close()
 
 
+class SessionDict(dict):
+
+    """
+    A session's data: a dictionary that notes when it is changed, so
+    that unchanged sessions needn't be saved.  Changes to mutable
+    values inside it aren't noticed; call ``changed()`` after making
+    them.
+    """
+
+    modified = False
+
+    def changed(self):
+        self.modified = True
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.modified = True
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.modified = True
+
+    def clear(self):
+        if self:
+            self.modified = True
+        dict.clear(self)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.modified = True
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self.modified = True
+        return item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.modified = True
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kw):
+        dict.update(self, *args, **kw)
+        self.modified = True
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
 last_cleanup = None
 cleaning_up = False
 cleanup_cycle = datetime.timedelta(seconds=15*60) #15 min
 
 class FileSession(object):
 
+    """
+    A session pickled to a file named after its sid.  The file is only
+    written when the session has changed, by renaming a new file over
+    it; with ``touch`` its modification time is updated otherwise.
+    Sessions are removed ``expiration`` minutes after they were last
+    written (or touched).
+    """
+
     def __init__(self, sid, create=False, session_file_path=tempfile.gettempdir(),
                  chmod=None,
                  expiration=2880, # in minutes: 48 hours
+                 touch=False,
                  ):
         if chmod and isinstance(chmod, (six.binary_type, six.text_type)):
             chmod = int(chmod, 8)
@@ -202,6 +284,7 @@ class FileSession(object):
         self._data = None
 
         self.expiration = expiration
+        self.touch = touch
 
 
     def filename(self):
@@ -212,25 +295,40 @@ class FileSession(object):
             return self._data
         if os.path.exists(self.filename()):
             f = open(self.filename(), 'rb')
-            self._data = cPickle.load(f)
+            self._data = SessionDict(cPickle.load(f))
             f.close()
         else:
-            self._data = {}
+            self._data = SessionDict()
         return self._data
 
     def close(self):
-        if self._data is not None:
-            filename = self.filename()
-            exists = os.path.exists(filename)
-            if not self._data:
-                if exists:
-                    os.unlink(filename)
-            else:
-                f = open(filename, 'wb')
-                cPickle.dump(self._data, f)
+        if self._data is None:
+            return
+        filename = self.filename()
+        if not self._data.modified:
+            if self.touch and self._data:
+                try:
+                    os.utime(filename, None)
+                except OSError:
+                    pass
+            return
+        if not self._data:
+            if os.path.exists(filename):
+                os.unlink(filename)
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.session_file_path, prefix='.tmp')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump(dict(self._data), f)
+            finally:
                 f.close()
-                if not exists and self.chmod:
-                    os.chmod(filename, self.chmod)
+            if self.chmod:
+                os.chmod(tmp, self.chmod)
+            _rename(tmp, filename)
+        except:
+            os.unlink(tmp)
+            raise
 
     def _clean_up(self):
         global cleaning_up
@@ -263,7 +361,14 @@ class FileSession(object):
             return
 
         if sess_time + exp_time < now:
-            os.remove(os.path.join(self.session_file_path, f))
+            filename = os.path.join(self.session_file_path, f)
+            try:
+                mtime = datetime.datetime.fromtimestamp(
+                    os.path.getmtime(filename))
+            except OSError:
+                return
+            if mtime + exp_time < now:
+                os.remove(filename)
 
     def clean_up(self):
         global last_cleanup, cleanup_cycle, cleaning_up
@@ -286,6 +391,338 @@ class FileSession(object):
                     cleaning_up = False
                     raise
 
+_sid_re = re.compile(r'^[A-Za-z0-9_-]+$')
+
+class SessionStore(object):
+
+    """
+    Somewhere ``StoreSession`` keeps sessions, as pickled strings.
+
+    Subclasses implement ``load``, ``save``, ``delete`` and
+    ``clean_up``.  Sessions expire ``expiration`` minutes after they
+    were last saved; ``maybe_clean_up()`` runs ``clean_up()`` in a
+    thread at most every ``cleanup_interval`` seconds.
+    """
+
+    cleanup_interval = 15*60
+
+    def __init__(self, expiration=2880):
+        self.expiration = expiration
+        self.last_cleanup = 0
+        self.cleaning_up = False
+        self.cleanup_lock = threading.Lock()
+
+    def load(self, sid):
+        """
+        Returns the pickled session, or None if there isn't one (or it
+        has expired).
+        """
+        raise NotImplementedError
+
+    def save(self, sid, pickled):
+        raise NotImplementedError
+
+    def delete(self, sid):
+        raise NotImplementedError
+
+    def touch(self, sid):
+        """
+        Restarts a session's expiration; subclasses can do this without
+        saving it again.
+        """
+        pickled = self.load(sid)
+        if pickled is not None:
+            self.save(sid, pickled)
+
+    def clean_up(self):
+        """
+        Removes expired sessions.
+        """
+        raise NotImplementedError
+
+    def maybe_clean_up(self):
+        now = time.time()
+        with self.cleanup_lock:
+            if (self.cleaning_up
+                or now - self.last_cleanup < self.cleanup_interval):
+                return
+            self.cleaning_up = True
+            self.last_cleanup = now
+        t = threading.Thread(target=self._clean_up)
+        t.daemon = True
+        t.start()
+
+    def _clean_up(self):
+        try:
+            self.clean_up()
+        finally:
+            self.cleaning_up = False
+
+class ShardedFileStore(SessionStore):
+
+    """
+    Keeps each session in a file under ``path``, spread over
+    ``256**levels`` directories by a hash of the session id, so that
+    no directory gets too big.  Files are replaced by renaming, so a
+    session is never read half-written.
+
+    The file's modification time is when the session was saved.
+    Each ``clean_up()`` only looks through ``cleanup_shards`` of the
+    top-level directories, taking the next ones each time.
+    """
+
+    cleanup_shards = 16
+
+    def __init__(self, path, expiration=2880, levels=2, chmod=None):
+        SessionStore.__init__(self, expiration)
+        if chmod and isinstance(chmod, (six.binary_type, six.text_type)):
+            chmod = int(chmod, 8)
+        self.path = path
+        self.levels = levels
+        self.chmod = chmod
+        self.next_shard = 0
+
+    def filename(self, sid):
+        digest = md5(sid.encode('utf8')).hexdigest()
+        parts = [digest[i*2:i*2+2] for i in range(self.levels)]
+        return os.path.join(self.path, *(parts + [sid]))
+
+    def load(self, sid):
+        filename = self.filename(sid)
+        try:
+            f = open(filename, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            if (os.fstat(f.fileno()).st_mtime + self.expiration*60
+                < time.time()):
+                return None
+            return f.read()
+        finally:
+            f.close()
+
+    def save(self, sid, pickled):
+        filename = self.filename(sid)
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another thread may have made it
+                if not os.path.isdir(dirname):
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(pickled)
+            finally:
+                f.close()
+            if self.chmod:
+                os.chmod(tmp, self.chmod)
+            _rename(tmp, filename)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def delete(self, sid):
+        try:
+            os.unlink(self.filename(sid))
+        except OSError:
+            pass
+
+    def touch(self, sid):
+        try:
+            os.utime(self.filename(sid), None)
+        except OSError:
+            pass
+
+    def clean_up(self):
+        shards = self.next_shard
+        self.next_shard = (shards + self.cleanup_shards) % 256
+        oldest = time.time() - self.expiration*60
+        for shard in range(shards, shards + self.cleanup_shards):
+            top = os.path.join(self.path, '%02x' % (shard % 256))
+            for root, dirs, files in os.walk(top):
+                for name in files:
+                    filename = os.path.join(root, name)
+                    try:
+                        if os.stat(filename).st_mtime < oldest:
+                            os.unlink(filename)
+                    except OSError:
+                        # Removed by another process
+                        pass
+
+def _rename(src, dest):
+    if os.name == 'nt' and os.path.exists(dest):
+        # Windows won't rename over an existing file
+        os.unlink(dest)
+    os.rename(src, dest)
+
+class SQLiteStore(SessionStore):
+
+    """
+    Keeps sessions in a SQLite database ``filename``, with an index on
+    their expiry time so ``clean_up()`` doesn't look at live sessions.
+    Each thread uses its own connection.
+    """
+
+    def __init__(self, filename, expiration=2880, timeout=10):
+        if sqlite3 is None:
+            raise ImportError("SQLiteStore requires the sqlite3 module")
+        SessionStore.__init__(self, expiration)
+        self.filename = filename
+        self.timeout = timeout
+        self.local = threading.local()
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS paste_session ("
+                "sid TEXT PRIMARY KEY, data BLOB NOT NULL, "
+                "expires REAL NOT NULL)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS paste_session_expires "
+                "ON paste_session (expires)")
+
+    def connection(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=self.timeout)
+            self.local.connection = conn
+        return conn
+
+    def load(self, sid):
+        row = self.connection().execute(
+            "SELECT data FROM paste_session WHERE sid = ? AND expires > ?",
+            (sid, time.time())).fetchone()
+        if row is None:
+            return None
+        return bytes(row[0])
+
+    def save(self, sid, pickled):
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO paste_session (sid, data, expires) "
+                "VALUES (?, ?, ?)",
+                (sid, sqlite3.Binary(pickled),
+                 time.time() + self.expiration*60))
+
+    def delete(self, sid):
+        conn = self.connection()
+        with conn:
+            conn.execute("DELETE FROM paste_session WHERE sid = ?", (sid,))
+
+    def touch(self, sid):
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "UPDATE paste_session SET expires = ? WHERE sid = ?",
+                (time.time() + self.expiration*60, sid))
+
+    def clean_up(self):
+        conn = self.connection()
+        with conn:
+            conn.execute("DELETE FROM paste_session WHERE expires <= ?",
+                         (time.time(),))
+
+class MemoryStore(SessionStore):
+
+    """
+    Keeps up to ``max_sessions`` sessions in this process, dropping
+    the least recently used ones.  Sessions are lost when the process
+    ends, and aren't shared between processes.
+    """
+
+    def __init__(self, max_sessions=10000, expiration=2880):
+        SessionStore.__init__(self, expiration)
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        # sid -> (pickled, expires), least recently used first
+        self.sessions = OrderedDict()
+
+    def load(self, sid):
+        with self.lock:
+            item = self.sessions.pop(sid, None)
+            if item is None or item[1] < time.time():
+                return None
+            self.sessions[sid] = item
+            return item[0]
+
+    def save(self, sid, pickled):
+        with self.lock:
+            self.sessions.pop(sid, None)
+            self.sessions[sid] = (pickled, time.time() + self.expiration*60)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def touch(self, sid):
+        with self.lock:
+            item = self.sessions.get(sid)
+            if item is not None:
+                self.sessions[sid] = (item[0],
+                                      time.time() + self.expiration*60)
+
+    def clean_up(self):
+        now = time.time()
+        with self.lock:
+            for sid, (pickled, expires) in list(self.sessions.items()):
+                if expires < now:
+                    del self.sessions[sid]
+
+class StoreSession(object):
+
+    """
+    A session kept in a ``SessionStore``, which is only saved if its
+    data has changed (or touched, with ``touch``).  ``SessionFactory``
+    uses this when given a ``store``.
+    """
+
+    def __init__(self, sid, create=False, store=None, touch=False):
+        if store is None:
+            raise TypeError("StoreSession requires a store")
+        if not sid or not _sid_re.search(sid):
+            # Invalid...
+            raise KeyError
+        self.sid = sid
+        self.store = store
+        self.touch = touch
+        self._pickled = None
+        self._data = None
+        if not create:
+            self._pickled = store.load(sid)
+            if self._pickled is None:
+                raise KeyError
+
+    def data(self):
+        if self._data is None:
+            if self._pickled is not None:
+                self._data = SessionDict(cPickle.loads(self._pickled))
+            else:
+                self._data = SessionDict()
+        return self._data
+
+    def close(self):
+        if self._data is None:
+            return
+        if not self._data.modified:
+            if self.touch and self._pickled is not None:
+                self.store.touch(self.sid)
+            return
+        if not self._data:
+            if self._pickled is not None:
+                self.store.delete(self.sid)
+            return
+        self.store.save(self.sid, cPickle.dumps(dict(self._data),
+                                                cPickle.HIGHEST_PROTOCOL))
+
+    def clean_up(self):
+        self.store.maybe_clean_up()
+
 class _NoDefault(object):
     def __repr__(self):
         return '<dynamic default>'
@@ -297,7 +734,10 @@ def make_session_middleware(
     expiration=NoDefault,
     cookie_name=NoDefault,
     session_file_path=NoDefault,
-    chmod=NoDefault):
+    chmod=NoDefault,
+    store=NoDefault,
+    max_sessions=NoDefault,
+    touch=NoDefault):
     """
     Adds a middleware that handles sessions for your applications.
     The session is a peristent dictionary.  To get this dictionary
@@ -325,8 +765,23 @@ def make_session_middleware(
           The octal chmod you want to apply to new sessions (e.g., 660
           to make the sessions group readable/writable)
 
-    Each of these also takes from the global configuration.  cookie_name
-    and chmod take from session_cookie_name and session_chmod
+      store:
+          Where sessions are kept: ``file`` (the default) for a file
+          per session in session_file_path, ``sharded`` for files
+          spread over subdirectories of session_file_path, ``sqlite``
+          for a database in session_file_path, or ``memory`` to keep
+          them in this process.
+
+      max_sessions:
+          The most sessions the ``memory`` store keeps.  Default 10000.
+
+      touch:
+          If true, a session expires ``expiration`` minutes after it
+          was last used, not after it was last changed.
+
+    Each of these also takes from the global configuration.  cookie_name,
+    chmod, store and touch take from session_cookie_name, session_chmod,
+    session_store and session_touch
     """
     if session_expiration is NoDefault:
         session_expiration = global_conf.get('session_expiration', 60*12)
@@ -340,7 +795,29 @@ def make_session_middleware(
         session_file_path = global_conf.get('session_file_path', '/tmp')
     if chmod is NoDefault:
         chmod = global_conf.get('session_chmod', None)
+    if store is NoDefault:
+        store = global_conf.get('session_store', 'file')
+    if max_sessions is NoDefault:
+        max_sessions = global_conf.get('max_sessions', 10000)
+    if touch is NoDefault:
+        touch = global_conf.get('session_touch', False)
+    touch = asbool(touch)
+    if store == 'file':
+        return SessionMiddleware(
+            app, session_expiration=session_expiration,
+            expiration=expiration, cookie_name=cookie_name,
+            session_file_path=session_file_path, chmod=chmod, touch=touch)
+    if store == 'sharded':
+        store = ShardedFileStore(session_file_path, expiration=expiration,
+                                 chmod=chmod)
+    elif store == 'sqlite':
+        store = SQLiteStore(
+            os.path.join(session_file_path, 'paste_sessions.sqlite'),
+            expiration=expiration)
+    elif store == 'memory':
+        store = MemoryStore(int(max_sessions), expiration=expiration)
+    else:
+        raise ValueError("Unknown session store %r" % store)
     return SessionMiddleware(
         app, session_expiration=session_expiration,
-        expiration=expiration, cookie_name=cookie_name,
-        session_file_path=session_file_path, chmod=chmod)
+        cookie_name=cookie_name, store=store, touch=touch)
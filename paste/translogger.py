@@ -4,9 +4,14 @@
 Middleware for logging requests, using Apache combined log format
 """
 
+import atexit
+import json
 import logging
 import six
+import threading
 import time
+import traceback
+from six.moves import queue
 from six.moves.urllib.parse import quote
 
 class TransLogger(object):
@@ -17,6 +22,21 @@ class TransLogger(object):
 
     If ``setup_console_handler`` is true, then messages for the named
     logger will be sent to the console.
+
+    Requests are logged when the response is finished, so the
+    ``format`` can also use ``%(duration)s`` and ``%(ttfb)s`` (the
+    seconds until the first of the body was ready); ``bytes`` is
+    counted if the response had no Content-Length.  ``write_log`` is
+    called as it always was, with the request's ``time.localtime()``,
+    and finds those two in ``environ['paste.translogger.timing']``.  A response given
+    as a list, or as a ``wsgi.file_wrapper``, is logged as soon as the
+    application returns it, and isn't wrapped.  With ``json_output``
+    each message is a JSON object of the same values.
+
+    With ``asynchronous`` the request thread only queues what it saw,
+    and a background thread formats and logs it, taking up to
+    ``batch_size`` entries at a time.  If ``queue_size`` entries are
+    waiting, requests wait to queue theirs.
     """
 
     format = ('%(REMOTE_ADDR)s - %(REMOTE_USER)s [%(time)s] '
@@ -29,7 +49,11 @@ class TransLogger(object):
                  logging_level=logging.INFO,
                  logger_name='wsgi',
                  setup_console_handler=True,
-                 set_logger_level=logging.DEBUG):
+                 set_logger_level=logging.DEBUG,
+                 json_output=False,
+                 asynchronous=False,
+                 batch_size=100,
+                 queue_size=10000):
         if format is not None:
             self.format = format
         self.application = application
@@ -48,64 +72,225 @@ class TransLogger(object):
                 self.logger.setLevel(set_logger_level)
         else:
             self.logger = logger
+        self.json_output = json_output
+        self.batch_size = batch_size
+        # (localtime, formatted time) of the last request logged
+        self._time_cache = (None, None)
+        if asynchronous:
+            self.queue = queue.Queue(queue_size)
+            self.writer = threading.Thread(
+                target=self.write_entries, name='TransLogger writer')
+            self.writer.daemon = True
+            self.writer.start()
+            atexit.register(self.close)
+        else:
+            self.queue = self.writer = None
 
     def __call__(self, environ, start_response):
-        start = time.localtime()
+        start = time.time()
         req_uri = quote(environ.get('SCRIPT_NAME', '')
                                + environ.get('PATH_INFO', ''))
         if environ.get('QUERY_STRING'):
             req_uri += '?'+environ['QUERY_STRING']
         method = environ['REQUEST_METHOD']
+        response = []
         def replacement_start_response(status, headers, exc_info=None):
-            # @@: Ideally we would count the bytes going by if no
-            # content-length header was provided; but that does add
-            # some overhead, so at least for now we'll be lazy.
             bytes = None
             for name, value in headers:
                 if name.lower() == 'content-length':
                     bytes = value
-            self.write_log(environ, method, req_uri, start, status, bytes)
+            response[:] = [status, bytes]
             return start_response(status, headers)
-        return self.application(environ, replacement_start_response)
+        app_iter = self.application(environ, replacement_start_response)
+        if response:
+            if isinstance(app_iter, (list, tuple)):
+                status, bytes = response
+                if bytes is None:
+                    bytes = sum(map(len, app_iter))
+                duration = time.time() - start
+                self.log_request(environ, method, req_uri, start, status,
+                                 bytes, duration, duration)
+                return app_iter
+            file_wrapper = environ.get('wsgi.file_wrapper')
+            if (isinstance(file_wrapper, type)
+                and isinstance(app_iter, file_wrapper)):
+                # Wrapping this would stop the server sending the file
+                # efficiently
+                status, bytes = response
+                duration = time.time() - start
+                self.log_request(environ, method, req_uri, start, status,
+                                 bytes, duration, duration)
+                return app_iter
+        return _LoggedResponse(self, app_iter, environ, method, req_uri,
+                               start, response)
+
+    def log_request(self, environ, method, req_uri, start, status, bytes,
+                    duration, ttfb):
+        """
+        Logs a finished request that started at ``start`` (a
+        ``time.time()``) and took ``duration`` seconds, ``ttfb`` of
+        them before the first of the body, through ``write_log``.
+        """
+        environ['paste.translogger.timing'] = (duration, ttfb)
+        self.write_log(environ, method, req_uri, time.localtime(start),
+                       status, bytes)
 
     def write_log(self, environ, method, req_uri, start, status, bytes):
         if bytes is None:
             bytes = '-'
-        if time.daylight:
-                offset = time.altzone / 60 / 60 * -100
-        else:
-                offset = time.timezone / 60 / 60 * -100
-        if offset >= 0:
-                offset = "+%0.4d" % (offset)
-        elif offset < 0:
-                offset = "%0.4d" % (offset)
+        duration, ttfb = environ.get('paste.translogger.timing',
+                                     (None, None))
         remote_addr = '-'
         if environ.get('HTTP_X_FORWARDED_FOR'):
             remote_addr = environ['HTTP_X_FORWARDED_FOR']
         elif environ.get('REMOTE_ADDR'):
             remote_addr = environ['REMOTE_ADDR']
+        entry = (remote_addr, environ.get('REMOTE_USER') or '-', method,
+                 req_uri, environ.get('SERVER_PROTOCOL'), start,
+                 status.split(None, 1)[0], bytes,
+                 environ.get('HTTP_REFERER', '-'),
+                 environ.get('HTTP_USER_AGENT', '-'), duration, ttfb)
+        if self.queue is not None:
+            self.queue.put(entry)
+        else:
+            self.log_entry(entry)
+
+    def log_entry(self, entry):
+        (remote_addr, remote_user, method, req_uri, http_version, start,
+         status, bytes, referer, user_agent, duration, ttfb) = entry
         d = {
             'REMOTE_ADDR': remote_addr,
-            'REMOTE_USER': environ.get('REMOTE_USER') or '-',
+            'REMOTE_USER': remote_user,
             'REQUEST_METHOD': method,
             'REQUEST_URI': req_uri,
-            'HTTP_VERSION': environ.get('SERVER_PROTOCOL'),
-            'time': time.strftime('%d/%b/%Y:%H:%M:%S ', start) + offset,
-            'status': status.split(None, 1)[0],
+            'HTTP_VERSION': http_version,
+            'time': self.format_time(start),
+            'status': status,
             'bytes': bytes,
-            'HTTP_REFERER': environ.get('HTTP_REFERER', '-'),
-            'HTTP_USER_AGENT': environ.get('HTTP_USER_AGENT', '-'),
+            'HTTP_REFERER': referer,
+            'HTTP_USER_AGENT': user_agent,
+            'duration': duration,
+            'ttfb': ttfb,
             }
-        message = self.format % d
+        if self.json_output:
+            if bytes == '-':
+                d['bytes'] = None
+            else:
+                d['bytes'] = int(bytes)
+            message = json.dumps(d, sort_keys=True)
+        else:
+            for key in ('duration', 'ttfb'):
+                if d[key] is None:
+                    d[key] = '-'
+                else:
+                    d[key] = '%.6f' % d[key]
+            message = self.format % d
         self.logger.log(self.logging_level, message)
 
+    def format_time(self, start):
+        """
+        Formats a ``time.localtime()`` in the Apache log format (like
+        ``10/Oct/2000:13:55:36 -0700``), reusing the last result for
+        the same second.
+        """
+        cached, formatted = self._time_cache
+        if cached != start:
+            if start.tm_isdst > 0:
+                offset = -time.altzone // 60
+            else:
+                offset = -time.timezone // 60
+            sign = offset < 0 and '-' or '+'
+            formatted = '%s%s%02d%02d' % (
+                time.strftime('%d/%b/%Y:%H:%M:%S ', start), sign,
+                abs(offset) // 60, abs(offset) % 60)
+            self._time_cache = (start, formatted)
+        return formatted
+
+    def write_entries(self):
+        """
+        Logs queued entries, in the background thread.
+        """
+        while True:
+            entries = [self.queue.get()]
+            try:
+                while len(entries) < self.batch_size:
+                    entries.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            for entry in entries:
+                if entry is None:
+                    return
+                try:
+                    self.log_entry(entry)
+                except Exception:
+                    traceback.print_exc()
+
+    def close(self):
+        """
+        Logs everything queued so far, and stops the background thread.
+        """
+        if self.writer is None or not self.writer.is_alive():
+            return
+        self.queue.put(None)
+        self.writer.join()
+
+class _LoggedResponse(object):
+
+    """
+    Passes on the response, counting its bytes and noting when the
+    first arrived, and logs the request when it is closed.
+    """
+
+    __slots__ = ('translogger', 'app_iter', 'environ', 'method', 'req_uri',
+                 'start', 'response', 'sent', 'first')
+
+    def __init__(self, translogger, app_iter, environ, method, req_uri,
+                 start, response):
+        self.translogger = translogger
+        self.app_iter = app_iter
+        self.environ = environ
+        self.method = method
+        self.req_uri = req_uri
+        self.start = start
+        self.response = response
+        self.sent = 0
+        self.first = None
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            if chunk and self.first is None:
+                self.first = time.time()
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            if self.response:
+                status, bytes = self.response
+                if bytes is None:
+                    bytes = self.sent
+                end = time.time()
+                first = self.first
+                if first is None:
+                    first = end
+                self.translogger.log_request(
+                    self.environ, self.method, self.req_uri, self.start,
+                    status, bytes, end - self.start, first - self.start)
+
 def make_filter(
     app, global_conf,
     logger_name='wsgi',
     format=None,
     logging_level=logging.INFO,
     setup_console_handler=True,
-    set_logger_level=logging.DEBUG):
+    set_logger_level=logging.DEBUG,
+    json_output=False,
+    asynchronous=False,
+    batch_size=100,
+    queue_size=10000):
     from paste.util.converters import asbool
     if isinstance(logging_level, (six.binary_type, six.text_type)):
         logging_level = logging._levelNames[logging_level]
@@ -117,6 +302,10 @@ def make_filter(
         logging_level=logging_level,
         logger_name=logger_name,
         setup_console_handler=asbool(setup_console_handler),
-        set_logger_level=set_logger_level)
+        set_logger_level=set_logger_level,
+        json_output=asbool(json_output),
+        asynchronous=asbool(asynchronous),
+        batch_size=int(batch_size),
+        queue_size=int(queue_size))
 
 make_filter.__doc__ = TransLogger.__doc__
@@ -88,13 +88,18 @@ class URLMap(DictMixin):
     URLs can also include domains, like ``http://blah.com/foo``, or as
     tuples ``('blah.com', '/foo')``.  This will match domain names; without
     the ``http://domain`` or with a domain of ``None`` any domain will be
-    matched (so long as no other explicit domain matches).  """
+    matched (so long as no other explicit domain matches).
+
+    Requests are dispatched through an index (a trie of path segments
+    for each domain), which is rebuilt after the mapping changes.  """
 
     def __init__(self, not_found_app=None):
         self.applications = []
         if not not_found_app:
             not_found_app = self.not_found_app
         self.not_found_application = not_found_app
+        self._index = None
+        self._index_source = None
 
     def __len__(self):
         return len(self.applications)
@@ -159,6 +164,54 @@ class URLMap(DictMixin):
         apps = [(key(desc), desc) for desc in self.applications]
         apps.sort()
         self.applications = [desc for (sortable, desc) in apps]
+        self._index = None
+
+    def build_index(self):
+        """
+        Builds the index ``__call__`` uses: a dictionary of domain (or
+        None) to a trie of path segments, where each node is a
+        dictionary of segment to child node, with the ``(app_url,
+        app)`` mounted there (if any) under the key None.
+        """
+        index = {}
+        for (domain, app_url), app in self.applications:
+            node = index.setdefault(domain or None, {})
+            if app_url:
+                for segment in app_url[1:].split('/'):
+                    node = node.setdefault(segment, {})
+            # Like the linear search, the first of any duplicates wins
+            node.setdefault(None, (app_url, app))
+        self._index = index
+        self._index_source = (self.applications, len(self.applications))
+        return index
+
+    def match(self, host, port, path_info):
+        """
+        Returns the ``(app_url, app)`` that ``path_info`` (normalized,
+        so it is empty or starts with ``/``) on the given host and port
+        is dispatched to, or None.
+        """
+        index = self._index
+        if (index is None or self._index_source[0] is not self.applications
+            or self._index_source[1] != len(self.applications)):
+            index = self.build_index()
+        segments = None
+        for domain in (host, host + ':' + port, None):
+            node = index.get(domain)
+            if node is None:
+                continue
+            found = node.get(None)
+            if segments is None:
+                segments = path_info[1:].split('/')
+            for segment in segments:
+                node = node.get(segment)
+                if node is None:
+                    break
+                if None in node:
+                    found = node[None]
+            if found is not None:
+                return found
+        return None
 
     def __setitem__(self, url, app):
         if app is None:
@@ -171,6 +224,8 @@ class URLMap(DictMixin):
         if dom_url in self:
             del self[dom_url]
         self.applications.append((dom_url, app))
+        # Only the new entry is out of place, which Python's sort
+        # fixes in linear time
         self.sort_apps()
 
     def __getitem__(self, url):
@@ -187,6 +242,7 @@ class URLMap(DictMixin):
         for app_url, app in self.applications:
             if app_url == url:
                 self.applications.remove((app_url, app))
+                self._index = None
                 break
         else:
             raise KeyError(
@@ -205,15 +261,14 @@ class URLMap(DictMixin):
             else:
                 port = '443'
         path_info = environ.get('PATH_INFO')
-        path_info = self.normalize_url(path_info, False)[1]
-        for (domain, app_url), app in self.applications:
-            if domain and domain != host and domain != host+':'+port:
-                continue
-            if (path_info == app_url
-                or path_info.startswith(app_url + '/')):
-                environ['SCRIPT_NAME'] += app_url
-                environ['PATH_INFO'] = path_info[len(app_url):]
-                return app(environ, start_response)
+        if not path_info.startswith('/') or '//' in path_info:
+            path_info = self.normalize_url(path_info, False)[1]
+        found = self.match(host, port, path_info)
+        if found is not None:
+            app_url, app = found
+            environ['SCRIPT_NAME'] += app_url
+            environ['PATH_INFO'] = path_info[len(app_url):]
+            return app(environ, start_response)
         environ['paste.urlmap_object'] = self
         return self.not_found_application(environ, start_response)
 
@@ -9,6 +9,8 @@ import six
 import sys
 import imp
 import mimetypes
+import threading
+from collections import OrderedDict
 try:
     import pkg_resources
 except ImportError:
@@ -23,7 +25,8 @@ from paste.util import converters
 class NoDefault(object):
     pass
 
-__all__ = ['URLParser', 'StaticURLParser', 'PkgResourcesParser']
+__all__ = ['URLParser', 'StaticURLParser', 'StaticFileCache',
+           'PkgResourcesParser']
 
 class URLParser(object):
 
@@ -423,14 +426,30 @@ class StaticURLParser(object):
 
     ``cache_max_age``:
       integer specifies Cache-Control max_age in seconds
+
+    ``precompressed``:
+      if true, send ``.br``/``.gz`` files found next to the requested
+      file to clients that accept them (see ``paste.fileapp.FileApp``)
+
+    ``compressed_cache``:
+      a ``paste.fileapp.CompressedCache`` of gzipped files, used for
+      text files without a ``.gz`` file
+
+    ``file_cache``:
+      a ``StaticFileCache`` to keep the ``FileApp`` for each file in,
+      instead of making a new one (and reading the file) per request
     """
     # @@: Should URLParser subclass from this?
 
     def __init__(self, directory, root_directory=None,
-                 cache_max_age=None):
+                 cache_max_age=None, precompressed=False,
+                 compressed_cache=None, file_cache=None):
         self.directory = self.normpath(directory)
         self.root_directory = self.normpath(root_directory or directory)
         self.cache_max_age = cache_max_age
+        self.precompressed = precompressed
+        self.compressed_cache = compressed_cache
+        self.file_cache = file_cache
 
     def normpath(path):
         return os.path.normcase(os.path.abspath(path))
@@ -440,6 +459,18 @@ class StaticURLParser(object):
         path_info = environ.get('PATH_INFO', '')
         if not path_info:
             return self.add_slash(environ, start_response)
+        if (self.file_cache is not None and path_info != '/'
+            and '/.' not in path_info and not path_info.endswith('/')):
+            # Look the whole path up at once, rather than a directory
+            # at a time
+            full = self.normpath(os.path.join(self.directory,
+                                              path_info.lstrip('/')))
+            fa = self.file_cache.get(full)
+            if fa is not None and full.startswith(self.root_directory):
+                environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') \
+                                         + path_info
+                environ['PATH_INFO'] = ''
+                return fa(environ, start_response)
         if path_info == '/':
             # @@: This should obviously be configurable
             filename = 'index.html'
@@ -454,8 +485,11 @@ class StaticURLParser(object):
         if os.path.isdir(full):
             # @@: Cache?
             return self.__class__(full, root_directory=self.root_directory,
-                                  cache_max_age=self.cache_max_age)(environ,
-                                                                   start_response)
+                                  cache_max_age=self.cache_max_age,
+                                  precompressed=self.precompressed,
+                                  compressed_cache=self.compressed_cache,
+                                  file_cache=self.file_cache)(
+                                      environ, start_response)
         if environ.get('PATH_INFO') and environ.get('PATH_INFO') != '/':
             return self.error_extra_path(environ, start_response)
         if_none_match = environ.get('HTTP_IF_NONE_MATCH')
@@ -472,10 +506,13 @@ class StaticURLParser(object):
         fa = self.make_app(full)
         if self.cache_max_age:
             fa.cache_control(max_age=self.cache_max_age)
+        if self.file_cache is not None:
+            self.file_cache.put(full, fa)
         return fa(environ, start_response)
 
     def make_app(self, filename):
-        return fileapp.FileApp(filename)
+        return fileapp.FileApp(filename, precompressed=self.precompressed,
+                               compressed_cache=self.compressed_cache)
 
     def add_slash(self, environ, start_response):
         """
@@ -509,17 +546,125 @@ class StaticURLParser(object):
     def __repr__(self):
         return '<%s %r>' % (self.__class__.__name__, self.directory)
 
-def make_static(global_conf, document_root, cache_max_age=None):
+class StaticFileCache(object):
+    """
+    A cache of the ``FileApp`` instances a ``StaticURLParser`` (and
+    the parsers for its subdirectories) makes, keyed by normalized
+    filename, so that small files stay in memory and aren't looked
+    up again for every request.
+
+    A cached file is checked (with ``os.stat``) at most once every
+    ``check_interval`` seconds, so changes can take that long to show
+    up.  The least recently used files are dropped to keep the cache
+    under ``max_size`` bytes (file contents held in memory, plus
+    ``entry_size`` for each file).  ``hits`` and ``misses`` count
+    lookups.
+    """
+
+    entry_size = 1024
+
+    def __init__(self, max_size=16 * 1024 * 1024, check_interval=1):
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def app_size(self, fa):
+        if fa.content is None or isinstance(fa.content, memoryview):
+            # Memory-mapped content can be dropped by the OS
+            return self.entry_size
+        return self.entry_size + len(fa.content)
+
+    def get(self, filename):
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[filename] = entry
+        fa, size = entry
+        try:
+            # Only stats the file every check_interval seconds
+            fa.update()
+        except OSError:
+            # Gone
+            self.remove(filename)
+            with self.lock:
+                self.misses += 1
+            return None
+        new_size = self.app_size(fa)
+        with self.lock:
+            self.hits += 1
+            if new_size != size and self.entries.get(filename) is entry:
+                self.entries[filename] = (fa, new_size)
+                self.size += new_size - size
+                self.prune()
+        return fa
+
+    def put(self, filename, fa):
+        fa.check_interval = self.check_interval
+        try:
+            fa.update()
+        except OSError:
+            return
+        size = self.app_size(fa)
+        with self.lock:
+            old = self.entries.pop(filename, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[filename] = (fa, size)
+            self.size += size
+            self.prune()
+
+    def remove(self, filename):
+        with self.lock:
+            old = self.entries.pop(filename, None)
+            if old is not None:
+                self.size -= old[1]
+
+    def prune(self):
+        # The lock must be held
+        while self.size > self.max_size and self.entries:
+            filename, (fa, size) = self.entries.popitem(last=False)
+            self.size -= size
+
+def make_static(global_conf, document_root, cache_max_age=None,
+                precompressed=False, compressed_cache_size=None,
+                file_cache_size=None, file_cache_check_interval=1):
     """
     Return a WSGI application that serves a directory (configured
     with document_root)
 
     cache_max_age - integer specifies CACHE_CONTROL max_age in seconds
+
+    precompressed - send .br/.gz files next to the requested file to
+    clients that accept them
+
+    compressed_cache_size - keep up to this many bytes of gzipped text
+    files in memory, for files without a .gz file
+
+    file_cache_size - keep up to this many bytes of files in memory,
+    checking each for changes at most every file_cache_check_interval
+    seconds (default 1)
     """
     if cache_max_age is not None:
         cache_max_age = int(cache_max_age)
+    compressed_cache = None
+    if compressed_cache_size:
+        compressed_cache = fileapp.CompressedCache(
+            max_size=int(compressed_cache_size))
+    file_cache = None
+    if file_cache_size:
+        file_cache = StaticFileCache(
+            max_size=int(file_cache_size),
+            check_interval=float(file_cache_check_interval))
     return StaticURLParser(
-        document_root, cache_max_age=cache_max_age)
+        document_root, cache_max_age=cache_max_age,
+        precompressed=converters.asbool(precompressed),
+        compressed_cache=compressed_cache, file_cache=file_cache)
 
 class PkgResourcesParser(StaticURLParser):
 
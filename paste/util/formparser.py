@@ -0,0 +1,324 @@
+# (c) 2005 Ian Bicking and contributors; written for Paste (http://pythonpaste.org)
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Incremental parsers for ``multipart/form-data`` and
+``application/x-www-form-urlencoded`` request bodies.
+
+The body is read in blocks of ``BLOCK_SIZE`` bytes; file uploads are
+kept in memory up to ``SPOOL_SIZE`` bytes, and in a temporary file
+after that.  ``parse_form`` raises ``FormError`` if the body is
+malformed, or goes over any of the limits: ``MAX_PARTS`` fields,
+``MAX_FIELD_SIZE`` bytes in a field that isn't a file, or
+``MAX_SIZE`` bytes in all (None for no limit).
+"""
+
+import re
+import tempfile
+from email.message import Message
+
+import six
+from six.moves.urllib.parse import parse_qsl
+
+try:
+    from cgi import FieldStorage as _FieldStorage
+except ImportError:
+    _FieldStorage = object
+
+__all__ = ['FormError', 'UploadedFile', 'parse_form']
+
+BLOCK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+MAX_PARTS = 10000
+MAX_FIELD_SIZE = 10 * 1024 * 1024
+MAX_SIZE = None
+# The most a part's headers can take up
+MAX_HEADER_SIZE = 16 * 1024
+
+class FormError(ValueError):
+    """
+    Raised when a form can't be parsed, or is too big.
+    """
+
+class UploadedFile(_FieldStorage):
+
+    """
+    A file from a ``multipart/form-data`` body, with the ``name``,
+    ``filename``, ``type``, ``headers``, ``file`` and ``value``
+    attributes of a ``cgi.FieldStorage`` (which this is a subclass of,
+    where that module exists).
+    """
+
+    def __init__(self, name, filename, headers, file):
+        self.name = name
+        self.filename = filename
+        self.headers = headers
+        self.file = file
+        self.list = None
+        content_type = headers.get('content-type', 'application/octet-stream')
+        self.type, self.type_options = _parse_header(content_type)
+        self.disposition, self.disposition_options = _parse_header(
+            headers.get('content-disposition', ''))
+
+    @property
+    def value(self):
+        self.file.seek(0)
+        value = self.file.read()
+        self.file.seek(0)
+        return value
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.name,
+                               self.filename)
+
+_option_re = re.compile(
+    r';\s*([^\s=;]+)\s*(?:=\s*("(?:[^"\\]|\\.)*"|[^;]*))?')
+
+def _parse_header(value):
+    """
+    Parses a header like ``form-data; name="field"``, returning
+    ``('form-data', {'name': 'field'})``.
+    """
+    main, sep, rest = value.partition(';')
+    options = {}
+    for match in _option_re.finditer(sep + rest):
+        name, option = match.group(1).lower(), match.group(2) or ''
+        option = option.strip()
+        if len(option) >= 2 and option[0] == option[-1] == '"':
+            option = option[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+        options[name] = option
+    return main.strip().lower(), options
+
+class _BodyReader(object):
+
+    """
+    Reads a request body in blocks, stopping after ``length`` bytes
+    (or at the end of the input, if ``length`` is negative).
+    """
+
+    def __init__(self, fp, length, max_size, block_size):
+        if max_size is not None and length > max_size:
+            raise FormError("Request body is too large (%s bytes, the "
+                            "limit is %s)" % (length, max_size))
+        self.fp = fp
+        self.remaining = length
+        self.max_size = max_size
+        self.block_size = block_size
+        self.total = 0
+
+    def read(self):
+        size = self.block_size
+        if self.remaining >= 0:
+            size = min(size, self.remaining)
+            if size <= 0:
+                return b''
+        data = self.fp.read(size)
+        if self.remaining >= 0:
+            if not data:
+                self.remaining = 0
+            self.remaining -= len(data)
+        self.total += len(data)
+        if self.max_size is not None and self.total > self.max_size:
+            raise FormError("Request body is too large (the limit is %s "
+                            "bytes)" % self.max_size)
+        return data
+
+def parse_form(fp, content_type, content_length, encoding=None,
+               errors=None, max_parts=None, max_field_size=None,
+               max_size=None, spool_size=None, block_size=None):
+    """
+    Parses a form body read from ``fp``, returning a list of ``(name,
+    value)``.  Files are ``UploadedFile`` instances; on Python 3 other
+    values (and names) are decoded with ``encoding`` (default UTF-8).
+    A ``content_type`` other than a form gives an empty list.
+    """
+    ctype, options = _parse_header(content_type)
+    limits = dict(
+        encoding=encoding or 'utf-8', errors=errors or 'replace',
+        max_parts=max_parts or MAX_PARTS,
+        max_field_size=max_field_size or MAX_FIELD_SIZE,
+        spool_size=spool_size or SPOOL_SIZE)
+    if max_size is None:
+        max_size = MAX_SIZE
+    reader = _BodyReader(fp, content_length, max_size,
+                         block_size or BLOCK_SIZE)
+    if ctype == 'application/x-www-form-urlencoded':
+        return _parse_urlencoded(reader, **limits)
+    if ctype == 'multipart/form-data':
+        boundary = options.get('boundary', '')
+        if not boundary or len(boundary) > 200:
+            raise FormError("Invalid multipart boundary %r" % boundary)
+        return _MultipartParser(reader, boundary.encode('latin-1'),
+                                **limits).parse()
+    return []
+
+def _parse_urlencoded(reader, encoding, errors, max_parts, max_field_size,
+                      spool_size):
+    results = []
+    # The pieces of the field the blocks so far ended in the middle
+    # of; joined once the field ends, so a big field isn't copied for
+    # every block
+    pending = []
+    pending_size = 0
+    while True:
+        block = reader.read()
+        if block:
+            pairs = block.split(b'&')
+            last = pairs.pop()
+            if pairs:
+                pending.append(pairs[0])
+                pairs[0] = b''.join(pending)
+                pending = []
+                pending_size = 0
+            pending.append(last)
+            pending_size += len(last)
+            if pending_size > max_field_size:
+                raise FormError("Form field is too large (the limit is %s "
+                                "bytes)" % max_field_size)
+        else:
+            pairs = [b''.join(pending)]
+        for pair in pairs:
+            if not pair:
+                continue
+            if len(pair) > max_field_size:
+                raise FormError("Form field is too large (the limit is %s "
+                                "bytes)" % max_field_size)
+            if six.PY3:
+                parsed = parse_qsl(pair.decode(encoding, errors),
+                                   keep_blank_values=True,
+                                   encoding=encoding, errors=errors)
+            else:
+                parsed = parse_qsl(pair, keep_blank_values=True)
+            results.extend(parsed)
+            if len(results) > max_parts:
+                raise FormError("Too many form fields (the limit is %s)"
+                                % max_parts)
+        if not block:
+            return results
+
+class _MultipartParser(object):
+
+    def __init__(self, reader, boundary, encoding, errors, max_parts,
+                 max_field_size, spool_size):
+        self.reader = reader
+        self.delimiter = b'--' + boundary
+        self.encoding = encoding
+        self.errors = errors
+        self.max_parts = max_parts
+        self.max_field_size = max_field_size
+        self.spool_size = spool_size
+
+    def more(self, buf):
+        block = self.reader.read()
+        if not block:
+            raise FormError("Multipart body ended unexpectedly")
+        return buf + block
+
+    def parse(self):
+        results = []
+        delimiter = self.delimiter
+        # Skip the preamble, up to the first delimiter
+        buf = b''
+        while True:
+            while len(buf) < len(delimiter):
+                buf = self.more(buf)
+            if buf.startswith(delimiter):
+                buf = buf[len(delimiter):]
+                break
+            pos = buf.find(b'\r\n' + delimiter)
+            if pos >= 0:
+                buf = buf[pos + 2 + len(delimiter):]
+                break
+            buf = self.more(buf[-len(delimiter) - 1:])
+        while True:
+            while len(buf) < 2:
+                buf = self.more(buf)
+            if buf[:2] == b'--':
+                return results
+            # Skip any padding after the delimiter
+            while True:
+                pos = buf.find(b'\r\n')
+                if pos >= 0:
+                    break
+                if len(buf) > 1024:
+                    raise FormError("Invalid multipart delimiter line")
+                buf = self.more(buf)
+            buf = buf[pos + 2:]
+            headers, buf = self.read_headers(buf)
+            if len(results) >= self.max_parts:
+                raise FormError("Too many form fields (the limit is %s)"
+                                % self.max_parts)
+            disposition, options = _parse_header(
+                headers.get('content-disposition', ''))
+            name = options.get('name')
+            filename = options.get('filename')
+            if filename is not None:
+                sink = tempfile.SpooledTemporaryFile(
+                    max_size=self.spool_size)
+                buf = self.read_body(buf, sink.write)
+                sink.seek(0)
+                value = UploadedFile(name, filename, headers, sink)
+            else:
+                chunks = []
+                size = [0]
+                def write(data):
+                    size[0] += len(data)
+                    if size[0] > self.max_field_size:
+                        raise FormError(
+                            "Form field %r is too large (the limit is %s "
+                            "bytes)" % (name, self.max_field_size))
+                    chunks.append(data)
+                buf = self.read_body(buf, write)
+                value = b''.join(chunks)
+                if six.PY3:
+                    value = value.decode(self.encoding, self.errors)
+            if name is not None:
+                results.append((name, value))
+
+    def read_headers(self, buf):
+        if buf.startswith(b'\r\n'):
+            end, start = 0, 2
+        else:
+            while True:
+                end = buf.find(b'\r\n\r\n')
+                if end >= 0:
+                    start = end + 4
+                    break
+                if len(buf) > MAX_HEADER_SIZE:
+                    raise FormError("Multipart headers are too large")
+                buf = self.more(buf)
+        if end > MAX_HEADER_SIZE:
+            raise FormError("Multipart headers are too large")
+        block = buf[:end]
+        if six.PY3:
+            block = block.decode(self.encoding, self.errors)
+        headers = Message()
+        lines = []
+        for line in block.split('\r\n'):
+            if line[:1] in (' ', '\t') and lines:
+                lines[-1] += ' ' + line.strip()
+            elif line:
+                lines.append(line)
+        for line in lines:
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise FormError("Invalid multipart header %r" % line)
+            headers[name.strip()] = value.strip()
+        return headers, buf[start:]
+
+    def read_body(self, buf, write):
+        """
+        Passes the part's body to ``write``, returning what's left of
+        the buffer after the delimiter that ends it.
+        """
+        end = b'\r\n' + self.delimiter
+        keep = len(end) - 1
+        while True:
+            pos = buf.find(end)
+            if pos >= 0:
+                if pos:
+                    write(buf[:pos])
+                return buf[pos + len(end):]
+            if len(buf) > keep:
+                write(buf[:-keep])
+                buf = buf[-keep:]
+            buf = self.more(buf)
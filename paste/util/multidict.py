@@ -1,10 +1,17 @@
 # (c) 2005 Ian Bicking and contributors; written for Paste (http://pythonpaste.org)
 # Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
-import cgi
 import copy
 import six
 import sys
 
+from paste.util.formparser import UploadedFile
+
+try:
+    from cgi import FieldStorage
+except ImportError:
+    # Removed in Python 3.13, so uploads are all UploadedFile
+    FieldStorage = UploadedFile
+
 try:
     # Python 3
     from collections.abc import MutableMapping as DictMixin
@@ -208,6 +215,160 @@ class MultiDict(DictMixin):
         for k, v in self._items:
             yield v
 
+class IndexedMultiDict(MultiDict):
+
+    """
+    A MultiDict that also keeps track of where each key appears, so
+    that looking up, adding and testing for a key don't go through
+    every item.  Keys must be hashable.
+
+    Removing a key still moves up every item added after it, so
+    deleting, popping or setting (which removes the old values) a key
+    that was added early takes time proportional to the number of
+    items; ``popitem()`` and changes to recently added keys are cheap.
+
+    Keys are matched just as MultiDict matches them: getting an item
+    and ``setdefault()`` use ``==`` alone, while ``getall()``, ``in``,
+    deleting, popping and setting also need the key to be of the same
+    type (so ``1`` and ``1.0`` are kept apart).
+    """
+
+    def __init__(self, *args, **kw):
+        MultiDict.__init__(self, *args, **kw)
+        self._reindex()
+
+    def _reindex(self, start=0):
+        """
+        Indexes the items from ``start`` on (all of them, rebuilding
+        the index, when ``start`` is 0).
+        """
+        if not start:
+            self._index = {}
+        index = self._index
+        for i in range(start, len(self._items)):
+            key = self._items[i][0]
+            if key in index:
+                index[key].append(i)
+            else:
+                index[key] = [i]
+
+    def _positions(self, key):
+        # Positions of the items MultiDict.getall/__delitem__/pop
+        # would match: equal keys of the same type
+        items = self._items
+        return [i for i in self._index.get(key, ())
+                if type(items[i][0]) == type(key)]
+
+    def _remove(self, positions):
+        """
+        Removes the items at ``positions`` (in order), moving up the
+        items after them; this takes time proportional to the number
+        of items after ``positions[0]``.
+        """
+        items = self._items
+        index = self._index
+        first = positions[0]
+        removed = set(positions)
+        tail = [item for i, item in enumerate(items[first:], first)
+                if i not in removed]
+        for key, value in items[first:]:
+            key_positions = index.get(key)
+            if key_positions and key_positions[-1] >= first:
+                while key_positions and key_positions[-1] >= first:
+                    key_positions.pop()
+                if not key_positions:
+                    del index[key]
+        del items[first:]
+        items.extend(tail)
+        self._reindex(first)
+
+    def __getitem__(self, key):
+        positions = self._index.get(key)
+        if not positions:
+            raise KeyError(repr(key))
+        return self._items[positions[0]][1]
+
+    def __setitem__(self, key, value):
+        positions = self._positions(key)
+        if positions:
+            self._remove(positions)
+        self.add(key, value)
+
+    def add(self, key, value):
+        """
+        Add the key and value, not overwriting any previous value.
+        """
+        if key in self._index:
+            self._index[key].append(len(self._items))
+        else:
+            self._index[key] = [len(self._items)]
+        self._items.append((key, value))
+
+    def getall(self, key):
+        """
+        Return a list of all values matching the key (may be an empty list)
+        """
+        items = self._items
+        return [items[i][1] for i in self._positions(key)]
+
+    def __delitem__(self, key):
+        positions = self._positions(key)
+        if not positions:
+            raise KeyError(repr(key))
+        self._remove(positions)
+
+    def __contains__(self, key):
+        items = self._items
+        for i in self._index.get(key, ()):
+            if type(items[i][0]) == type(key):
+                return True
+        return False
+
+    has_key = __contains__
+
+    def clear(self):
+        self._items = []
+        self._index = {}
+
+    def copy(self):
+        return self.__class__(self)
+
+    def setdefault(self, key, default=None):
+        positions = self._index.get(key)
+        if positions:
+            return self._items[positions[0]][1]
+        self.add(key, default)
+        return default
+
+    def pop(self, key, *args):
+        if len(args) > 1:
+            raise TypeError("pop expected at most 2 arguments, got "
+                              + repr(1 + len(args)))
+        positions = self._positions(key)
+        if positions:
+            v = self._items[positions[0]][1]
+            self._remove(positions[:1])
+            return v
+        if args:
+            return args[0]
+        else:
+            raise KeyError(repr(key))
+
+    def popitem(self):
+        key, value = self._items.pop()
+        positions = self._index[key]
+        positions.pop()
+        if not positions:
+            del self._index[key]
+        return key, value
+
+    def update(self, other=None, **kwargs):
+        start = len(self._items)
+        MultiDict.update(self, other)
+        if kwargs:
+            MultiDict.update(self, kwargs)
+        self._reindex(start)
+
 class UnicodeMultiDict(DictMixin):
     """
     A MultiDict wrapper that decodes returned values to unicode on the
@@ -239,6 +400,8 @@ class UnicodeMultiDict(DictMixin):
                 key, value = item
                 key = self._encode_key(key)
                 items[index] = (key, value)
+            if isinstance(self.multi, IndexedMultiDict):
+                self.multi._reindex()
 
     def _encode_key(self, key):
         if self.decode_keys:
@@ -263,7 +426,7 @@ class UnicodeMultiDict(DictMixin):
 
         ``FieldStorage`` objects are specially handled.
         """
-        if isinstance(value, cgi.FieldStorage):
+        if isinstance(value, (FieldStorage, UploadedFile)):
             # decode FieldStorage's field name and filename
             decode_name = self.decode_keys and isinstance(value.name, six.binary_type)
             if six.PY2 or decode_name:
@@ -23,22 +23,36 @@ The ``Template`` class takes the template string and the name of
 the template (for errors) and a default namespace.  Then (like
 ``string.Template``) you can call the ``tmpl.substitute(**kw)``
 method to make a substitution (or ``tmpl.substitute(a_dict)``).
+``tmpl.generate(**kw)`` does the same, but returns the output in
+encoded chunks as it is produced, for use as a WSGI app_iter.
 
 ``sub(content, **kw)`` substitutes the template immediately.  You
 can use ``__name='tmpl.html'`` to set the name of the template.
 
 If there are syntax errors ``TemplateError`` will be raised.
+
+Templates are compiled into a Python function when they are created,
+so substituting them doesn't re-parse or re-compile anything.
 """
 
+import ast
+import copy
+import keyword
+import os
 import re
 import six
 import sys
+import threading
+import time
+from collections import OrderedDict
 from html import escape
+from types import FunctionType
+from six.moves import builtins
 from six.moves.urllib.parse import quote
 from paste.util.looper import looper
 
 __all__ = ['TemplateError', 'Template', 'sub', 'HTMLTemplate',
-           'sub_html', 'html', 'bunch']
+           'sub_html', 'html', 'bunch', 'TemplateLoader']
 
 token_re = re.compile(r'\{\{|\}\}')
 in_re = re.compile(r'\s+in\s+')
@@ -60,12 +74,6 @@ class TemplateError(Exception):
             msg += ' in %s' % self.name
         return msg
 
-class _TemplateContinue(Exception):
-    pass
-
-class _TemplateBreak(Exception):
-    pass
-
 class Template(object):
 
     default_namespace = {
@@ -76,16 +84,25 @@ class Template(object):
 
     default_encoding = 'utf8'
 
+    flush_size = 8192
+
     def __init__(self, content, name=None, namespace=None):
         self.content = content
         self._unicode = isinstance(content, six.text_type)
         self.name = name
         self._parsed = parse(content, name=name)
+        self._compiled = self._compile()
+        # Compiled by the first generate()
+        self._stream_compiled = None
         if namespace is None:
             namespace = {}
         self.namespace = namespace
 
-    def from_filename(cls, filename, namespace=None, encoding=None):
+    def from_filename(cls, filename, namespace=None, encoding=None,
+                      loader=None):
+        if loader is not None:
+            return loader.load(filename, namespace=namespace,
+                               encoding=encoding, template_class=cls)
         f = open(filename, 'rb')
         c = f.read()
         f.close()
@@ -101,6 +118,23 @@ class Template(object):
             hex(id(self))[2:], self.name)
 
     def substitute(self, *args, **kw):
+        ns = self._namespace(args, kw)
+        result = self._interpret(ns)
+        return result
+
+    def generate(self, *args, **kw):
+        """
+        Like ``substitute``, but returns an iterator over the output
+        in chunks, encoded with ``default_encoding`` so it can be
+        returned as a WSGI app_iter.  Output is sent at block
+        boundaries (each pass through a ``{{for}}`` loop, and the end
+        of each top-level block) once at least ``flush_size``
+        characters are waiting.
+        """
+        ns = self._namespace(args, kw)
+        return self._generate(ns)
+
+    def _namespace(self, args, kw):
         if args:
             if kw:
                 raise TypeError(
@@ -112,113 +146,93 @@ class Template(object):
         ns = self.default_namespace.copy()
         ns.update(self.namespace)
         ns.update(kw)
-        result = self._interpret(ns)
-        return result
+        return ns
 
     def _interpret(self, ns):
         __traceback_hide__ = True
         parts = []
-        self._interpret_codes(self._parsed, ns, out=parts)
+        try:
+            self._call(self._compiled, ns, parts.append)
+        except:
+            self._reraise(self._compiled)
         return ''.join(parts)
 
-    def _interpret_codes(self, codes, ns, out):
-        __traceback_hide__ = True
-        for item in codes:
-            if isinstance(item, six.string_types):
-                out.append(item)
-            else:
-                self._interpret_code(item, ns, out)
-
-    def _interpret_code(self, code, ns, out):
-        __traceback_hide__ = True
-        name, pos = code[0], code[1]
-        if name == 'py':
-            self._exec(code[2], ns, pos)
-        elif name == 'continue':
-            raise _TemplateContinue()
-        elif name == 'break':
-            raise _TemplateBreak()
-        elif name == 'for':
-            vars, expr, content = code[2], code[3], code[4]
-            expr = self._eval(expr, ns, pos)
-            self._interpret_for(vars, expr, content, ns, out)
-        elif name == 'cond':
-            parts = code[2:]
-            self._interpret_if(parts, ns, out)
-        elif name == 'expr':
-            parts = code[2].split('|')
-            base = self._eval(parts[0], ns, pos)
-            for part in parts[1:]:
-                func = self._eval(part, ns, pos)
-                base = func(base)
-            out.append(self._repr(base, pos))
-        elif name == 'default':
-            var, expr = code[2], code[3]
-            if var not in ns:
-                result = self._eval(expr, ns, pos)
-                ns[var] = result
-        elif name == 'comment':
-            return
-        else:
-            assert 0, "Unknown code: %r" % name
-
-    def _interpret_for(self, vars, expr, content, ns, out):
+    def _generate(self, ns):
         __traceback_hide__ = True
-        for item in expr:
-            if len(vars) == 1:
-                ns[vars[0]] = item
-            else:
-                if len(vars) != len(item):
-                    raise ValueError(
-                        'Need %i items to unpack (got %i items)'
-                        % (len(vars), len(item)))
-                for name, value in zip(vars, item):
-                    ns[name] = value
-            try:
-                self._interpret_codes(content, ns, out)
-            except _TemplateContinue:
-                continue
-            except _TemplateBreak:
-                break
-
-    def _interpret_if(self, parts, ns, out):
+        if self._stream_compiled is None:
+            self._stream_compiled = self._compile(stream=True)
+        parts = []
+        gen = self._call(self._stream_compiled, ns, parts.append)
+        size = counted = 0
+        try:
+            while True:
+                try:
+                    next(gen)
+                except StopIteration:
+                    break
+                except:
+                    self._reraise(self._stream_compiled)
+                size += sum(map(len, parts[counted:]))
+                counted = len(parts)
+                if size >= self.flush_size:
+                    chunk = ''.join(parts)
+                    del parts[:]
+                    size = counted = 0
+                    yield self._encode(chunk)
+            if parts:
+                yield self._encode(''.join(parts))
+        finally:
+            gen.close()
+
+    def _encode(self, chunk):
+        if isinstance(chunk, six.text_type):
+            chunk = chunk.encode(self.default_encoding)
+        return chunk
+
+    def _compile(self, stream=False):
+        """
+        Compiles the template, returning ``(code, positions, codes)``;
+        see ``_TemplateCompiler``.
+        """
+        compiler = _TemplateCompiler(self.name, stream=stream)
+        source, positions, codes = compiler.compile(self._parsed)
+        return compiler.code, positions, codes
+
+    def _call(self, compiled, ns, write):
+        """
+        Calls the compiled template with ``ns`` as its globals,
+        passing each piece of output to ``write``.
+        """
         __traceback_hide__ = True
-        # @@: if/else/else gets through
-        for part in parts:
-            assert not isinstance(part, six.string_types)
-            name, pos = part[0], part[1]
-            if name == 'else':
-                result = True
-            else:
-                result = self._eval(part[2], ns, pos)
-            if result:
-                self._interpret_codes(part[3], ns, out)
-                break
-
-    def _eval(self, code, ns, pos):
+        code, positions, codes = compiled
+        if '__builtins__' not in ns:
+            ns['__builtins__'] = builtins
+        func = FunctionType(code, ns)
+        return func(ns, write, self._repr, eval, six.exec_, codes,
+                    _assign_loop_vars)
+
+    def _reraise(self, compiled):
+        """
+        Re-raises the current exception, with the position in the
+        template of the line of compiled code it came from.
+        """
         __traceback_hide__ = True
-        try:
-            value = eval(code, ns)
-            return value
-        except:
-            exc_info = sys.exc_info()
-            e = exc_info[1]
+        code, positions, codes = compiled
+        exc_info = sys.exc_info()
+        pos = None
+        tb = exc_info[2]
+        while tb is not None:
+            if tb.tb_frame.f_code is code:
+                pos = positions[tb.tb_lineno]
+            tb = tb.tb_next
+        e = exc_info[1]
+        if pos is not None:
             if getattr(e, 'args'):
                 arg0 = e.args[0]
             else:
                 arg0 = str(e)
             e.args = (self._add_line_info(arg0, pos),)
-            six.reraise(exc_info[0], e, exc_info[2])
-
-    def _exec(self, code, ns, pos):
-        __traceback_hide__ = True
-        try:
-            six.exec_(code, ns)
-        except:
-            exc_info = sys.exc_info()
-            e = exc_info[1]
-            e.args = (self._add_line_info(e.args[0], pos),)
-            six.reraise(exc_info[0], e, exc_info[2])
+        six.reraise(exc_info[0], e, exc_info[2])
 
     def _repr(self, value, pos):
         __traceback_hide__ = True
@@ -260,6 +274,101 @@ class Template(object):
             msg += " in file %s" % self.name
         return msg
 
+class TemplateLoader(object):
+    """
+    A cache of templates loaded from files, keyed by absolute path
+    (plus template class and encoding), so a template is only read,
+    parsed and compiled again when its file changes.  One loader can be
+    shared by many threads.
+
+    A cached file is checked (with ``os.stat``) at most once every
+    ``check_interval`` seconds, so changes can take that long to show
+    up.  The least recently used templates are dropped to keep the
+    cache to ``max_templates``.  ``hits`` and ``misses`` count lookups.
+    On Python 3 files are decoded with the template class's
+    ``default_encoding`` unless an ``encoding`` is given.
+
+    Use it like::
+
+        loader = TemplateLoader(HTMLTemplate)
+        tmpl = loader.load('page.html')
+        # or HTMLTemplate.from_filename('page.html', loader=loader)
+    """
+
+    def __init__(self, template_class=None, max_templates=200,
+                 check_interval=1, encoding=None):
+        self.template_class = template_class or Template
+        self.max_templates = max_templates
+        self.check_interval = check_interval
+        self.encoding = encoding
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, filename, namespace=None, encoding=None,
+             template_class=None):
+        """
+        Returns the template in ``filename``.  The cached template is
+        shared, so if ``namespace`` is given you get a copy of it that
+        uses that namespace.
+        """
+        template_class = template_class or self.template_class
+        encoding = encoding or self.encoding
+        if encoding is None and six.PY3:
+            # Templates can't be parsed from bytes
+            encoding = template_class.default_encoding
+        filename = os.path.abspath(filename)
+        key = (filename, template_class, encoding)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+        if entry is not None and self.fresh(filename, entry, now):
+            with self.lock:
+                self.hits += 1
+            return self.bind(entry[0], namespace)
+        with self.lock:
+            self.misses += 1
+        # Stat before reading, so a change made while reading is
+        # picked up by the next check
+        stamp = self.stamp(filename)
+        tmpl = template_class.from_filename(filename, encoding=encoding)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = [tmpl, stamp, now]
+            while len(self.entries) > self.max_templates:
+                self.entries.popitem(last=False)
+        return self.bind(tmpl, namespace)
+
+    def fresh(self, filename, entry, now):
+        tmpl, stamp, checked = entry
+        if now - checked < self.check_interval:
+            return True
+        try:
+            if self.stamp(filename) != stamp:
+                return False
+        except OSError:
+            return False
+        entry[2] = now
+        return True
+
+    def stamp(self, filename):
+        st = os.stat(filename)
+        return (st.st_mtime, st.st_size)
+
+    def bind(self, tmpl, namespace):
+        if namespace is None:
+            return tmpl
+        tmpl = copy.copy(tmpl)
+        tmpl.namespace = namespace
+        return tmpl
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
 def sub(content, **kw):
     name = kw.get('__name')
     tmpl = Template(content, name=name)
@@ -370,6 +479,201 @@ def sub_html(content, **kw):
     return tmpl.substitute(kw)
 
 
+############################################################
+## Compiling
+############################################################
+
+def _assign_loop_vars(ns, vars, item):
+    if len(vars) == 1:
+        ns[vars[0]] = item
+    else:
+        if len(vars) != len(item):
+            raise ValueError(
+                'Need %i items to unpack (got %i items)'
+                % (len(vars), len(item)))
+        for name, value in zip(vars, item):
+            ns[name] = value
+
+class _TemplateCompiler(object):
+
+    """
+    Turns a parsed template into a single Python function::
+
+        __template(__ns, __write, __repr, __eval, __exec, __codes, __assign)
+
+    which is run with the template namespace as its globals, so
+    expressions are compiled once into plain name lookups and calls,
+    and ``{{for}}``/``{{if}}`` become real ``for`` and ``if``
+    statements.  Expressions that don't compile on their own are left
+    to ``eval`` at render time, so their errors show up when (and
+    if) they are reached, as they always have.  So are expressions
+    that call ``locals()``, ``vars()`` or ``dir()``, which would
+    otherwise see the function's variables instead of the namespace.
+    Names bound with ``:=`` are declared global, so they go into the
+    namespace as they do with ``eval``.
+
+    With ``stream`` the function is a generator, yielding (nothing)
+    at block boundaries so ``Template.generate`` can send what has
+    been written so far.
+
+    ``compile`` returns the source, a list mapping each line of it to
+    the template position it came from (or None), and the code
+    objects of the ``{{py:}}`` blocks.
+    """
+
+    header = ('def __template(__ns, __write, __repr, __eval, __exec, '
+              '__codes, __assign):')
+    # Expressions using these see the function's scope, not the
+    # namespace, so they are left to eval()
+    scope_names = ('locals', 'vars', 'dir')
+
+    def __init__(self, name=None, stream=False):
+        self.name = name
+        self.stream = stream
+        self.filename = '<template %s>' % (name or hex(id(self))[2:])
+
+    def compile(self, parsed):
+        self.lines = []
+        self.positions = []
+        self.codes = []
+        self.globals = set()
+        self.indent = 1
+        self.compile_codes(parsed)
+        if self.stream:
+            # Makes sure it's a generator, even with no blocks
+            self.emit('yield')
+        head = [self.header, '    __traceback_hide__ = True']
+        if self.globals:
+            head.append('    global %s' % ', '.join(sorted(self.globals)))
+        source = '\n'.join(head + self.lines) + '\n'
+        ns = {}
+        six.exec_(compile(source, self.filename, 'exec'), ns)
+        self.code = ns['__template'].__code__
+        # Line numbers start at 1
+        positions = [None] * (len(head) + 1) + self.positions
+        return source, positions, self.codes
+
+    def emit(self, line, pos=None):
+        # Continuation lines are inside brackets, and mustn't be
+        # indented (they may be in the middle of a string)
+        self.lines.append('    ' * self.indent + line)
+        self.positions.extend([pos] * (line.count('\n') + 1))
+
+    def value(self, source):
+        """
+        Python for the value of the expression ``source``
+        """
+        source = source.lstrip(' \t')
+        try:
+            compile(source, '<string>', 'eval')
+            tree = ast.parse(source, mode='eval')
+        except SyntaxError:
+            return '__eval(%r, __ns)' % source
+        named_expr = getattr(ast, 'NamedExpr', None)
+        bound = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node.id in self.scope_names:
+                return '__eval(%r, __ns)' % source
+            if named_expr is not None and isinstance(node, named_expr):
+                bound.add(node.target.id)
+        self.globals.update(bound)
+        return '(%s\n)' % source
+
+    def compile_codes(self, codes):
+        start = len(self.lines)
+        text = []
+        for item in codes:
+            if isinstance(item, six.string_types):
+                text.append(item)
+                continue
+            if item[0] == 'comment':
+                continue
+            if ''.join(text):
+                self.emit('__write(%r)' % ''.join(text))
+            text = []
+            getattr(self, 'compile_%s' % item[0])(item)
+            if (self.stream and self.indent == 1
+                and item[0] in ('for', 'cond')):
+                self.emit('yield')
+        if ''.join(text):
+            self.emit('__write(%r)' % ''.join(text))
+        if len(self.lines) == start:
+            self.emit('pass')
+
+    def compile_body(self, codes):
+        self.indent += 1
+        self.compile_codes(codes)
+        self.indent -= 1
+
+    def compile_loop_body(self, codes, vars=None, pos=None):
+        self.indent += 1
+        if self.stream:
+            # At the start, so {{continue}} doesn't skip it
+            self.emit('yield')
+        if vars is not None:
+            self.emit('__assign(__ns, %r, __item)' % (vars,), pos)
+        self.compile_codes(codes)
+        self.indent -= 1
+
+    def compile_py(self, code):
+        pos, source = code[1], code[2]
+        try:
+            compiled = compile(source, '<string>', 'exec')
+        except SyntaxError:
+            self.emit('__exec(%r, __ns)' % source, pos)
+        else:
+            self.codes.append(compiled)
+            self.emit('__exec(__codes[%i], __ns)' % (len(self.codes) - 1),
+                      pos)
+
+    def compile_continue(self, code):
+        self.emit('continue')
+
+    def compile_break(self, code):
+        self.emit('break')
+
+    def compile_for(self, code):
+        pos, vars, source, content = code[1], code[2], code[3], code[4]
+        simple = True
+        for var in vars:
+            if (not var_re.search(var) or keyword.iskeyword(var)
+                or var.startswith('__')):
+                simple = False
+        if simple:
+            self.globals.update(vars)
+            self.emit('for %s in %s:' % (', '.join(vars),
+                                         self.value(source)), pos)
+            self.compile_loop_body(content)
+        else:
+            self.emit('for __item in %s:' % self.value(source), pos)
+            self.compile_loop_body(content, vars, pos)
+
+    def compile_cond(self, code):
+        for part in code[2:]:
+            kind, pos, source, content = part
+            if kind == 'else':
+                self.emit('else:')
+                self.compile_body(content)
+                # Anything after the first else can't be reached
+                break
+            self.emit('%s %s:' % (kind, self.value(source)), pos)
+            self.compile_body(content)
+
+    def compile_expr(self, code):
+        pos, parts = code[1], code[2].split('|')
+        self.emit('__v = %s' % self.value(parts[0]), pos)
+        for part in parts[1:]:
+            self.emit('__v = %s(__v)' % self.value(part), pos)
+        # _repr adds the position to its own errors
+        self.emit('__write(__repr(__v, %r))' % (pos,))
+
+    def compile_default(self, code):
+        pos, var, source = code[1], code[2], code[3]
+        self.emit('if %r not in __ns:' % var)
+        self.indent += 1
+        self.emit('__ns[%r] = %s' % (var, self.value(source)), pos)
+        self.indent -= 1
+
 ############################################################
 ## Lexing and Parsing
 ############################################################
@@ -18,7 +18,7 @@ import six
 
 from paste.request import EnvironHeaders, get_cookie_dict, \
     parse_dict_querystring, parse_formvars
-from paste.util.multidict import MultiDict, UnicodeMultiDict
+from paste.util.multidict import IndexedMultiDict, UnicodeMultiDict
 from paste.registry import StackedObjectProxy
 from paste.response import HeaderDict
 from paste.wsgilib import encode_unicode_app_iter
@@ -241,7 +241,7 @@ class WSGIRequest(object):
         Returns a ``MultiDict`` container or a ``UnicodeMultiDict`` when
         ``charset`` is set.
         """
-        params = MultiDict()
+        params = IndexedMultiDict()
         params.update(self._POST())
         params.update(self._GET())
         if self.charset:
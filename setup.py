@@ -73,6 +73,7 @@ setup(name="Paste",
       test_slow = paste.debug.debugapp:make_slow_app
       transparent_proxy = paste.proxy:make_transparent_proxy
       watch_threads = paste.debug.watchthreads:make_watch_threads
+      server_metrics = paste.debug.metrics:make_server_metrics
 
       [paste.composite_factory]
       urlmap = paste.urlmap:urlmap_factory
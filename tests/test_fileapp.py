@@ -1,16 +1,21 @@
 # (c) 2005 Ian Bicking, Clark C. Evans and contributors
 # This module is part of the Python Paste Project and is released under
 # the MIT License: http://www.opensource.org/licenses/mit-license.php
+import email
+import gzip
+import mimetypes
 import time
 import random
 import os
 import tempfile
+import zipfile
 try:
     # Python 3
     from email.utils import parsedate_tz, mktime_tz
 except ImportError:
     # Python 2
     from rfc822 import parsedate_tz, mktime_tz
+import pytest
 import six
 
 from paste import fileapp
@@ -163,9 +168,13 @@ def _excercize_range(build,content):
     assert res.header('accept-ranges') == 'bytes'
     assert res.body == content
     assert res.header('content-length') == str(len(content))
-    res = build("bytes=-%d" % (len(content)-1))
+    res = build("bytes=-%d" % len(content))
     assert res.body == content
     assert res.header('content-length') == str(len(content))
+    # the last bytes
+    res = build("bytes=-%d" % (len(content)-1))
+    assert res.body == content[1:]
+    assert res.header('content-length') == str(len(content)-1)
     res = build("bytes=0-")
     assert res.body == content
     assert res.header('content-length') == str(len(content))
@@ -188,7 +197,65 @@ def test_range():
         app = DataApp(content)
         return TestApp(app).get("/",headers={'Range': range}, status=status)
     _excercize_range(build,content)
-    build('bytes=0-%d' % (len(content)+1), 416)
+    # ranges past the end are cut short
+    res = build('bytes=0-%d' % (len(content)+1))
+    assert res.body == content
+    res = build('bytes=%d-' % len(content), 416)
+    assert res.header('content-range') == 'bytes */%d' % len(content)
+    # an invalid header is ignored
+    res = build('bytes=5-3', 200)
+    assert res.body == content
+
+def _parse_multipart(res):
+    content_type = res.header('content-type')
+    assert content_type.startswith('multipart/byteranges; boundary=')
+    assert int(res.header('content-length')) == len(res.body)
+    msg = email.message_from_bytes(
+        b'Content-Type: ' + content_type.encode('ascii') + b'\r\n\r\n'
+        + res.body)
+    return [(part['Content-Range'], part.get_payload(decode=True))
+            for part in msg.get_payload()]
+
+def _excercize_multirange(build, content):
+    length = len(content)
+    res = build('bytes=0-1,-2')
+    assert _parse_multipart(res) == [
+        ('bytes 0-1/%d' % length, content[:2]),
+        ('bytes %d-%d/%d' % (length-2, length-1, length), content[-2:])]
+    # overlapping and adjacent ranges are joined
+    res = build('bytes=10-19, 0-4, 3-6, 7-8')
+    assert _parse_multipart(res) == [
+        ('bytes 0-8/%d' % length, content[:9]),
+        ('bytes 10-19/%d' % length, content[10:20])]
+    res = build('bytes=0-4,5-9')
+    assert res.body == content[:10]
+    assert res.header('content-range') == 'bytes 0-9/%d' % length
+
+@pytest.mark.skipif(not six.PY3, reason='email.message_from_bytes')
+def test_multirange():
+    content = (LETTERS * 5).encode('utf8')
+    def build(range, status=206):
+        app = DataApp(content)
+        return TestApp(app).get("/",headers={'Range': range}, status=status)
+    _excercize_multirange(build, content)
+
+def test_if_range():
+    content = (LETTERS * 5).encode('utf8')
+    app = TestApp(DataApp(content))
+    res = app.get('/')
+    etag = res.header('ETag')
+    last_mod = res.header('Last-Modified')
+    res = app.get('/', headers={'Range': 'bytes=0-9', 'If-Range': etag},
+                  status=206)
+    assert res.body == content[:10]
+    res = app.get('/', headers={'Range': 'bytes=0-9', 'If-Range': last_mod},
+                  status=206)
+    assert res.body == content[:10]
+    for other in ('"other"', 'W/' + etag, 'Sat, 1 Jan 2005 12:00:00 GMT',
+                  'junk'):
+        res = app.get('/', headers={'Range': 'bytes=0-9', 'If-Range': other},
+                      status=200)
+        assert res.body == content
 
 def test_file_range():
     tempfile = "test_fileapp.%s.txt" % (random.random())
@@ -204,6 +271,8 @@ def test_file_range():
             return TestApp(app).get("/",headers={'Range': range},
                                         status=status)
         _excercize_range(build,content)
+        if six.PY3:
+            _excercize_multirange(build, content)
         for size in (13,len(LETTERS), len(LETTERS)-1):
             fileapp.BLOCK_SIZE = size
             _excercize_range(build,content)
@@ -230,6 +299,33 @@ def test_file_cache():
     res = app.get('/', headers={'If-Modified-Since': 'invalid date'},
                   status=400)
 
+def test_file_update_is_atomic(tmpdir, monkeypatch):
+    path = tmpdir.join('data.txt')
+    path.write(b'old', mode='wb')
+    os.utime(str(path), (1000, 1000))
+    app = fileapp.FileApp(str(path))
+    app.update()
+    old_etag = app.calculate_etag()
+    path.write(b'new!', mode='wb')
+    os.utime(str(path), (2000, 2000))
+    last_checked = app.last_checked
+    seen = []
+    def open_file(filename, mode='r'):
+        # While the new version is read, others still see the old one
+        seen.append((app.calculate_etag(), app.content, app.last_checked))
+        return open(filename, mode)
+    monkeypatch.setattr(fileapp, 'open', open_file, raising=False)
+    app.check_interval = 60
+    app.update(force=True)
+    assert seen == [(old_etag, b'old', last_checked)]
+    assert app.content == b'new!'
+    assert app.last_modified == 2000
+    assert app.calculate_etag() != old_etag
+    res = TestApp(app).get('/')
+    assert res.body == b'new!'
+    assert res.header('Last-Modified').startswith(
+        'Thu, 01 Jan 1970 00:33:20')
+
 def test_methods():
     filename = os.path.join(os.path.dirname(__file__),
                             'urlparser_data', 'secured.txt')
@@ -240,3 +336,133 @@ def test_methods():
     assert not res.body
     app.post('', status=405) # Method Not Allowed
 
+
+def test_precompressed():
+    dirname = tempfile.mkdtemp()
+    filename = os.path.join(dirname, 'app.js')
+    with open(filename, 'wb') as fp:
+        fp.write(b'var x = 1;\n' * 100)
+    with open(filename + '.gz', 'wb') as fp:
+        fp.write(b'gzipped')
+    try:
+        app = TestApp(fileapp.FileApp(filename, precompressed=True))
+        res = app.get('/', headers={'Accept-Encoding': 'gzip, deflate'})
+        assert res.body == b'gzipped'
+        assert res.header('Content-Encoding') == 'gzip'
+        assert res.header('Vary') == 'Accept-Encoding'
+        assert res.header('Content-Type').startswith(
+            mimetypes.guess_type(filename)[0])
+        gzip_etag = res.header('ETag')
+        app.get('/', headers={'Accept-Encoding': 'gzip',
+                              'If-None-Match': gzip_etag}, status=304)
+        res = app.get('/', headers={'Accept-Encoding': 'br, gzip;q=0'})
+        assert res.body == b'var x = 1;\n' * 100
+        assert res.header('Content-Encoding', None) is None
+        assert res.header('Vary') == 'Accept-Encoding'
+        assert res.header('ETag') != gzip_etag
+        # An out of date .gz file isn't used
+        os.utime(filename + '.gz', (time.time() - 100, time.time() - 100))
+        res = app.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert res.header('Content-Encoding', None) is None
+    finally:
+        os.unlink(filename + '.gz')
+        os.unlink(filename)
+        os.rmdir(dirname)
+
+def test_compressed_cache():
+    fd, filename = tempfile.mkstemp(suffix='.txt')
+    os.write(fd, b'line of text\n' * 200)
+    os.close(fd)
+    try:
+        cache = fileapp.CompressedCache(max_size=100)
+        app = TestApp(fileapp.FileApp(filename, compressed_cache=cache))
+        res = app.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert res.header('Content-Encoding') == 'gzip'
+        assert gzip.GzipFile(fileobj=six.BytesIO(res.body)).read() == \
+            b'line of text\n' * 200
+        assert int(res.header('Content-Length')) == len(res.body)
+        assert list(cache.entries) == [(filename, os.stat(filename).st_mtime,
+                                        2600)]
+        assert cache.size == len(res.body)
+        # A changed file is compressed again, and the cache stays bounded
+        with open(filename, 'wb') as fp:
+            fp.write(b'other text\n' * 200)
+        os.utime(filename, (time.time() + 10, time.time() + 10))
+        res = app.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert gzip.GzipFile(fileobj=six.BytesIO(res.body)).read() == \
+            b'other text\n' * 200
+        assert len(cache.entries) == 1
+        assert cache.size <= cache.max_size
+    finally:
+        os.unlink(filename)
+
+def test_file_mmap():
+    fd, filename = tempfile.mkstemp()
+    content = (LETTERS * 200).encode('ascii')
+    assert len(content) > fileapp.CACHE_SIZE
+    os.write(fd, content)
+    os.close(fd)
+    try:
+        fa = fileapp.FileApp(filename, use_mmap=True)
+        app = TestApp(fa)
+        res = app.get('/')
+        assert res.body == content
+        assert isinstance(fa.content, memoryview)
+        res = app.get('/', headers={'Range': 'bytes=100-199'}, status=206)
+        assert res.body == content[100:200]
+        # Middleware (and lint) get bytes, even under paste.httpserver
+        from paste.lint import middleware
+        extra = {'paste.httpserver.buffers': True}
+        app = TestApp(middleware(fa))
+        assert app.get('/', extra_environ=extra).body == content
+        res = app.get('/', headers={'Range': 'bytes=100-199,300-399'},
+                      extra_environ=extra, status=206)
+        assert content[100:200] in res.body
+        assert content[300:400] in res.body
+    finally:
+        os.unlink(filename)
+
+def test_archive_store():
+    fd, filename = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    archive = zipfile.ZipFile(filename, 'w')
+    archive.writestr(zipfile.ZipInfo('stored.txt'), b'stored' * 100)
+    info = zipfile.ZipInfo('deflated.txt')
+    info.compress_type = zipfile.ZIP_DEFLATED
+    archive.writestr(info, b'deflated' * 100)
+    archive.writestr(zipfile.ZipInfo('other.txt'), b'other')
+    archive.close()
+    try:
+        store = ArchiveStore(filename, cache_size=1000)
+        app = TestApp(store)
+        res = app.get('/stored.txt')
+        assert res.body == b'stored' * 100
+        assert isinstance(store.cache['stored.txt'].content, memoryview)
+        res = app.get('/stored.txt', headers={'Range': 'bytes=6-11'},
+                      status=206)
+        assert res.body == b'stored'
+        assert app.get('/deflated.txt').body == b'deflated' * 100
+        assert store.cached_bytes == 800
+        # Without the mapping, stored items count too; only 1000 bytes
+        # of content are kept
+        store.mapping = None
+        store.cache.pop('stored.txt')
+        assert app.get('/stored.txt').body == b'stored' * 100
+        assert store.cached_bytes == 600
+        assert list(store.cache) == ['stored.txt']
+        # Iterating always gives bytes; paste.httpserver can ask for
+        # the mapping itself
+        mapped = ArchiveStore(filename)
+        res = mapped({'PATH_INFO': '/stored.txt', 'REQUEST_METHOD': 'GET',
+                      'wsgi.version': (1, 0),
+                      'paste.httpserver.buffers': True},
+                     lambda status, headers: None)
+        assert b''.join(res) == b'stored' * 100
+        buffers = res.httpserver_buffers()
+        assert isinstance(buffers[0], memoryview)
+        assert buffers[0].tobytes() == b'stored' * 100
+        mapped.archive.close()
+        app.get('/missing.txt', status=404)
+    finally:
+        store.archive.close()
+        os.unlink(filename)
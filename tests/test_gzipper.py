@@ -17,3 +17,38 @@ def test_gzip():
     assert res.body != b'this is a test'
     actual = gzip.GzipFile(fileobj=six.BytesIO(res.body)).read()
     assert actual == b'this is a test'
+
+def csv_app(environ, start_response):
+    start_response('200 OK', [('content-type', 'text/csv')])
+    for i in range(1000):
+        yield ('%s,row %s\n' % (i, i)).encode('ascii')
+
+def test_gzip_streaming():
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started.append(dict(headers))
+    app_iter = middleware(csv_app, streaming=True, flush_size=1024)(
+        {'HTTP_ACCEPT_ENCODING': 'gzip'}, start_response)
+    chunks = list(app_iter)
+    app_iter.close()
+    assert started[0]['content-encoding'] == 'gzip'
+    assert 'content-length' not in started[0]
+    # Flushed as it goes, rather than in one piece at the end
+    assert len(chunks) > 5
+    expected = b''.join(csv_app({}, lambda *args: None))
+    assert gzip.GzipFile(fileobj=six.BytesIO(b''.join(chunks))).read() \
+        == expected
+
+def test_gzip_min_size_and_types():
+    small_app = TestApp(middleware(simple_app, min_size=100))
+    res = small_app.get(
+        '/', extra_environ=dict(HTTP_ACCEPT_ENCODING='gzip'))
+    assert res.body == b'this is a test'
+    assert res.header('content-encoding', None) is None
+    def pdf_app(environ, start_response):
+        start_response('200 OK', [('content-type', 'application/pdf')])
+        return [b'%PDF' * 100]
+    res = TestApp(middleware(pdf_app, streaming=True)).get(
+        '/', extra_environ=dict(HTTP_ACCEPT_ENCODING='gzip'))
+    assert res.body == b'%PDF' * 100
+    assert res.header('content-encoding', None) is None
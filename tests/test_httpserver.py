@@ -1,11 +1,21 @@
 import email
 import io
+import os
+import signal
 import socket
+import subprocess
+import sys
+import threading
+import time
 
+import pytest
 import six
 
-from paste.httpserver import LimitedLengthFile, WSGIHandler
+from paste.httpserver import (
+    FastWSGIHandler, LimitedLengthFile, PreforkSupervisor, ThreadPool,
+    WSGIHandler, serve)
 from six.moves import StringIO
+from six.moves.http_client import HTTPConnection
 
 
 class MockServer(object):
@@ -72,3 +82,605 @@ def test_limited_length_file_tell_on_socket():
     assert f.read() == b'123456789'
     assert f.tell() == 10
     backing_read.close()
+
+
+def _start_server(app, handler_class=WSGIHandler, **kwargs):
+    class Handler(handler_class):
+        pass
+    kwargs.setdefault('protocol_version', 'HTTP/1.1')
+    server = serve(app, host='127.0.0.1', port=0, handler=Handler,
+                   start_loop=False, daemon_threads=True, **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _simple_app(environ, start_response):
+    body = environ['PATH_INFO'].encode('ascii')
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def test_event_loop_idle_keepalive():
+    server = _start_server(_simple_app, use_event_loop=True,
+                           threadpool_workers=1,
+                           threadpool_options={'spawn_if_under': 0})
+    host, port = server.server_address[:2]
+    try:
+        idle = HTTPConnection(host, port, timeout=5)
+        idle.request('GET', '/first')
+        assert idle.getresponse().read() == b'/first'
+        # The single worker is not pinned by the idle connection
+        other = HTTPConnection(host, port, timeout=5)
+        other.request('GET', '/other')
+        assert other.getresponse().read() == b'/other'
+        idle.request('GET', '/again')
+        assert idle.getresponse().read() == b'/again'
+        idle.close()
+        other.close()
+    finally:
+        server.server_close()
+
+
+def test_event_loop_pipelined_requests():
+    server = _start_server(_simple_app, use_event_loop=True)
+    host, port = server.server_address[:2]
+    try:
+        sock = socket.create_connection((host, port), timeout=5)
+        sock.sendall(b'GET /a HTTP/1.1\r\nHost: x\r\n\r\n'
+                     b'GET /b HTTP/1.1\r\nHost: x\r\n\r\n')
+        data = b''
+        while not data.endswith(b'/b'):
+            chunk = sock.recv(4096)
+            assert chunk
+            data += chunk
+        assert data.count(b'200 OK') == 2
+        assert b'\r\n\r\n/a' in data
+        sock.close()
+    finally:
+        server.server_close()
+
+
+def _parse_with(handler_class, raw_request):
+    handler = handler_class.__new__(handler_class)
+    handler.server = MockServer()
+    handler.client_address = ('1.2.3.4', 1234)
+    handler.connection = MockSocket()
+    handler.rfile = io.BytesIO(raw_request)
+    handler.wfile = io.BytesIO()
+    handler.raw_requestline = handler.rfile.readline()
+    assert handler.parse_request()
+    handler.wsgi_setup()
+    environ = handler.wsgi_environ
+    del environ['wsgi.input']
+    del environ['paste.httpserver.flush']
+    return environ
+
+
+def test_fast_handler_environ_matches():
+    for raw in [b'GET /path HTTP/1.0\r\nHost: mywebsite\r\n\r\n',
+                b'GET /a%20b/?x=1&y=2 HTTP/1.1\r\n'
+                b'Host: host1\r\nHost: host2\r\n'
+                b'Content-Type: text/plain\r\nContent-Length: 4\r\n\r\nbody',
+                b'POST /a/./b/../c//d/ HTTP/1.0\r\n'
+                b'Content-Type: a\r\nContent-Type: b\r\n\r\n',
+                b'GET /x#frag HTTP/1.0\r\nAccept: */*\r\n\r\n']:
+        expected = _parse_with(WSGIHandler, raw)
+        environ = _parse_with(FastWSGIHandler, raw)
+        assert environ == expected
+
+
+def test_fast_handler_headers_message():
+    handler = FastWSGIHandler.__new__(FastWSGIHandler)
+    handler.rfile = io.BytesIO(b'Host: h\r\nAccept: a\r\n'
+                               b'X-Folded: one\r\n two\r\n\r\n')
+    handler.wfile = io.BytesIO()
+    handler.raw_requestline = b'GET / HTTP/1.0\r\n'
+    assert handler.parse_request()
+    assert handler.headers['Accept'] == 'a'
+    assert handler.wsgi_request_headers['HTTP_HOST'] == 'h'
+    # Folded lines are joined with a space, as RFC 7230 asks
+    assert handler.wsgi_request_headers['HTTP_X_FOLDED'] == 'one two'
+
+
+def test_fast_handler_too_many_headers():
+    handler = FastWSGIHandler.__new__(FastWSGIHandler)
+    handler.rfile = io.BytesIO(b'X-A: b\r\n' * 101 + b'\r\n')
+    handler.wfile = io.BytesIO()
+    handler.request_version = 'HTTP/1.0'
+    handler.raw_requestline = b'GET / HTTP/1.0\r\n'
+    assert not handler.parse_request()
+    assert b' 431 ' in handler.wfile.getvalue()
+
+
+def test_fast_handler_served():
+    server = _start_server(_simple_app, handler_class=FastWSGIHandler)
+    host, port = server.server_address[:2]
+    try:
+        conn = HTTPConnection(host, port, timeout=5)
+        for path in ['/one', '/two%21']:
+            conn.request('GET', path)
+            assert conn.getresponse().read() == path.replace('%21', '!').encode()
+        conn.close()
+    finally:
+        server.server_close()
+
+
+class RecordingSocket(object):
+    def __init__(self, max_send=None):
+        self.max_send = max_send
+        self.calls = 0
+        self.data = b''
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        data = b''.join(bytes(b) for b in buffers)[:self.max_send]
+        self.data += data
+        return len(data)
+
+    def write(self, data):
+        self.data += data
+
+
+def _run_app(app, connection, raw=b'GET / HTTP/1.0\r\n\r\n',
+             protocol_version='HTTP/1.0'):
+    handler = WSGIHandler.__new__(WSGIHandler)
+    handler.protocol_version = protocol_version
+    handler.server = MockServer()
+    handler.server.wsgi_application = app
+    handler.client_address = ('1.2.3.4', 1234)
+    handler.connection = connection
+    handler.rfile = io.BytesIO(raw)
+    handler.wfile = connection
+    handler.raw_requestline = handler.rfile.readline()
+    assert handler.parse_request()
+    handler.wsgi_execute()
+    return connection.data
+
+
+def _chunked_app(environ, start_response):
+    start_response('200 OK', [('Content-Length', '1000')])
+    return [b'0123456789'] * 100
+
+
+def test_coalesced_writes():
+    connection = RecordingSocket()
+    data = _run_app(_chunked_app, connection)
+    assert connection.calls == 1
+    assert data.startswith(b'HTTP/1.0 200 OK\r\n')
+    assert data.endswith(b'\r\n\r\n' + b'0123456789' * 100)
+
+
+def test_coalesced_partial_writes():
+    connection = RecordingSocket(max_send=7)
+    data = _run_app(_chunked_app, connection)
+    assert connection.calls > 1
+    assert data.endswith(b'\r\n\r\n' + b'0123456789' * 100)
+
+
+def test_flush_and_write_send_immediately():
+    sent = []
+
+    def app(environ, start_response):
+        write = start_response('200 OK', [('Content-Length', '6')])
+        write(b'ab')
+        sent.append(connection.data)
+        yield b'cd'
+        environ['paste.httpserver.flush']()
+        sent.append(connection.data)
+        yield b'ef'
+
+    connection = RecordingSocket()
+    data = _run_app(app, connection)
+    assert sent[0].endswith(b'\r\n\r\nab')
+    assert sent[1].endswith(b'\r\n\r\nabcd')
+    assert data.endswith(b'\r\n\r\nabcdef')
+
+
+def test_error_before_output_sends_500():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Length', '6')])
+        yield b'ab'
+        raise ValueError('broken')
+
+    connection = RecordingSocket()
+    try:
+        _run_app(app, connection)
+    except ValueError:
+        pass
+    else:
+        assert False, 'error was swallowed'
+    assert connection.data.startswith(b'HTTP/1.0 500 ')
+
+
+def _generator_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    yield b'hello '
+    yield b''
+    yield environ['PATH_INFO'].encode('ascii')
+
+
+def test_chunked_response():
+    connection = RecordingSocket()
+    data = _run_app(_generator_app, connection,
+                    raw=b'GET /x HTTP/1.1\r\nHost: h\r\n\r\n',
+                    protocol_version='HTTP/1.1')
+    head, body = data.split(b'\r\n\r\n', 1)
+    assert b'Transfer-Encoding: chunked' in head
+    assert b'Connection: close' not in head
+    assert body == b'8\r\nhello /x\r\n0\r\n\r\n'
+
+
+def test_http10_response_without_length_closes():
+    connection = RecordingSocket()
+    data = _run_app(_generator_app, connection,
+                    raw=b'GET /x HTTP/1.0\r\n\r\n',
+                    protocol_version='HTTP/1.1')
+    head, body = data.split(b'\r\n\r\n', 1)
+    assert b'Connection: close' in head
+    assert b'chunked' not in head
+    assert body == b'hello /x'
+
+
+def test_head_response_has_no_body():
+    connection = RecordingSocket()
+    data = _run_app(_chunked_app, connection,
+                    raw=b'HEAD / HTTP/1.1\r\nHost: h\r\n\r\n',
+                    protocol_version='HTTP/1.1')
+    assert data.endswith(b'Content-Length: 1000\r\n\r\n')
+
+
+def test_chunked_keepalive():
+    server = _start_server(_generator_app)
+    host, port = server.server_address[:2]
+    try:
+        conn = HTTPConnection(host, port, timeout=5)
+        for path in ['/one', '/two']:
+            conn.request('GET', path)
+            res = conn.getresponse()
+            assert res.getheader('Transfer-Encoding') == 'chunked'
+            assert res.read() == b'hello ' + path.encode('ascii')
+        # Same connection for both requests
+        assert conn.sock is not None
+        conn.close()
+    finally:
+        server.server_close()
+
+
+def test_file_wrapper_sendfile(tmpdir, monkeypatch):
+    from paste.fileapp import FileApp
+    content = b''.join(b'%06d\n' % i for i in range(20000))
+    filename = tmpdir.join('data.txt')
+    filename.write(content, mode='wb')
+    used = []
+    orig_sendfile = socket.socket.sendfile
+
+    def sendfile(sock, file, offset=0, count=None):
+        used.append((offset, count))
+        return orig_sendfile(sock, file, offset, count)
+    monkeypatch.setattr(socket.socket, 'sendfile', sendfile)
+
+    server = _start_server(FileApp(str(filename)))
+    host, port = server.server_address[:2]
+    try:
+        conn = HTTPConnection(host, port, timeout=5)
+        conn.request('GET', '/')
+        assert conn.getresponse().read() == content
+        conn.request('GET', '/', headers={'Range': 'bytes=7-20'})
+        res = conn.getresponse()
+        assert res.status == 206
+        assert res.read() == content[7:21]
+        conn.close()
+    finally:
+        server.server_close()
+    assert used == [(0, len(content)), (7, 14)]
+
+
+def test_file_wrapper_range_through_middleware(tmpdir):
+    from paste.fileapp import FileApp
+    content = b''.join(b'%06d\n' % i for i in range(20000))
+    filename = tmpdir.join('data.txt')
+    filename.write(content, mode='wb')
+    file_app = FileApp(str(filename))
+
+    def middleware(environ, start_response):
+        # Iterates over the app_iter, so the server can't use sendfile
+        app_iter = file_app(environ, start_response)
+        try:
+            for chunk in app_iter:
+                yield chunk
+        finally:
+            app_iter.close()
+
+    server = _start_server(middleware)
+    host, port = server.server_address[:2]
+    try:
+        conn = HTTPConnection(host, port, timeout=5)
+        for first, last in [(0, 9), (7, 20), (100, 200)]:
+            conn.request('GET', '/', headers={
+                'Range': 'bytes=%s-%s' % (first, last)})
+            res = conn.getresponse()
+            assert res.status == 206
+            assert res.read() == content[first:last + 1]
+        # The connection is still in step
+        conn.request('GET', '/')
+        assert conn.getresponse().read() == content
+        conn.close()
+    finally:
+        server.server_close()
+
+
+def test_file_wrapper_fallback():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Length', '5')])
+        return environ['wsgi.file_wrapper'](io.BytesIO(b'0123456789'), 2)
+
+    connection = RecordingSocket()
+    data = _run_app(app, connection)
+    assert data.endswith(b'\r\n\r\n01234')
+
+
+def test_httpserver_buffers():
+    class Body(object):
+        def __iter__(self):
+            assert 0, 'The buffers should be used'
+        def httpserver_buffers(self):
+            return [memoryview(b'01234'), b'56789']
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Length', '10')])
+        return Body()
+
+    connection = RecordingSocket()
+    data = _run_app(app, connection)
+    assert data.endswith(b'\r\n\r\n0123456789')
+
+
+def test_file_wrapper_head():
+    read = []
+
+    class File(io.BytesIO):
+        def read(self, size=-1):
+            read.append(size)
+            return io.BytesIO.read(self, size)
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Length', '10')])
+        return environ['wsgi.file_wrapper'](File(b'0123456789'), 2)
+
+    connection = RecordingSocket()
+    data = _run_app(app, connection,
+                    raw=b'HEAD / HTTP/1.1\r\nHost: h\r\n\r\n',
+                    protocol_version='HTTP/1.1')
+    assert data.endswith(b'Content-Length: 10\r\n\r\n')
+    assert read == []
+
+
+def test_threadpool_supervisor():
+    pool = ThreadPool(2, daemon=True, hung_thread_limit=0.1,
+                      kill_thread_limit=0, spawn_if_under=1,
+                      supervisor_period=0.05)
+    release = threading.Event()
+    started = []
+    done = threading.Event()
+
+    def blocked():
+        started.append(1)
+        release.wait(5)
+
+    try:
+        pool.add_task(blocked)
+        pool.add_task(blocked)
+        for i in range(100):
+            if len(started) == 2 and pool._hung_count == 2:
+                break
+            time.sleep(0.02)
+        assert pool._hung_count == 2
+        # Both workers are hung, so a worker is added for this task
+        pool.add_task(done.set)
+        assert done.wait(5)
+    finally:
+        release.set()
+        pool.shutdown()
+    assert pool._supervisor_stop.is_set()
+
+
+def test_threadpool_supervisor_leaves_killing_to_add_task():
+    pool = ThreadPool(1, daemon=True, hung_thread_limit=0.05,
+                      kill_thread_limit=0.1, spawn_if_under=0,
+                      supervisor_period=0.05)
+    killed = []
+    pool.kill_worker = lambda thread_id: killed.append(
+        threading.current_thread())
+    release = threading.Event()
+    try:
+        pool.add_task(lambda: release.wait(5))
+        for i in range(100):
+            if pool._kill_hung_due:
+                break
+            time.sleep(0.02)
+        assert pool._kill_hung_due
+        # The supervisor only flags the hung worker...
+        assert killed == []
+        pool.add_task(lambda: None)
+        # ... and it is killed on the thread adding tasks
+        assert killed == [threading.current_thread()]
+        assert not pool._kill_hung_due
+    finally:
+        release.set()
+        pool.shutdown()
+
+
+def test_server_metrics():
+    import json
+    from paste.debug.metrics import ServerMetricsApp
+    from paste.urlmap import URLMap
+    app = URLMap()
+    app['/'] = _simple_app
+    app['/_metrics'] = ServerMetricsApp()
+    server = _start_server(app)
+    host, port = server.server_address[:2]
+    try:
+        conn = HTTPConnection(host, port, timeout=5)
+        for i in range(3):
+            conn.request('GET', '/x')
+            conn.getresponse().read()
+        conn.request('GET', '/_metrics')
+        data = json.loads(conn.getresponse().read().decode('utf-8'))
+        assert data['connections'] == 1
+        assert data['requests'] == 3
+        assert data['reused_requests'] == 2
+        assert data['bytes_out'] > 0
+        assert data['queue_wait_count'] == 1
+        assert data['busy_workers'] == 1
+        assert sum(data['worker_requests'].values()) == 1
+        assert set(data['response_time_percentiles']) == set(
+            ['0.5', '0.9', '0.99', '1.0'])
+        conn.request('GET', '/_metrics?format=prometheus')
+        text = conn.getresponse().read().decode('utf-8')
+        assert 'paste_httpserver_requests_total 4\n' in text
+        assert 'paste_httpserver_queue_wait_seconds_bucket{le="+Inf"} 1\n' in text
+        conn.close()
+    finally:
+        server.server_close()
+
+
+_prefork_script = """
+import os, sys
+from paste.httpserver import serve
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [('%s %s' % (os.getpid(), environ['wsgi.multiprocess'])).encode()]
+serve(app, port=int(sys.argv[1]), processes=2)
+"""
+
+
+def _worker_pids(port, wanted, timeout=15):
+    """Makes new connections until ``wanted(pids)`` is true"""
+    pids = set()
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            conn = HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/')
+            pid, multiprocess = conn.getresponse().read().split()
+            conn.close()
+        except (socket.error, ValueError):
+            time.sleep(0.1)
+            continue
+        assert multiprocess == b'True'
+        pids.add(int(pid))
+        if wanted(pids):
+            return pids
+    raise AssertionError('Only saw worker processes %s' % sorted(pids))
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork')
+                    or not hasattr(socket, 'SO_REUSEPORT'),
+                    reason='needs fork and SO_REUSEPORT')
+def test_prefork_processes():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    proc = subprocess.Popen([sys.executable, '-c', _prefork_script,
+                             str(port)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        first = _worker_pids(port, lambda pids: len(pids) == 2)
+        # A worker that dies is replaced
+        killed = first.pop()
+        os.kill(killed, signal.SIGKILL)
+        _worker_pids(port, lambda pids: pids - first - set([killed]))
+        # SIGHUP replaces every worker, one at a time
+        before = _worker_pids(port, lambda pids: len(pids) == 2)
+        proc.send_signal(signal.SIGHUP)
+        _worker_pids(port, lambda pids: len(pids - before) == 2)
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait() == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+
+
+class _FakePrefork(PreforkSupervisor):
+    """Workers are only pids; ``exits`` are reaped one per reap"""
+
+    restart_interval = 0
+
+    def __init__(self, pids, exits):
+        self.make_server = None
+        self.processes = len(pids)
+        self.logger = None
+        self.workers = dict((pid, 0) for pid in pids)
+        self.running = True
+        self.exits = list(exits)
+        self.next_pid = 100
+        self.log = []
+
+    def spawn_worker(self):
+        self.next_pid += 1
+        self.workers[self.next_pid] = 0
+        self.log.append(('spawn', self.next_pid))
+
+    def signal_worker(self, pid, signum):
+        self.log.append(('signal', pid))
+
+    def reap_workers(self, replace=False):
+        if self.exits:
+            pid = self.exits.pop(0)
+            del self.workers[pid]
+            self.log.append(('reaped', pid))
+            if replace:
+                self.spawn_worker()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_prefork_restart_replaces_exited_workers():
+    supervisor = _FakePrefork([1, 2, 3], exits=[3, 2])
+    supervisor.restart_workers()
+    assert supervisor.log == [
+        ('spawn', 101),
+        # Worker 3 died while 1 was being replaced
+        ('reaped', 3), ('spawn', 102),
+        ('signal', 1),
+        # And 2 while waiting for 1 to stop
+        ('reaped', 2), ('spawn', 103),
+        ]
+    assert sorted(supervisor.workers) == [101, 102, 103]
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_prefork_worker_stopped_while_starting():
+    class Server(object):
+        def __init__(self):
+            os.kill(os.getpid(), signal.SIGTERM)
+            self.running = True
+            self.served = self.closed = False
+        def serve_forever(self):
+            self.served = self.running
+        def server_close(self):
+            self.closed = True
+    servers = []
+    def make_server():
+        servers.append(Server())
+        return servers[-1]
+    supervisor = _FakePrefork([], [])
+    supervisor.make_server = make_server
+    previous = dict((signum, signal.getsignal(signum))
+                    for signum in (signal.SIGTERM, signal.SIGINT,
+                                   signal.SIGHUP))
+    try:
+        supervisor.run_worker()
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+    server, = servers
+    assert not server.running
+    assert not server.served
+    assert server.closed
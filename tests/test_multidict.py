@@ -4,14 +4,17 @@
 import cgi
 import gc
 import io
+import random
 
 import pytest
 import six
 
-from paste.util.multidict import MultiDict, UnicodeMultiDict
+from paste.util.formparser import UploadedFile
+from paste.util.multidict import IndexedMultiDict, MultiDict, UnicodeMultiDict
 
-def test_dict():
-    d = MultiDict({'a': 1})
+@pytest.mark.parametrize('cls', [MultiDict, IndexedMultiDict])
+def test_dict(cls):
+    d = cls({'a': 1})
     assert d.items() == [('a', 1)]
 
     d['b'] = 2
@@ -53,12 +56,13 @@ def test_dict():
     assert d.items() == [('a', 1), ('z', []), ('y', 6), ('x', 'x test'),
                          ((1, None), (None, 1))]
 
-def test_unicode_dict():
-    _test_unicode_dict()
-    _test_unicode_dict(decode_param_names=True)
+@pytest.mark.parametrize('cls', [MultiDict, IndexedMultiDict])
+def test_unicode_dict(cls):
+    _test_unicode_dict(cls)
+    _test_unicode_dict(cls, decode_param_names=True)
 
-def _test_unicode_dict(decode_param_names=False):
-    d = UnicodeMultiDict(MultiDict({b'a': 'a test'}))
+def _test_unicode_dict(cls, decode_param_names=False):
+    d = UnicodeMultiDict(cls({b'a': 'a test'}))
     d.encoding = 'utf-8'
     d.errors = 'ignore'
 
@@ -163,3 +167,69 @@ def _test_unicode_dict(decode_param_names=False):
     ufs = None
     gc.collect()
     assert not fs.file.closed
+
+    upload = UploadedFile('upload', u'hi.txt', {}, io.BytesIO(b'hi'))
+    d[k('u')] = upload
+    uupload = d[k('u')]
+    assert isinstance(uupload, UploadedFile)
+    assert uupload.filename == u'hi.txt'
+    assert uupload.value == b'hi'
+
+def test_indexed_dict_matches():
+    rand = random.Random(0)
+    plain = MultiDict()
+    indexed = IndexedMultiDict()
+    keys = ['a', 'b', 'c', 'd', 1, 1.0]
+    for i in range(2000):
+        key = rand.choice(keys)
+        op = rand.choice(['add', 'add', 'set', 'del', 'pop', 'popitem',
+                          'setdefault', 'update'])
+        results = []
+        for d in (plain, indexed):
+            try:
+                if op == 'add':
+                    result = d.add(key, i)
+                elif op == 'set':
+                    d[key] = i
+                    result = None
+                elif op == 'del':
+                    del d[key]
+                    result = None
+                elif op == 'pop':
+                    result = d.pop(key, None)
+                elif op == 'popitem':
+                    result = d.popitem()
+                elif op == 'setdefault':
+                    result = d.setdefault(key, i)
+                else:
+                    result = d.update([(key, i), ('e', i)], f=i)
+            except (KeyError, IndexError) as e:
+                result = e.__class__
+            results.append(result)
+        assert results[0] == results[1], op
+        assert plain.items() == indexed.items()
+        for key in keys + ['e', 'f', 'x']:
+            assert (key in plain) == (key in indexed)
+            assert plain.getall(key) == indexed.getall(key)
+            assert plain.get(key) == indexed.get(key)
+    copy = indexed.copy()
+    assert isinstance(copy, IndexedMultiDict)
+    assert copy.items() == indexed.items()
+    indexed.clear()
+    assert 'a' not in indexed and not indexed.getall('a')
+
+@pytest.mark.parametrize('cls', [MultiDict, IndexedMultiDict])
+def test_key_types(cls):
+    d = cls([(1, 'int'), (1.0, 'float')])
+    # Getting uses == alone...
+    assert d[1.0] == 'int'
+    assert d.setdefault(1.0) == 'int'
+    # ... the rest also the type
+    assert d.getall(1.0) == ['float']
+    assert d.pop(1.0) == 'float'
+    assert 1.0 not in d
+    with pytest.raises(KeyError):
+        del d[1.0]
+    d[1.0] = 'float'
+    del d[1]
+    assert d.items() == [(1.0, 'float')]
@@ -1,5 +1,11 @@
+import os
+import socket
+import threading
+import time
+
 from paste import proxy
 from paste.fixture import TestApp
+from paste.httpserver import serve, WSGIHandler
 
 def test_proxy_to_website():
     # Not the most robust test...
@@ -10,3 +16,207 @@ def test_proxy_to_website():
     res = app.get('/')
     # httpbin is a react app now, so hard to read
     assert '<title>httpbin.org</title>' in res
+
+def _upstream_app(environ, start_response):
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    body = environ['wsgi.input'].read(length)
+    if environ['PATH_INFO'] == '/stream':
+        # No content-length, so the response is sent chunked
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'x' * 100000, b'y' * 100000]
+    body = ('%s %s %d' % (environ['REQUEST_METHOD'], environ['PATH_INFO'],
+                          len(body))).encode('ascii')
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+def _start_upstream(app=_upstream_app):
+    class Handler(WSGIHandler):
+        pass
+    server = serve(app, host='127.0.0.1', port=0, handler=Handler,
+                   protocol_version='HTTP/1.1', start_loop=False,
+                   daemon_threads=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def test_pooled_proxy():
+    server = _start_upstream()
+    host, port = server.server_address[:2]
+    try:
+        proxy_app = proxy.Proxy('http://%s:%s' % (host, port), pool_size=2,
+                                connect_timeout=5, read_timeout=5)
+        app = TestApp(proxy_app)
+        res = app.get('/one', headers={'Connection': 'close'})
+        assert res.body == b'GET /one 0'
+        res = app.post('/two', params=b'a' * 200000)
+        assert res.body == b'POST /two 200000'
+        res = app.get('/stream')
+        assert res.body == b'x' * 100000 + b'y' * 100000
+        stats = proxy_app.pool.stats()
+        assert stats['created'] == 1
+        assert stats['reused'] == 2
+        assert stats['idle'] == 1
+        assert stats['in_use'] == 0
+        # A response that isn't read to the end loses its connection
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/stream',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+                   'wsgi.url_scheme': 'http', 'wsgi.input': None}
+        app_iter = proxy_app(environ, lambda status, headers: None)
+        next(iter(app_iter))
+        app_iter.close()
+        stats = proxy_app.pool.stats()
+        assert stats['discarded'] == 1
+        assert stats['idle'] == 0
+        assert app.get('/three').body == b'GET /three 0'
+        assert proxy_app.pool.stats()['created'] == 2
+        proxy_app.pool.close()
+    finally:
+        server.server_close()
+
+def test_connection_dropped_high_fd():
+    class Conn(object):
+        pass
+    a, b = socket.socketpair()
+    # Past the 1024 select() can handle
+    fd = os.dup2(a.fileno(), 1500) or 1500
+    conn = Conn()
+    conn.sock = socket.socket(a.family, a.type, fileno=fd)
+    try:
+        assert not proxy._connection_dropped(conn)
+        b.close()
+        assert proxy._connection_dropped(conn)
+    finally:
+        conn.sock.close()
+        a.close()
+
+def _unused_address():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = 'http://127.0.0.1:%s' % sock.getsockname()[1]
+    sock.close()
+    return address
+
+def test_balancer_choose():
+    balancer = proxy.Balancer(['http://a', 'http://b', 'http://c'])
+    chosen = [balancer.choose() for i in range(3)]
+    assert sorted(u.host for u in chosen) == ['a', 'b', 'c']
+    balancer.release(chosen[0])
+    assert balancer.choose(exclude=chosen[1:]) is chosen[0]
+    assert balancer.choose(exclude=balancer.upstreams) is None
+    for i in range(balancer.max_failures):
+        balancer.failed(chosen[1])
+    for i in range(10):
+        upstream = balancer.choose(exclude=[chosen[2]])
+        assert upstream is chosen[0]
+        balancer.release(upstream)
+    # With every upstream left out, they're used anyway
+    chosen[0].healthy = False
+    upstream = balancer.choose(exclude=[chosen[2]])
+    assert upstream in (chosen[0], chosen[1])
+    balancer.succeeded(chosen[1])
+    assert chosen[1].ejected_until == 0
+
+    balancer = proxy.Balancer(['http://a', 'http://b', 'http://c'],
+                              method='two_choices')
+    busy, idle, other = balancer.upstreams
+    busy.outstanding = 5
+    other.outstanding = 1
+    for i in range(20):
+        upstream = balancer.choose()
+        assert upstream is not busy
+        balancer.release(upstream)
+
+def test_balanced_proxy():
+    server = _start_upstream()
+    host, port = server.server_address[:2]
+    live = 'http://%s:%s' % (host, port)
+    dead = _unused_address()
+    try:
+        for pool_size in [None, 2]:
+            proxy_app = proxy.Proxy([dead, live], pool_size=pool_size,
+                                    connect_timeout=5)
+            app = TestApp(proxy_app)
+            dead_upstream, live_upstream = proxy_app.balancer.upstreams
+            # Ties are broken at random, so it may take a few requests
+            # for the dead upstream to fail enough times
+            for i in range(100):
+                assert app.get('/a').body == b'GET /a 0'
+                if dead_upstream.ejected_until:
+                    break
+            assert dead_upstream.failures == proxy_app.balancer.max_failures
+            for i in range(4):
+                assert app.post('/b', params=b'abc').body == b'POST /b 3'
+            assert dead_upstream.failures == proxy_app.balancer.max_failures
+            assert live_upstream.outstanding == 0
+            assert dead_upstream.outstanding == 0
+        app = TestApp(proxy.TransparentProxy(
+            force_host=[dead[7:], live[7:]]))
+        for i in range(3):
+            res = app.get('/c', extra_environ={'HTTP_HOST': 'example.com'})
+            assert res.body == b'GET /c 0'
+    finally:
+        server.server_close()
+
+def _slow_app(environ, start_response):
+    time.sleep(1)
+    return _upstream_app(environ, start_response)
+
+def test_balanced_proxy_timeouts():
+    slow_server = _start_upstream(_slow_app)
+    server = _start_upstream()
+    slow = 'http://%s:%s' % slow_server.server_address[:2]
+    live = 'http://%s:%s' % server.server_address[:2]
+    try:
+        for pool_size in [None, 2]:
+            proxy_app = proxy.Proxy([slow, live], pool_size=pool_size,
+                                    connect_timeout=5, read_timeout=0.2)
+            app = TestApp(proxy_app)
+            slow_upstream, live_upstream = proxy_app.balancer.upstreams
+            # Makes sure the slow upstream is tried first
+            live_upstream.outstanding = 5
+            # A POST that may have reached the upstream isn't sent again
+            try:
+                app.post('/a', params=b'abc')
+            except socket.timeout:
+                pass
+            else:
+                assert 0, 'POST was retried'
+            # A GET is
+            assert app.get('/b').body == b'GET /b 0'
+            # Being slow isn't a failure
+            assert slow_upstream.failures == 0
+            assert not slow_upstream.ejected_until
+            live_upstream.outstanding = 0
+            assert slow_upstream.outstanding == 0
+    finally:
+        slow_server.server_close()
+        server.server_close()
+
+def _health_app(environ, start_response):
+    status = environ['PATH_INFO'] == '/health' and '200 OK' or '500 Error'
+    start_response(status, [('Content-Type', 'text/plain')])
+    return [b'']
+
+def test_health_checker():
+    server = _start_upstream(_health_app)
+    host, port = server.server_address[:2]
+    live = 'http://%s:%s' % (host, port)
+    dead = _unused_address()
+    try:
+        balancer = proxy.Balancer([live, dead])
+        checker = proxy.HealthChecker(balancer, path='/health', timeout=5)
+        checker.check_all()
+        assert [u.healthy for u in balancer.upstreams] == [True, False]
+        checker.path = '/other'
+        checker.check_all()
+        assert [u.healthy for u in balancer.upstreams] == [False, False]
+        checker = balancer.start_health_checks('/health', interval=0.05)
+        time.sleep(0.3)
+        assert balancer.upstreams[0].healthy
+        balancer.stop_health_checks()
+        checker.join(5)
+        assert not checker.is_alive()
+    finally:
+        server.server_close()
@@ -24,10 +24,10 @@ def test_gets():
     app = TestApp(simpleapp)
     res = app.get('/')
     assert 'Hello' in res
-    assert "get is MultiDict([])" in res
+    assert "get is IndexedMultiDict([])" in res
 
     res = app.get('/?name=george')
-    res.mustcontain("get is MultiDict([('name', 'george')])")
+    res.mustcontain("get is IndexedMultiDict([('name', 'george')])")
     res.mustcontain("Val is george")
 
 def test_language_parsing():
@@ -1,3 +1,10 @@
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+from paste import session
 from paste.session import SessionMiddleware
 from paste.fixture import TestApp
 import six
@@ -54,3 +61,212 @@ def test_app2():
     assert res.body == b'fluff'
 
 
+
+class CountingStore(session.MemoryStore):
+
+    saves = 0
+
+    def save(self, sid, pickled):
+        self.saves += 1
+        session.MemoryStore.save(self, sid, pickled)
+
+def _check_store(store):
+    app = TestApp(SessionMiddleware(wsgi_app.application, store=store))
+    res = app.get('/get1')
+    assert res.body == b'no-info'
+    info[:] = ['stored']
+    app.get('/put1')
+    assert app.get('/get1').body == b'stored'
+    assert app.get('/get2').body == b'stored'
+    info[:] = ['changed']
+    app.get('/put2')
+    assert app.get('/get1').body == b'changed'
+
+def test_stores():
+    dirname = tempfile.mkdtemp()
+    try:
+        _check_store(session.MemoryStore())
+        _check_store(session.ShardedFileStore(os.path.join(dirname, 'files')))
+        _check_store(session.SQLiteStore(os.path.join(dirname, 'db')))
+    finally:
+        shutil.rmtree(dirname)
+
+def test_store_saves_changes_only():
+    store = CountingStore()
+    app = TestApp(SessionMiddleware(wsgi_app.application, store=store))
+    info[:] = ['once']
+    app.get('/put1')
+    assert store.saves == 1
+    app.get('/get1')
+    app.get('/get2')
+    assert store.saves == 1
+    info[:] = ['twice']
+    app.get('/put1')
+    assert store.saves == 2
+
+def test_store_session_ids():
+    store = session.MemoryStore()
+    for sid in ['', '../etc/passwd', 'missing']:
+        try:
+            session.StoreSession(sid, store=store)
+        except KeyError:
+            pass
+        else:
+            assert False, "Expected KeyError for %r" % sid
+
+def test_sharded_file_store():
+    dirname = tempfile.mkdtemp()
+    try:
+        store = session.ShardedFileStore(dirname, expiration=1)
+        store.cleanup_shards = 256
+        store.save('abc', b'data')
+        filename = store.filename('abc')
+        assert filename.startswith(dirname)
+        assert len(filename[len(dirname):].split(os.sep)) == 4
+        assert store.load('abc') == b'data'
+        assert store.load('other') is None
+        store.save('old', b'old data')
+        old = time.time() - 120
+        os.utime(store.filename('old'), (old, old))
+        assert store.load('old') is None
+        store.clean_up()
+        assert not os.path.exists(store.filename('old'))
+        assert os.path.exists(filename)
+        store.delete('abc')
+        assert store.load('abc') is None
+    finally:
+        shutil.rmtree(dirname)
+
+def test_sqlite_store():
+    dirname = tempfile.mkdtemp()
+    try:
+        store = session.SQLiteStore(os.path.join(dirname, 'sessions.db'))
+        store.save('abc', b'data')
+        store.save('abc', b'new data')
+        assert store.load('abc') == b'new data'
+        store.expiration = -1
+        store.save('old', b'old data')
+        assert store.load('old') is None
+        store.clean_up()
+        count = store.connection().execute(
+            "SELECT COUNT(*) FROM paste_session").fetchone()[0]
+        assert count == 1
+        store.delete('abc')
+        assert store.load('abc') is None
+    finally:
+        shutil.rmtree(dirname)
+
+def test_memory_store():
+    store = session.MemoryStore(max_sessions=2)
+    store.save('a', b'1')
+    store.save('b', b'2')
+    assert store.load('a') == b'1'
+    store.save('c', b'3')
+    # b was used least recently
+    assert store.load('b') is None
+    assert store.load('a') == b'1'
+    assert store.load('c') == b'3'
+    store.max_sessions = 3
+    store.expiration = -1
+    store.save('d', b'4')
+    store.clean_up()
+    assert list(store.sessions) == ['a', 'c']
+    store.save('d', b'4')
+    assert store.load('d') is None
+
+def test_session_dict():
+    data = session.SessionDict({'a': [1]})
+    assert not data.modified
+    data.get('a')
+    data['a'].append(2)
+    assert not data.modified
+    data.changed()
+    assert data.modified
+    for change in [lambda d: d.__setitem__('b', 1),
+                   lambda d: d.__delitem__('a'),
+                   lambda d: d.pop('a'),
+                   lambda d: d.popitem(),
+                   lambda d: d.setdefault('b', 1),
+                   lambda d: d.update(b=1),
+                   lambda d: d.clear()]:
+        data = session.SessionDict({'a': 1})
+        change(data)
+        assert data.modified
+    data = session.SessionDict({'a': 1})
+    data.pop('b', None)
+    data.setdefault('a', 2)
+    assert not data.modified
+
+def test_file_session_writes_changes_only():
+    dirname = tempfile.mkdtemp()
+    try:
+        sess = session.FileSession('20240101000000-abc', create=True,
+                                   session_file_path=dirname, touch=True)
+        sess.data()['a'] = {'b': 1}
+        sess.close()
+        filename = sess.filename()
+        assert os.listdir(dirname) == [os.path.basename(filename)]
+        inode = os.stat(filename).st_ino
+        old = time.time() - 600
+        os.utime(filename, (old, old))
+
+        sess = session.FileSession('20240101000000-abc',
+                                   session_file_path=dirname)
+        sess.data()['a']['b'] = 2
+        sess.close()
+        # Unchanged as far as it knows, and not touched
+        assert os.stat(filename).st_ino == inode
+        assert os.path.getmtime(filename) < time.time() - 300
+
+        sess = session.FileSession('20240101000000-abc',
+                                   session_file_path=dirname, touch=True)
+        assert sess.data() == {'a': {'b': 1}}
+        sess.close()
+        assert os.stat(filename).st_ino == inode
+        assert os.path.getmtime(filename) > time.time() - 300
+
+        sess = session.FileSession('20240101000000-abc',
+                                   session_file_path=dirname)
+        sess.data()['a']['b'] = 2
+        sess.data().changed()
+        sess.close()
+        sess = session.FileSession('20240101000000-abc',
+                                   session_file_path=dirname)
+        assert sess.data() == {'a': {'b': 2}}
+        # A recently used session isn't cleaned up, however old its sid
+        sess._clean_up_file(os.path.basename(filename),
+                            exp_time=datetime.timedelta(minutes=5),
+                            now=datetime.datetime.now())
+        assert os.path.exists(filename)
+    finally:
+        shutil.rmtree(dirname)
+
+def test_store_touch():
+    dirname = tempfile.mkdtemp()
+    try:
+        memory = session.MemoryStore()
+        files = session.ShardedFileStore(dirname)
+        sqlite = session.SQLiteStore(os.path.join(dirname, 'db'))
+        for store in [memory, files, sqlite]:
+            store.expiration = 1
+            sess = session.StoreSession('abc', create=True, store=store,
+                                        touch=True)
+            sess.data()['a'] = 1
+            sess.close()
+            if store is files:
+                old = time.time() - 600
+                os.utime(files.filename('abc'), (old, old))
+            store.expiration = 60
+            sess = session.StoreSession('abc', store=store, touch=True)
+            assert sess.data() == {'a': 1}
+            sess.close()
+            if store is memory:
+                expires = memory.sessions['abc'][1]
+            elif store is files:
+                expires = os.path.getmtime(files.filename('abc')) + 3600
+            else:
+                expires = sqlite.connection().execute(
+                    "SELECT expires FROM paste_session").fetchone()[0]
+            assert expires > time.time() + 3000
+    finally:
+        shutil.rmtree(dirname)
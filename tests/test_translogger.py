@@ -0,0 +1,123 @@
+import json
+import logging
+import re
+import time
+
+from paste.fixture import TestApp
+from paste.translogger import TransLogger
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+def make_logger(name):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = ListHandler()
+    logger.addHandler(handler)
+    return logger, handler
+
+def simple_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', '5')])
+    return [b'hello']
+
+def streaming_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    yield b'hello '
+    yield b'world'
+
+def test_log_format():
+    logger, handler = make_logger('test_translogger.format')
+    app = TestApp(TransLogger(simple_app, logger=logger))
+    app.get('/path?a=1', extra_environ={'REMOTE_ADDR': '10.0.0.1',
+                                        'HTTP_USER_AGENT': 'tester'})
+    app = TestApp(TransLogger(streaming_app, logger=logger))
+    app.get('/stream')
+    first, second = handler.messages
+    assert re.match(
+        r'^10\.0\.0\.1 - - \[\d\d/\w\w\w/\d{4}:\d\d:\d\d:\d\d [+-]\d{4}\] '
+        r'"GET /path\?a=1 HTTP/1\.0" 200 5 "-" "tester"$', first), first
+    assert second.endswith('" 200 11 "-" "-"'), second
+
+def test_json_output():
+    logger, handler = make_logger('test_translogger.json')
+    app = TestApp(TransLogger(streaming_app, logger=logger,
+                              json_output=True))
+    app.get('/stream')
+    entry = json.loads(handler.messages[0])
+    assert entry['REQUEST_URI'] == '/stream'
+    assert entry['status'] == '200'
+    assert entry['bytes'] == 11
+    assert entry['duration'] >= 0
+
+def test_asynchronous():
+    logger, handler = make_logger('test_translogger.asynchronous')
+    translogger = TransLogger(simple_app, logger=logger, asynchronous=True,
+                              batch_size=3, format='%(REQUEST_URI)s')
+    app = TestApp(translogger)
+    for i in range(10):
+        app.get('/%s' % i)
+    translogger.close()
+    assert not translogger.writer.is_alive()
+    assert handler.messages == ['/%s' % i for i in range(10)]
+
+def test_timing():
+    logger, handler = make_logger('test_translogger.timing')
+    translogger = TransLogger(streaming_app, logger=logger, json_output=True)
+    app_iter = translogger({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'},
+                           lambda status, headers: None)
+    assert list(app_iter) == [b'hello ', b'world']
+    assert not handler.messages
+    app_iter.close()
+    entry = json.loads(handler.messages.pop())
+    assert entry['bytes'] == 11
+    assert 0 <= entry['ttfb'] <= entry['duration']
+
+    # Lists, and file wrappers, are logged at once and not wrapped
+    def list_app(environ, start_response):
+        start_response('200 OK', [])
+        return [b'abc', b'de']
+    translogger.application = list_app
+    body = [b'abc', b'de']
+    app_iter = translogger({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'},
+                           lambda status, headers: None)
+    assert app_iter == body
+    entry = json.loads(handler.messages.pop())
+    assert entry['bytes'] == 5
+    assert entry['ttfb'] == entry['duration']
+
+    class FileWrapper(object):
+        def __init__(self, filelike, block_size=8192):
+            self.filelike = filelike
+    def file_app(environ, start_response):
+        start_response('200 OK', [('Content-Length', '3')])
+        return environ['wsgi.file_wrapper'](None)
+    translogger.application = file_app
+    app_iter = translogger({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/',
+                            'wsgi.file_wrapper': FileWrapper},
+                           lambda status, headers: None)
+    assert isinstance(app_iter, FileWrapper)
+    assert json.loads(handler.messages.pop())['bytes'] == 3
+
+def test_write_log_signature():
+    # Subclasses overriding write_log still get the old arguments
+    calls = []
+    class Logger(TransLogger):
+        def write_log(self, environ, method, req_uri, start, status, bytes):
+            calls.append((start, environ['paste.translogger.timing']))
+            TransLogger.write_log(self, environ, method, req_uri, start,
+                                  status, bytes)
+    logger, handler = make_logger('test_translogger.signature')
+    app = TestApp(Logger(streaming_app, logger=logger, json_output=True))
+    app.get('/stream')
+    (start, (duration, ttfb)), = calls
+    assert isinstance(start, time.struct_time)
+    assert 0 <= ttfb <= duration
+    assert json.loads(handler.messages[0])['duration'] == duration
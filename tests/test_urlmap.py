@@ -51,3 +51,38 @@ def test_404():
     assert b'--><script' not in res.body
     res = app.get("/--%01><script>", status=404)
     assert b'--\x01><script>' not in res.body
+
+def _linear_match(mapper, host, port, path_info):
+    # How URLMap used to search its applications
+    for (domain, app_url), app in mapper.applications:
+        if domain and domain != host and domain != host+':'+port:
+            continue
+        if (path_info == app_url
+            or path_info.startswith(app_url + '/')):
+            return app_url, app
+    return None
+
+def test_index_matches_linear_search():
+    mapper = URLMap()
+    urls = ['', '/a', '/a/b', '/a/b/c', '/ab', '/x/y',
+            'http://foo.com/', 'http://foo.com/a/b', 'http://foo.com:8080/a',
+            'http://foo.com:8080/a/b/c', ('bar.com', '/x'), ('bar.com', '')]
+    for url in urls:
+        mapper[url] = make_app(repr(url))
+    paths = ['', '/', '/a', '/a/', '/a/b', '/a/bc', '/a/b/c/d', '/ab/c',
+             '/x', '/x/y/z', '/z']
+    for host, port in [('foo.com', '80'), ('foo.com', '8080'),
+                       ('bar.com', '80'), ('other.com', '443')]:
+        for path in paths:
+            assert mapper.match(host, port, path) == \
+                _linear_match(mapper, host, port, path), (host, port, path)
+    # The index follows changes to the map
+    del mapper['/a/b']
+    assert mapper.match('other.com', '80', '/a/b/x')[0] == '/a'
+    mapper['/a/b/x'] = make_app('new')
+    assert mapper.match('other.com', '80', '/a/b/x')[0] == '/a/b/x'
+    del mapper['']
+    assert mapper.match('other.com', '80', '/z') is None
+    app = TestApp(mapper)
+    res = app.get('/a//b///x/y', extra_environ={'HTTP_HOST': 'other.com'})
+    assert res.body == b'new'
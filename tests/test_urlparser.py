@@ -1,4 +1,6 @@
 import os
+import tempfile
+import time
 from paste.urlparser import *
 from paste.fixture import *
 from pkg_resources import get_distribution
@@ -135,6 +137,51 @@ def test_static_parser():
     res = testapp.get('/dir%20with%20spaces/%2e%2e/%2e%2e/secured.txt', status=404)
     res = testapp.get('/dir%20with%20spaces/', status=404)
 
+def test_static_parser_file_cache():
+    cache = StaticFileCache(check_interval=0)
+    app = TestApp(StaticURLParser(path('find_file'), file_cache=cache))
+    for i in range(2):
+        res = app.get('/dir with spaces/test 4.html')
+        assert res.body.strip() == b'test 4'
+        app.get('/index.txt/foo', status=404)
+        app.get('/dir with spaces/../../secured.txt', status=404)
+    assert cache.hits == 1
+    assert len(cache.entries) == 1
+    assert cache.size == cache.entry_size + len(res.body)
+
+def test_static_file_cache_revalidates():
+    dirname = tempfile.mkdtemp()
+    filename = os.path.join(dirname, 'a.txt')
+    with open(filename, 'wb') as fp:
+        fp.write(b'first')
+    try:
+        cache = StaticFileCache(max_size=4000, check_interval=60)
+        app = TestApp(StaticURLParser(dirname, file_cache=cache))
+        assert app.get('/a.txt').body == b'first'
+        with open(filename, 'wb') as fp:
+            fp.write(b'second')
+        os.utime(filename, (time.time() + 10, time.time() + 10))
+        # Not checked again yet
+        assert app.get('/a.txt').body == b'first'
+        for fa, size in cache.entries.values():
+            fa.check_interval = 0
+        assert app.get('/a.txt').body == b'second'
+        assert (cache.hits, cache.misses) == (2, 1)
+        os.unlink(filename)
+        app.get('/a.txt', status=404)
+        assert not cache.entries and cache.size == 0
+        # Bounded by size
+        for i in range(10):
+            with open(os.path.join(dirname, '%s.txt' % i), 'wb') as fp:
+                fp.write(b'x' * 1000)
+            app.get('/%s.txt' % i)
+        assert cache.size <= cache.max_size
+        assert len(cache.entries) == 1
+    finally:
+        for name in os.listdir(dirname):
+            os.unlink(os.path.join(dirname, name))
+        os.rmdir(dirname)
+
 def test_egg_parser():
     app = PkgResourcesParser('Paste', 'paste')
     testapp = TestApp(app)
@@ -0,0 +1,151 @@
+import cgi
+import io
+import random
+
+import pytest
+import six
+
+from paste.request import parse_formvars
+from paste.util.formparser import FormError, UploadedFile, parse_form
+
+BOUNDARY = 'xYzZY'
+
+def multipart(fields, boundary=BOUNDARY, preamble=b'', epilogue=b''):
+    lines = [preamble]
+    for name, value in fields:
+        lines.append(b'--' + boundary.encode('ascii') + b'\r\n')
+        if isinstance(value, tuple):
+            filename, content = value
+            lines.append(('Content-Disposition: form-data; name="%s"; '
+                          'filename="%s"\r\n' % (name, filename)
+                          ).encode('utf-8'))
+            lines.append(b'Content-Type: application/octet-stream\r\n\r\n')
+            lines.append(content)
+        else:
+            lines.append(('Content-Disposition: form-data; name="%s"\r\n'
+                          '\r\n' % name).encode('utf-8'))
+            lines.append(value.encode('utf-8'))
+        lines.append(b'\r\n')
+    lines.append(b'--' + boundary.encode('ascii') + b'--\r\n' + epilogue)
+    return b''.join(lines)
+
+def parse(body, block_size=None, **kw):
+    return parse_form(io.BytesIO(body),
+                      'multipart/form-data; boundary="%s"' % BOUNDARY,
+                      len(body), block_size=block_size, **kw)
+
+def test_multipart():
+    body = multipart(
+        [('a', u'1'), ('b', u'caf\xe9\r\n--xYz'), ('a', u''),
+         ('upload', (u'寿司.txt', b'\x00data\r\n' * 100))],
+        preamble=b'ignored\r\n', epilogue=b'ignored too')
+    for block_size in [None, 1, 2, 3, 7, 64]:
+        fields = parse(body, block_size=block_size)
+        assert [name for name, value in fields] == ['a', 'b', 'a', 'upload']
+        assert fields[0][1] == '1'
+        if six.PY3:
+            assert fields[1][1] == u'caf\xe9\r\n--xYz'
+        upload = fields[3][1]
+        assert isinstance(upload, UploadedFile)
+        assert isinstance(upload, cgi.FieldStorage)
+        if six.PY3:
+            assert upload.filename == u'寿司.txt'
+        assert upload.type == 'application/octet-stream'
+        assert upload.value == b'\x00data\r\n' * 100
+        assert upload.file.read() == upload.value
+
+def test_matches_field_storage():
+    rand = random.Random(0)
+    for i in range(20):
+        fields = []
+        for j in range(rand.randint(1, 6)):
+            content = bytes(bytearray(
+                rand.choice(b'ab\r\n-xYzZY') for k in range(rand.randint(0, 50))))
+            if rand.random() < 0.5:
+                fields.append(('f%s' % j, ('file%s' % j, content)))
+            else:
+                fields.append(('f%s' % j, content.decode('ascii')))
+        body = multipart(fields)
+        environ = {'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(body)),
+                   'CONTENT_TYPE': 'multipart/form-data; boundary=%s'
+                   % BOUNDARY}
+        fs = cgi.FieldStorage(fp=io.BytesIO(body), environ=environ,
+                              keep_blank_values=True)
+        expected = [(item.name, item.value) for item in fs.list]
+        got = [(name, getattr(value, 'value', value))
+               for name, value in parse(body, block_size=rand.randint(1, 20))]
+        assert got == expected
+
+def test_spooling():
+    body = multipart([('small', (u'small', b'x' * 10)),
+                      ('large', (u'large', b'y' * 5000))])
+    small, large = [value for name, value in parse(body, spool_size=1000)]
+    assert not small.file._rolled
+    assert large.file._rolled
+    assert large.value == b'y' * 5000
+
+def test_limits():
+    body = multipart([('a', u'1'), ('b', u'x' * 100), ('c', (u'c', b'y' * 500))])
+    pytest.raises(FormError, parse, body, max_parts=2)
+    pytest.raises(FormError, parse, body, max_field_size=50)
+    pytest.raises(FormError, parse, body, max_size=len(body) - 1)
+    assert len(parse(body, max_parts=3, max_field_size=100,
+                     max_size=len(body))) == 3
+    # Files don't count against the field size
+    assert len(parse(body, max_field_size=100)) == 3
+    pytest.raises(FormError, parse, body[:-20])
+    pytest.raises(FormError, parse_form, io.BytesIO(body),
+                  'multipart/form-data', len(body))
+
+def test_urlencoded():
+    body = b'a=1&b=caf%C3%A9&&c=&d=x+y&a=' + b'z' * 100
+    for block_size in [None, 1, 3, 10]:
+        fields = parse_form(io.BytesIO(body),
+                            'application/x-www-form-urlencoded',
+                            len(body), block_size=block_size)
+        assert fields == [('a', '1'), ('b', u'caf\xe9' if six.PY3 else
+                                       'caf\xc3\xa9'),
+                          ('c', ''), ('d', 'x y'), ('a', 'z' * 100)]
+    pytest.raises(FormError, parse_form, io.BytesIO(body),
+                  'application/x-www-form-urlencoded', len(body),
+                  max_field_size=50, block_size=10)
+    pytest.raises(FormError, parse_form, io.BytesIO(body),
+                  'application/x-www-form-urlencoded', len(body),
+                  max_parts=4)
+    assert parse_form(io.BytesIO(body), 'text/xml', len(body)) == []
+
+def test_urlencoded_blocks():
+    # Fields spanning many blocks, and '&' at every place in a block
+    rand = random.Random(0)
+    body = b'&'.join(
+        b'f%d=' % i + b'v' * rand.choice([0, 1, 5, 50, 500])
+        for i in range(40)) + b'&&x=1'
+    expected = [(name.decode('ascii'), value.decode('ascii'))
+                for name, value in (pair.split(b'=')
+                                    for pair in body.split(b'&') if pair)]
+    for block_size in [1, 2, 7, 64, 1000]:
+        fields = parse_form(io.BytesIO(body),
+                            'application/x-www-form-urlencoded',
+                            len(body), block_size=block_size)
+        assert [tuple(map(str, field)) for field in fields] == expected
+
+def test_parse_formvars():
+    body = multipart([('a', u'1'), ('empty', (u'', b'')),
+                      ('upload', (u'u.txt', b'data'))])
+    environ = {'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(body)),
+               'CONTENT_TYPE': 'multipart/form-data; boundary=%s' % BOUNDARY,
+               'QUERY_STRING': 'q=1', 'wsgi.input': io.BytesIO(body)}
+    formvars = parse_formvars(environ)
+    assert formvars['a'] == '1'
+    assert formvars['empty'] == b''
+    assert formvars['upload'].value == b'data'
+    assert formvars['q'] == '1'
+    environ = {'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(body)),
+               'CONTENT_TYPE': 'multipart/form-data; boundary=%s' % BOUNDARY,
+               'wsgi.input': io.BytesIO(body)}
+    pytest.raises(FormError, parse_formvars, environ, max_parts=2)
+    # A bad Content-Length is ignored
+    environ = {'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': 'bogus',
+               'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+               'QUERY_STRING': 'q=1', 'wsgi.input': io.BytesIO(b'a=1')}
+    assert parse_formvars(environ).items() == [('q', '1')]
@@ -0,0 +1,124 @@
+import os
+import threading
+
+from paste.util.template import HTMLTemplate, Template, TemplateLoader
+
+def write(path, content, mtime):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.utime(path, (mtime, mtime))
+
+def test_loader(tmpdir):
+    path = str(tmpdir.join('page.html'))
+    write(path, 'Hi {{name}}', 1000)
+    loader = TemplateLoader(HTMLTemplate, check_interval=0)
+    tmpl = loader.load(path)
+    assert isinstance(tmpl, HTMLTemplate)
+    assert tmpl.substitute(name='<you>') == 'Hi &lt;you&gt;'
+    assert loader.load(path) is tmpl
+    assert HTMLTemplate.from_filename(path, loader=loader) is tmpl
+    assert (loader.hits, loader.misses) == (2, 1)
+    # Plain templates are cached separately
+    plain = Template.from_filename(path, loader=loader)
+    assert plain.substitute(name='<you>') == 'Hi <you>'
+    # A namespace gives a copy that shares the compiled template
+    bound = loader.load(path, namespace={'name': 'ns'})
+    assert bound is not tmpl and bound.substitute() == 'Hi ns'
+    assert tmpl.namespace == {}
+
+    write(path, 'Bye {{name}}', 2000)
+    assert loader.load(path).substitute(name='x') == 'Bye x'
+    os.unlink(path)
+    try:
+        loader.load(path)
+    except (IOError, OSError):
+        pass
+    else:
+        assert 0, 'Removed file still loaded'
+
+def test_loader_check_interval(tmpdir):
+    path = str(tmpdir.join('page.txt'))
+    write(path, 'one', 1000)
+    loader = TemplateLoader(check_interval=3600)
+    assert loader.load(path).substitute() == 'one'
+    write(path, 'two', 2000)
+    assert loader.load(path).substitute() == 'one'
+    loader.clear()
+    assert loader.load(path).substitute() == 'two'
+
+def test_loader_bounded(tmpdir):
+    loader = TemplateLoader(max_templates=3)
+    paths = []
+    for i in range(5):
+        path = str(tmpdir.join('t%s.txt' % i))
+        write(path, '{{%s}}' % i, 1000)
+        paths.append(path)
+    results = []
+    def load_all():
+        for path in paths * 20:
+            results.append(loader.load(path).substitute())
+    threads = [threading.Thread(target=load_all) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 400
+    assert sorted(set(results)) == ['0', '1', '2', '3', '4']
+    assert len(loader.entries) == 3
+    assert loader.hits + loader.misses == 400
+
+def test_generate():
+    tmpl = HTMLTemplate(
+        '<ul>\n{{for i in items}}\n{{if i == 3}}{{continue}}{{endif}}'
+        '<li>{{i}}</li>\n{{endfor}}\n</ul>{{py:x = "<end>"}}{{x}}')
+    tmpl.flush_size = 20
+    chunks = list(tmpl.generate(items=range(10)))
+    assert b''.join(chunks) == tmpl.substitute(items=range(10)).encode('utf8')
+    assert len(chunks) > 2
+    assert all(isinstance(chunk, bytes) for chunk in chunks)
+    # Each chunk but the last ends at a loop pass
+    assert all(chunk.endswith(b'</li>\n') for chunk in chunks[:-1])
+    assert chunks[-1].endswith(b'&lt;end&gt;')
+    tmpl.flush_size = 8192
+    assert list(tmpl.generate(items=[])) == [b'<ul>\n</ul>&lt;end&gt;']
+    assert list(Template('').generate()) == []
+
+def test_generate_lazily():
+    seen = []
+    def items():
+        for i in range(100):
+            seen.append(i)
+            yield i
+    tmpl = Template('{{for i in items}}{{i}},{{endfor}}')
+    tmpl.flush_size = 10
+    app_iter = tmpl.generate(items=items())
+    assert next(app_iter) == b'0,1,2,3,4,'
+    assert len(seen) < 10
+    app_iter.close()
+    assert len(seen) < 10
+
+def test_generate_errors():
+    tmpl = Template('{{for i in x}}\n{{1 / i}}\n{{endfor}}', name='t.txt')
+    tmpl.flush_size = 1
+    app_iter = tmpl.generate(x=[1, 0])
+    assert next(app_iter) == b'1.0\n'
+    try:
+        next(app_iter)
+    except ZeroDivisionError as e:
+        assert str(e).endswith('at line 2 column 3 in file t.txt'), str(e)
+    else:
+        assert 0, 'No error'
+
+def test_comprehensions():
+    # Comprehensions are inlined into the function on Python 3.12+
+    tmpl = Template('{{[y * 2 for y in xs]}} {{ {y: 1 for y in xs} }} '
+                    '{{for x in [y for y in xs if y]}}{{x}}{{endfor}}')
+    assert tmpl.substitute(xs=[0, 1]) == '[0, 2] {0: 1, 1: 1} 1'
+    assert Template('{{(z := 3)}}{{z}}').substitute() == '33'
+    assert Template('{{[(w := y) for y in xs]}}{{w}}').substitute(
+        xs=[1, 2]) == '[1, 2]2'
+
+def test_locals():
+    # locals() is the namespace, as it was when expressions were eval'd
+    tmpl = Template('{{sorted(k for k in locals() if k[0] == "a")}}')
+    assert tmpl.substitute(ab=1, ac=2) == "['ab', 'ac']"